@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+# Benchmark suite for eflomal, using a synthetic corpus from synthetic.py:
+#
+#   python3 benchmarks/run.py -n 100000 --seed 1 -o results.jsonl
+#
+# Each result is written as one JSON object per line, and the results of
+# another run (e.g. from a different commit) can be compared with:
+#
+#   python3 benchmarks/run.py -n 100000 --seed 1 --compare results.jsonl
+#
+# Timings of the eflomal binary are taken from its telemetry records (see
+# the README), everything else is timed here. Since the corpus and the
+# sampler are seeded, the links (and thus their precision and recall against
+# the gold links of the synthetic corpus) are the same between runs of the
+# same code.
+
+import argparse
+from collections import defaultdict
+import json
+import os
+import subprocess
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+import eflomal
+
+from synthetic import generate_corpus, write_corpus
+
+
+def timed(f, repeat=1):
+    """Call f() repeat times and return the minimum time and the result"""
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = f()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def git_commit():
+    """Return the commit of the source tree, or None if unknown"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+            universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_links(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        return [set(tuple(map(int, link.split('-'))) for link in line.split())
+                for line in f]
+
+
+def run_eflomal(source_filename, target_filename, **kwargs):
+    """Run the eflomal binary and return its telemetry records"""
+    records = []
+    eflomal.align(source_filename, target_filename,
+                  progress=records.append, **kwargs)
+    return records
+
+
+def telemetry_results(records):
+    """Summarize the telemetry records of an alignment run"""
+    throughput = defaultdict(list)
+    results = []
+    for record in records:
+        event = record['event']
+        if event == 'iteration':
+            throughput[(record['model'], record['direction'])].append(
+                record['tokens_per_second'])
+        elif event in ('argmax', 'scores'):
+            results.append(('%s_%s' % (event, record['direction']),
+                            record['seconds'], 's'))
+        elif event in ('read', 'priors'):
+            results.append((event, record['seconds'], 's'))
+        elif event == 'done':
+            results.append(('max_rss', record['max_rss_kb'], 'kB'))
+    for (model, direction), values in sorted(throughput.items()):
+        results.append(('sample_model%d_%s' % (model, direction),
+                        sum(values) / len(values), 'tokens/s'))
+    return results
+
+
+def run_benchmarks(args, tmpdir):
+    """Run all benchmarks, and return a list of (name, value, unit)"""
+    results = []
+
+    def path(name):
+        return os.path.join(tmpdir, name)
+
+    source, target, gold = generate_corpus(
+        args.n_sentences, vocabulary_size=args.vocabulary_size,
+        exponent=args.exponent, mean_length=args.mean_length,
+        seed=args.seed)
+    with open(path('src.txt'), 'w', encoding='utf-8') as srcf, \
+         open(path('trg.txt'), 'w', encoding='utf-8') as trgf:
+        write_corpus(source, target, gold, srcf, trgf)
+
+    def read_texts():
+        with open(path('src.txt'), 'r', encoding='utf-8') as srcf, \
+             open(path('trg.txt'), 'r', encoding='utf-8') as trgf:
+            return (eflomal.read_text(srcf, True, 0, 0),
+                    eflomal.read_text(trgf, True, 0, 0))
+
+    t, ((src_sents, src_index), (trg_sents, trg_index)) = timed(
+        read_texts, args.repeat)
+    results.append(('read_text', t, 's'))
+
+    for name, write, suffix in (
+            ('write_text', eflomal.write_text, 'efl'),
+            ('write_binary_text', eflomal.write_binary_text, 'eflt')):
+        def write_texts():
+            with open(path('src.' + suffix), 'wb') as srcf, \
+                 open(path('trg.' + suffix), 'wb') as trgf:
+                write(srcf, src_sents, len(src_index))
+                write(trgf, trg_sents, len(trg_index))
+        t, _ = timed(write_texts, args.repeat)
+        results.append((name, t, 's'))
+
+    records = run_eflomal(
+        path('src.eflt'), path('trg.eflt'),
+        links_filename_fwd=path('fwd'), links_filename_rev=path('rev'),
+        scores_filename_fwd=path('scores.fwd'),
+        scores_filename_rev=path('scores.rev'),
+        model=args.model, score_model=args.model,
+        n_iterations=args.n_iterations, n_samplers=args.n_samplers,
+        seed=args.seed)
+    results.extend(
+        (('text_read_binary' if name == 'read' else name), value, unit)
+        for name, value, unit in telemetry_results(records))
+
+    links = read_links(path('fwd'))
+    n_correct = sum(len(a.intersection(b)) for a, b in zip(links, gold))
+    results.append(('precision_forward',
+                    n_correct / max(1, sum(map(len, links))), ''))
+    results.append(('recall_forward',
+                    n_correct / max(1, sum(map(len, gold))), ''))
+
+    def priors():
+        with open(path('src.txt'), 'r', encoding='utf-8') as srcf, \
+             open(path('trg.txt'), 'r', encoding='utf-8') as trgf, \
+             open(path('fwd'), 'r', encoding='utf-8') as fwdf, \
+             open(path('rev'), 'r', encoding='utf-8') as revf:
+            return eflomal.calculate_priors(srcf, trgf, fwdf, revf, False)
+
+    t, priors_tuple = timed(priors, args.repeat)
+    results.append(('calculate_priors', t, 's'))
+    with open(path('priors'), 'w', encoding='utf-8') as f:
+        eflomal.write_priors(f, *priors_tuple)
+
+    # A single IBM1 iteration with priors, to time reading the texts and
+    # priors in the text and binary formats
+    aligner = eflomal.Aligner()
+    for binary, suffix in ((False, 'text'), (True, 'binary')):
+        with open(path('src.txt'), 'r', encoding='utf-8') as srcf, \
+             open(path('trg.txt'), 'r', encoding='utf-8') as trgf, \
+             open(path('priors'), 'r', encoding='utf-8') as priorsf, \
+             open(path('src.p'), 'wb') as srcpf, \
+             open(path('trg.p'), 'wb') as trgpf, \
+             open(path('priors.p'), 'wb' if binary else 'w') as priorspf:
+            aligner.prepare_files(srcf, srcpf, trgf, trgpf,
+                                  priorsf, priorspf, binary=binary)
+        records = run_eflomal(
+            path('src.p'), path('trg.p'), links_filename_fwd=path('fwd.p'),
+            priors_filename=path('priors.p'), model=1, n_iterations=(1,),
+            seed=args.seed)
+        for name, value, unit in telemetry_results(records):
+            if name == 'priors':
+                results.append(('priors_read_' + suffix, value, unit))
+            elif name == 'read' and not binary:
+                results.append(('text_read_text', value, unit))
+
+    return results
+
+
+def compare(results, baseline):
+    """Print a comparison between two lists of result records"""
+    old = {r['benchmark']: r for r in baseline if 'benchmark' in r}
+    print('%-26s %14s %14s %8s' % ('benchmark', 'baseline', 'current',
+                                   'ratio'))
+    for r in results:
+        name = r['benchmark']
+        if name not in old: continue
+        ratio = r['value'] / old[name]['value'] if old[name]['value'] \
+                else float('nan')
+        print('%-26s %14.6g %14.6g %8.3f %s' % (
+            name, old[name]['value'], r['value'], ratio, r['unit']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark eflomal on a synthetic corpus')
+    parser.add_argument(
+        '-n', '--sentences', dest='n_sentences', type=int, default=20000,
+        metavar='N', help='Number of sentence pairs')
+    parser.add_argument(
+        '--vocabulary', dest='vocabulary_size', type=int, default=10000,
+        metavar='N', help='Vocabulary size of each language')
+    parser.add_argument(
+        '--exponent', dest='exponent', type=float, default=1.0,
+        metavar='X', help='Exponent of the Zipfian distribution')
+    parser.add_argument(
+        '--mean-length', dest='mean_length', type=float, default=20.0,
+        metavar='X', help='Mean sentence length')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, default=1,
+        metavar='N', help='Random seed for the corpus and the sampler')
+    parser.add_argument(
+        '-m', '--model', dest='model', type=int, default=3,
+        metavar='N', help='Model (1 = IBM1, 2 = IBM1+HMM, '
+                          '3 = IBM1+HMM+fertility)')
+    parser.add_argument(
+        '--iterations', dest='n_iterations', type=int, nargs=3,
+        default=None, metavar='N',
+        help='Number of iterations per model (default: automatic)')
+    parser.add_argument(
+        '--n-samplers', dest='n_samplers', type=int, default=3,
+        metavar='N', help='Number of independent samplers')
+    parser.add_argument(
+        '--repeat', dest='repeat', type=int, default=3,
+        metavar='N', help='Number of repetitions of the Python benchmarks '
+                          '(the fastest is recorded)')
+    parser.add_argument(
+        '-o', '--output', dest='output_filename', type=str, default=None,
+        metavar='filename', help='File to write results to (JSON lines)')
+    parser.add_argument(
+        '--compare', dest='baseline_filename', type=str, default=None,
+        metavar='filename', help='Compare with results from this file')
+    args = parser.parse_args()
+    if args.n_iterations is not None:
+        args.n_iterations = tuple(args.n_iterations)
+
+    with TemporaryDirectory() as tmpdir:
+        results = [{'benchmark': name, 'value': value, 'unit': unit}
+                   for name, value, unit in run_benchmarks(args, tmpdir)]
+
+    config = {'commit': git_commit(), 'time': time.time()}
+    config.update(vars(args))
+    del config['output_filename'], config['baseline_filename']
+
+    outf = sys.stdout if args.output_filename is None \
+            else open(args.output_filename, 'w', encoding='utf-8')
+    if args.baseline_filename is None or args.output_filename is not None:
+        print(json.dumps({'config': config}), file=outf)
+        for r in results:
+            print(json.dumps(r), file=outf)
+    if outf is not sys.stdout: outf.close()
+
+    if args.baseline_filename is not None:
+        with open(args.baseline_filename, 'r', encoding='utf-8') as f:
+            baseline = [json.loads(line) for line in f]
+        compare(results, baseline)
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Generate a synthetic parallel corpus for benchmarking, e.g.:
+#
+#   python3 benchmarks/synthetic.py -n 100000 --seed 1 \
+#       -s synth.src -t synth.trg -g synth.gold
+#
+# Source words are drawn from a Zipfian distribution, and each is translated
+# into one target word, dropped (aligned to NULL) or accompanied by an
+# inserted target word, before the target sentence is locally reordered.
+# The same arguments and seed always give the same corpus.
+
+import argparse
+
+import numpy as np
+
+
+def zipf_distribution(vocabulary_size, exponent):
+    """Return the cumulative distribution of a Zipfian vocabulary"""
+    p = 1.0 / np.arange(1, vocabulary_size+1, dtype=np.float64)**exponent
+    return np.cumsum(p / p.sum())
+
+
+def generate_corpus(n_sentences, vocabulary_size=10000, exponent=1.0,
+                    mean_length=20.0, length_sigma=0.5, max_length=None,
+                    null_rate=0.1, swap_rate=0.1, seed=1):
+    """Generate a synthetic parallel corpus
+
+    Arguments:
+    n_sentences -- number of sentence pairs
+    vocabulary_size -- number of word types in each language
+    exponent -- exponent of the Zipfian word frequency distribution
+    mean_length -- mean source sentence length (in tokens), lengths are
+                   log-normally distributed
+    length_sigma -- standard deviation of the logarithm of the length
+    max_length -- if given, the maximum source sentence length
+    null_rate -- probability of a source word not being translated, and
+                 (separately) of a target word being inserted
+    swap_rate -- probability of swapping each pair of adjacent target words
+    seed -- seed for the random number generator
+
+    Returns:
+    a tuple (source, target, links) of lists with one item per sentence.
+    Source and target sentences are lists of str tokens, and links are lists
+    of (source index, target index) pairs.
+    """
+    rng = np.random.default_rng(seed)
+    cdf = zipf_distribution(vocabulary_size, exponent)
+    translation = rng.permutation(vocabulary_size)
+
+    mu = np.log(mean_length) - 0.5*length_sigma**2
+    lengths = np.maximum(1, np.round(
+        rng.lognormal(mu, length_sigma, n_sentences))).astype(np.int64)
+    if max_length is not None:
+        lengths = np.minimum(lengths, max_length)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    n_tokens = int(offsets[-1])
+    tokens = np.minimum(
+        np.searchsorted(cdf, rng.random(n_tokens)), vocabulary_size-1)
+    dropped = rng.random(n_tokens) < null_rate
+    inserted = rng.random(n_tokens) < null_rate
+    insertions = np.minimum(
+        np.searchsorted(cdf, rng.random(n_tokens)), vocabulary_size-1)
+
+    source, target, links = [], [], []
+    for i in range(n_sentences):
+        start, end = offsets[i], offsets[i+1]
+        # target words as (source index or -1, word id) pairs
+        words = []
+        for j in range(end - start):
+            if not dropped[start+j]:
+                words.append((j, translation[tokens[start+j]]))
+            if inserted[start+j]:
+                words.append((-1, insertions[start+j]))
+        swaps = rng.random(max(0, len(words)-1)) < swap_rate
+        for k in np.flatnonzero(swaps):
+            words[k], words[k+1] = words[k+1], words[k]
+        source.append(['s%d' % x for x in tokens[start:end]])
+        target.append(['t%d' % x for _, x in words])
+        links.append([(j, k) for k, (j, _) in enumerate(words) if j >= 0])
+    return source, target, links
+
+
+def write_corpus(source, target, links, source_file, target_file,
+                 links_file=None):
+    """Write a corpus from generate_corpus() to files
+
+    The links are written in the same format as the output of eflomal.
+    """
+    for sent in source:
+        print(' '.join(sent), file=source_file)
+    for sent in target:
+        print(' '.join(sent), file=target_file)
+    if links_file is not None:
+        for sent_links in links:
+            print(' '.join('%d-%d' % link for link in sent_links),
+                  file=links_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic parallel corpus')
+    parser.add_argument(
+        '-n', '--sentences', dest='n_sentences', type=int, default=10000,
+        metavar='N', help='Number of sentence pairs')
+    parser.add_argument(
+        '--vocabulary', dest='vocabulary_size', type=int, default=10000,
+        metavar='N', help='Vocabulary size of each language')
+    parser.add_argument(
+        '--exponent', dest='exponent', type=float, default=1.0,
+        metavar='X', help='Exponent of the Zipfian distribution')
+    parser.add_argument(
+        '--mean-length', dest='mean_length', type=float, default=20.0,
+        metavar='X', help='Mean sentence length')
+    parser.add_argument(
+        '--length-sigma', dest='length_sigma', type=float, default=0.5,
+        metavar='X', help='Standard deviation of the log sentence length')
+    parser.add_argument(
+        '--max-length', dest='max_length', type=int, default=None,
+        metavar='N', help='Maximum sentence length')
+    parser.add_argument(
+        '--null-rate', dest='null_rate', type=float, default=0.1,
+        metavar='X', help='Rate of untranslated and inserted words')
+    parser.add_argument(
+        '--swap-rate', dest='swap_rate', type=float, default=0.1,
+        metavar='X', help='Rate of swapping adjacent target words')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, default=1,
+        metavar='N', help='Random seed')
+    parser.add_argument(
+        '-s', '--source', dest='source_filename', type=str, required=True,
+        metavar='filename', help='Source text output filename')
+    parser.add_argument(
+        '-t', '--target', dest='target_filename', type=str, required=True,
+        metavar='filename', help='Target text output filename')
+    parser.add_argument(
+        '-g', '--gold', dest='links_filename', type=str, default=None,
+        metavar='filename', help='Gold alignment output filename')
+    args = parser.parse_args()
+
+    source, target, links = generate_corpus(
+        args.n_sentences, vocabulary_size=args.vocabulary_size,
+        exponent=args.exponent, mean_length=args.mean_length,
+        length_sigma=args.length_sigma, max_length=args.max_length,
+        null_rate=args.null_rate, swap_rate=args.swap_rate, seed=args.seed)
+    with open(args.source_filename, 'w', encoding='utf-8') as srcf, \
+         open(args.target_filename, 'w', encoding='utf-8') as trgf:
+        if args.links_filename:
+            with open(args.links_filename, 'w', encoding='utf-8') as linksf:
+                write_corpus(source, target, links, srcf, trgf, linksf)
+        else:
+            write_corpus(source, target, links, srcf, trgf)
+
+
+if __name__ == '__main__': main()
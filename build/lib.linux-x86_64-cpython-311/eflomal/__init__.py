@@ -0,0 +1,1568 @@
+"""eflomal package"""
+
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
+import logging
+import lzma
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import sys
+from tempfile import NamedTemporaryFile, TemporaryDirectory, mkdtemp
+import threading
+import zlib
+
+import numpy as np
+
+from .cython import align, align_arrays, read_text, write_text, FlatText, \
+    write_binary_text, read_joint_text, plan_resources, NULL_LINK, \
+    SYMMETRIZATION_METHODS, TEXT_VERSION
+
+
+logger = logging.getLogger(__name__)
+
+# Number of lines per shard when preparing texts in parallel
+SHARD_SIZE = 100000
+
+# Number of iterations used by Aligner.infer() (and by align_stream() after
+# the first chunk), relative to training
+INFERENCE_REL_ITERATIONS = 0.1
+
+# Size of the blocks of compressed data read by open_input(), and the number
+# of decompressed blocks buffered
+DECOMPRESS_BLOCK_SIZE = 0x40000
+DECOMPRESS_BLOCKS = 8
+
+# Factor for the counts of earlier chunks in Aligner.align_stream()
+STREAM_DECAY = 0.9
+
+# Default size limit (in bytes) of a CorpusCache
+CACHE_SIZE = 0x100000000
+
+# Version of the entries of a CorpusCache, to be increased whenever the way
+# the corpora are prepared changes
+CACHE_VERSION = 2
+
+# Vocabulary section appended to model snapshots: magic, version, source
+# prefix/suffix length, target prefix/suffix length, number of bytes of the
+# source and target vocabularies. This is followed by the vocabularies
+# (newline-separated words, UTF-8) and the offset of the section (uint64).
+SNAPSHOT_VOCABULARY = struct.Struct('<4sIIIIIQQ')
+SNAPSHOT_VOCABULARY_MAGIC = b'EFLV'
+SNAPSHOT_VOCABULARY_VERSION = 1
+
+# Header of the binary priors format written by to_eflomal_priors_file():
+# magic, version, source and target vocabulary sizes (including NULL), number
+# of lexical priors, number of forward/reverse jump priors and forward/reverse
+# fertility priors.
+PRIORS_HEADER = struct.Struct('<4sIIIQIIII')
+PRIORS_MAGIC = b'EFLP'
+PRIORS_VERSION = 1
+
+# Header of the binary links format written by the eflomal binary with
+# --binary-links: magic, version and number of sentences. It is followed by
+# the (source, target) index pairs of all links as uint32, and by the offsets
+# of the links of each sentence into these as uint64 (one more than the
+# number of sentences).
+LINKS_HEADER = struct.Struct('<4sIQ')
+LINKS_MAGIC = b'EFLL'
+LINKS_VERSION = 1
+
+
+class Aligner:
+    """Aligner class"""
+
+    def __init__(self, model=3, score_model=0,
+                 n_iterations=None, n_samplers=3,
+                 rel_iterations=1.0, null_prior=0.2,
+                 source_prefix_len=0, source_suffix_len=0,
+                 target_prefix_len=0, target_suffix_len=0, n_jobs=1,
+                 n_threads=1, tolerance=0.0, seed=None, cache_dir=None,
+                 cache_size=CACHE_SIZE, max_memory=None, max_threads=None,
+                 dedup=False):
+        self.model = model
+        self.score_model = score_model
+        self.n_iterations = n_iterations
+        self.n_samplers = n_samplers
+        self.rel_iterations = rel_iterations
+        self.null_prior = null_prior
+        self.source_prefix_len = source_prefix_len
+        self.source_suffix_len = source_suffix_len
+        self.target_prefix_len = target_prefix_len
+        self.target_suffix_len = target_suffix_len
+        self.n_jobs = n_jobs
+        self.n_threads = n_threads
+        self.tolerance = tolerance
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.max_memory = max_memory
+        self.max_threads = max_threads
+        self.dedup = dedup
+
+    def prepare_files(self, src_input_file, src_output_file,
+                      trg_input_file, trg_output_file,
+                      priors_input_file, priors_output_file, binary=False,
+                      indices=None):
+        """Convert text files to formats used by eflomal
+
+        Inputs should be file objects or any iterables over lines. Outputs
+        should be file objects, opened in binary mode. If `binary` is True,
+        the texts and priors are written in the binary formats which the
+        eflomal binary can memory-map instead of parsing (in which case
+        `priors_output_file` should also be opened in binary mode).
+
+        If `trg_input_file` is None, `src_input_file` should be a fast_align
+        style joint file (with ||| between the source and target sentences),
+        which is read in a single pass.
+
+        If the `n_jobs` attribute is larger than 1, the source and target
+        texts are read concurrently in shards by a pool of that many
+        processes. The output is identical to that of the serial version.
+
+        If `indices` is given, it should be a pair of TextIndex objects (as
+        returned by read_snapshot_vocabulary()) whose words keep their
+        indexes, with new words added after them. Their prefix and suffix
+        lengths are used instead of those of the Aligner.
+
+        Unless `indices` is given, the words are numbered in order of
+        decreasing frequency (see sort_vocabulary()).
+
+        Returns the source and target TextIndex objects.
+
+        """
+        if indices is not None:
+            src_prefix_len, src_suffix_len, src_voc = \
+                indices[0].prefix_len, indices[0].suffix_len, indices[0].index
+            trg_prefix_len, trg_suffix_len, trg_voc = \
+                indices[1].prefix_len, indices[1].suffix_len, indices[1].index
+        else:
+            src_prefix_len, src_suffix_len, src_voc = \
+                self.source_prefix_len, self.source_suffix_len, None
+            trg_prefix_len, trg_suffix_len, trg_voc = \
+                self.target_prefix_len, self.target_suffix_len, None
+            if trg_input_file is None and self.n_jobs > 1:
+                src_input_file, trg_input_file = split_joint_file(
+                    src_input_file)
+        if trg_input_file is None:
+            (src_sents, src_voc), (trg_sents, trg_voc) = read_joint_text(
+                src_input_file, True, src_prefix_len, src_suffix_len,
+                trg_prefix_len, trg_suffix_len, src_voc, trg_voc)
+        elif indices is None and self.n_jobs > 1:
+            (src_sents, src_voc), (trg_sents, trg_voc) = read_texts_parallel(
+                [(src_input_file, src_prefix_len, src_suffix_len),
+                 (trg_input_file, trg_prefix_len, trg_suffix_len)],
+                self.n_jobs)
+        else:
+            src_sents, src_voc = read_text(
+                src_input_file, True, src_prefix_len, src_suffix_len, src_voc)
+            trg_sents, trg_voc = read_text(
+                trg_input_file, True, trg_prefix_len, trg_suffix_len, trg_voc)
+        if indices is None:
+            src_sents, src_voc = sort_vocabulary(src_sents, src_voc)
+            trg_sents, trg_voc = sort_vocabulary(trg_sents, trg_voc)
+        src_index, n_src_sents, src_voc_size = write_eflomal_text(
+            src_sents, src_voc, src_output_file,
+            src_prefix_len, src_suffix_len, binary)
+        trg_index, n_trg_sents, trg_voc_size = write_eflomal_text(
+            trg_sents, trg_voc, trg_output_file,
+            trg_prefix_len, trg_suffix_len, binary)
+        if n_src_sents != n_trg_sents:
+            logger.error(
+                'number of sentences differ in input files (%d vs %d)',
+                n_src_sents, n_trg_sents)
+            raise ValueError('Mismatched file sizes')
+        logger.info('Prepared %d sentences for alignment', n_src_sents)
+        if priors_input_file:
+            logger.info('Reading lexical priors...')
+            priors = read_priors(priors_input_file)
+            to_eflomal_priors_file(
+                priors, src_index, trg_index, priors_output_file, binary)
+        return src_index, trg_index
+
+    def align(self, src_input, trg_input,
+              links_filename_fwd=None, links_filename_rev=None,
+              scores_filename_fwd=None, scores_filename_rev=None,
+              priors_input=None, quiet=True, use_gdb=False,
+              snapshot_filename=None, links_filename_sym=None,
+              symmetrization='grow-diag-final-and', progress=None,
+              query_src_input=None, query_trg_input=None,
+              binary_links=False):
+        """Run alignment for the input
+
+        The input is given as for prepare_files(), so if `trg_input` is None,
+        `src_input` is a joint file with both sides.
+
+        If `query_src_input` is given (with `query_trg_input`, or None for a
+        joint file), the input is only used to train the model, and the
+        query sentences are aligned using it. Only the links and scores of
+        the query sentences are written, and the input sentences are only
+        sampled as needed for training. The input can then be a large
+        corpus, which is best kept in a CorpusCache (see below) when aligning
+        several query sets against it.
+
+        If `binary_links` is True, the links are written in the binary
+        format (see read_binary_links()) rather than as text.
+
+        If `snapshot_filename` is given, a snapshot of the trained model
+        (including the vocabulary) is written there, which can be used with
+        infer() to align new data.
+
+        If `links_filename_sym` is given, the links of both directions are
+        symmetrized by the eflomal binary (using one of
+        SYMMETRIZATION_METHODS) and written there.
+
+        If `progress` is given, it is called with each telemetry record of
+        the eflomal binary (a dict, e.g. with the time and number of changed
+        links of an iteration) as soon as it is written.
+
+        If the `cache_dir` attribute is set, the prepared texts are taken
+        from (or added to) a CorpusCache in that directory, limited to
+        `cache_size` bytes, so that repeated runs on the same input skip
+        preparing it.
+
+        If the `max_memory` (in bytes) or `max_threads` attributes are set,
+        the eflomal binary estimates its memory use from the sizes of the
+        texts, and reduces the number of samplers and threads or aligns the
+        directions one after the other to fit within them (see
+        plan_resources()). MemoryError is raised if that is not enough.
+
+        If the `dedup` attribute is True, identical sentence pairs of the
+        input are aligned once by the eflomal binary, with their statistics
+        weighted by the number of copies. The links and scores are still
+        written for every line. This saves time on corpora with many
+        repeated pairs, such as subtitles or web crawls.
+
+        """
+        with NamedTemporaryFile('wb') as srcf, \
+             NamedTemporaryFile('wb') as trgf, \
+             NamedTemporaryFile('wb') as priorsf, \
+             NamedTemporaryFile('wb') as query_srcf, \
+             NamedTemporaryFile('wb') as query_trgf:
+            # Write input files for the eflomal binary
+            if self.cache_dir is None:
+                src_index, trg_index = self.prepare_files(
+                    src_input, srcf, trg_input, trgf, None, None,
+                    binary=True)
+                src_filename, trg_filename = srcf.name, trgf.name
+            else:
+                cache = CorpusCache(self.cache_dir, self.cache_size)
+                src_filename, trg_filename, (src_index, trg_index) = \
+                    cache.prepare(self, src_input, trg_input)
+            if query_src_input is not None:
+                # new words of the queries are numbered after the others
+                src_index, trg_index = self.prepare_files(
+                    query_src_input, query_srcf, query_trg_input,
+                    query_trgf, None, None, binary=True,
+                    indices=(src_index, trg_index))
+            # the priors are written last, since the eflomal binary expects
+            # them to cover the vocabularies including the queries
+            if priors_input is not None:
+                logger.info('Reading lexical priors...')
+                to_eflomal_priors_file(
+                    read_priors(priors_input), src_index, trg_index,
+                    priorsf, True)
+            # Run wrapper for the eflomal binary
+            align(src_filename, trg_filename,
+                  links_filename_fwd=links_filename_fwd,
+                  links_filename_rev=links_filename_rev,
+                  statistics_filename=None,
+                  scores_filename_fwd=scores_filename_fwd,
+                  scores_filename_rev=scores_filename_rev,
+                  priors_filename=(None if priors_input is None
+                                   else priorsf.name),
+                  model=self.model,
+                  score_model=self.score_model,
+                  n_iterations=self.n_iterations,
+                  n_samplers=self.n_samplers,
+                  n_threads=self.n_threads,
+                  quiet=quiet,
+                  rel_iterations=self.rel_iterations,
+                  null_prior=self.null_prior,
+                  use_gdb=use_gdb,
+                  tolerance=self.tolerance, seed=self.seed,
+                  max_memory=self.max_memory or 0,
+                  max_threads=self.max_threads or 0,
+                  snapshot_output_filename=snapshot_filename,
+                  links_filename_sym=links_filename_sym,
+                  symmetrization=symmetrization,
+                  progress=progress,
+                  query_source_filename=(None if query_src_input is None
+                                         else query_srcf.name),
+                  query_target_filename=(None if query_src_input is None
+                                         else query_trgf.name),
+                  binary_links=binary_links,
+                  dedup=self.dedup)
+        if snapshot_filename is not None:
+            write_snapshot_vocabulary(snapshot_filename, src_index, trg_index)
+
+    def infer(self, snapshot_filename, src_input, trg_input,
+              links_filename_fwd=None, links_filename_rev=None,
+              scores_filename_fwd=None, scores_filename_rev=None,
+              quiet=True, use_gdb=False, links_filename_sym=None,
+              symmetrization='grow-diag-final-and', progress=None,
+              binary_links=False):
+        """Align the input using a model snapshot written by align()
+
+        Sampling starts from the statistics of the snapshot, so only a few
+        iterations are needed: unless the `n_iterations` attribute is set,
+        INFERENCE_REL_ITERATIONS times the usual number is used. The
+        vocabulary and stemming settings are those of the snapshot.
+        The input, symmetrized links, progress and `binary_links` are handled
+        as in align().
+
+        """
+        indices = read_snapshot_vocabulary(snapshot_filename)
+        with NamedTemporaryFile('wb') as srcf, \
+             NamedTemporaryFile('wb') as trgf:
+            self.prepare_files(
+                src_input, srcf, trg_input, trgf, None, None, binary=True,
+                indices=indices)
+            align(srcf.name, trgf.name,
+                  links_filename_fwd=links_filename_fwd,
+                  links_filename_rev=links_filename_rev,
+                  scores_filename_fwd=scores_filename_fwd,
+                  scores_filename_rev=scores_filename_rev,
+                  model=self.model,
+                  score_model=self.score_model,
+                  n_iterations=self.n_iterations,
+                  n_samplers=self.n_samplers,
+                  n_threads=self.n_threads,
+                  quiet=quiet,
+                  rel_iterations=(
+                      self.rel_iterations*INFERENCE_REL_ITERATIONS),
+                  null_prior=self.null_prior,
+                  use_gdb=use_gdb,
+                  tolerance=self.tolerance, seed=self.seed,
+                  max_memory=self.max_memory or 0,
+                  max_threads=self.max_threads or 0,
+                  snapshot_input_filename=snapshot_filename,
+                  links_filename_sym=links_filename_sym,
+                  symmetrization=symmetrization,
+                  progress=progress,
+                  binary_links=binary_links,
+                  dedup=self.dedup)
+
+    def align_multi(self, src_input, trg_inputs,
+                    links_filenames_fwd=None, links_filenames_rev=None,
+                    scores_filenames_fwd=None, scores_filenames_rev=None,
+                    links_filenames_sym=None,
+                    symmetrization='grow-diag-final-and', n_workers=1,
+                    quiet=True, progress=None, binary_links=False):
+        """Align one source text with each of several target texts
+
+        `trg_inputs` is a sequence of target inputs, each with as many lines
+        as `src_input`. A target given as a filename is opened (with
+        open_input()) by the worker that aligns it, so that at most
+        `n_workers` targets are open (and being decompressed) at a time.
+        Targets can also be file objects or any iterables over lines. The
+        output arguments are sequences with one filename (or None) for each
+        target, and are otherwise handled as in align().
+
+        The source text is only read and prepared once. All runs of the
+        eflomal binary memory-map the same prepared file, so its pages are
+        shared between them. The pairs are aligned by a pool of `n_workers`
+        threads, each of which prepares a target text and runs the eflomal
+        binary for it. The `max_memory` and `max_threads` attributes apply
+        to each run of the binary.
+
+        If `progress` is given, it is called with the index of the target
+        and each telemetry record. The calls can come from several threads.
+
+        """
+        n_targets = len(trg_inputs)
+
+        def per_target(filenames):
+            if filenames is None:
+                return [None] * n_targets
+            if len(filenames) != n_targets:
+                raise ValueError('expected one output filename per target')
+            return list(filenames)
+
+        outputs = list(zip(*map(per_target, (
+            links_filenames_fwd, links_filenames_rev, scores_filenames_fwd,
+            scores_filenames_rev, links_filenames_sym))))
+
+        with NamedTemporaryFile('wb') as srcf:
+            if self.n_jobs > 1:
+                [(src_sents, src_voc)] = read_texts_parallel(
+                    [(src_input, self.source_prefix_len,
+                      self.source_suffix_len)], self.n_jobs)
+            else:
+                src_sents, src_voc = read_text(
+                    src_input, True, self.source_prefix_len,
+                    self.source_suffix_len)
+            src_sents, src_voc = sort_vocabulary(src_sents, src_voc)
+            _, n_src_sents, _ = write_eflomal_text(
+                src_sents, src_voc, srcf, self.source_prefix_len,
+                self.source_suffix_len, True)
+            # only the prepared file is needed from now on
+            del src_sents, src_voc
+            logger.info('Prepared %d source sentences for %d targets',
+                        n_src_sents, n_targets)
+
+            def align_target(k):
+                links_fwd, links_rev, scores_fwd, scores_rev, links_sym = \
+                    outputs[k]
+                with NamedTemporaryFile('wb') as trgf:
+                    # the target is only open while it is prepared
+                    with contextlib.ExitStack() as stack:
+                        trg_input = trg_inputs[k]
+                        if isinstance(trg_input, str):
+                            trg_input = stack.enter_context(
+                                open_input(trg_input))
+                        _, n_trg_sents, _ = to_eflomal_text_file(
+                            trg_input, trgf, self.target_prefix_len,
+                            self.target_suffix_len, binary=True)
+                    if n_src_sents != n_trg_sents:
+                        logger.error(
+                            'number of sentences differ in source and '
+                            'target %d (%d vs %d)',
+                            k, n_src_sents, n_trg_sents)
+                        raise ValueError('Mismatched file sizes')
+                    align(srcf.name, trgf.name,
+                          links_filename_fwd=links_fwd,
+                          links_filename_rev=links_rev,
+                          scores_filename_fwd=scores_fwd,
+                          scores_filename_rev=scores_rev,
+                          model=self.model,
+                          score_model=self.score_model,
+                          n_iterations=self.n_iterations,
+                          n_samplers=self.n_samplers,
+                          n_threads=self.n_threads,
+                          quiet=quiet,
+                          rel_iterations=self.rel_iterations,
+                          null_prior=self.null_prior,
+                          tolerance=self.tolerance, seed=self.seed,
+                          max_memory=self.max_memory or 0,
+                          max_threads=self.max_threads or 0,
+                          links_filename_sym=links_sym,
+                          symmetrization=symmetrization,
+                          progress=(None if progress is None
+                                    else functools.partial(progress, k)),
+                          binary_links=binary_links,
+                          dedup=self.dedup)
+
+            with ThreadPoolExecutor(max(1, n_workers)) as pool:
+                for future in [pool.submit(align_target, k)
+                               for k in range(n_targets)]:
+                    future.result()
+
+    def align_stream(self, src_input, trg_input, chunk_size,
+                     links_filename_fwd=None, links_filename_rev=None,
+                     scores_filename_fwd=None, scores_filename_rev=None,
+                     quiet=True, links_filename_sym=None,
+                     symmetrization='grow-diag-final-and',
+                     decay=STREAM_DECAY, snapshot_input_filename=None,
+                     snapshot_filename=None, progress=None):
+        """Align the input in chunks of `chunk_size` sentence pairs
+
+        Only one chunk at a time is read and aligned, so memory use depends
+        on the chunk size and the vocabulary rather than on the length of
+        the input, which may be any iterable over lines (such as an endless
+        stream), or a joint file if `trg_input` is None. The lexical, jump
+        and fertility counts are carried over from one chunk to the next
+        through model snapshots, with the counts of earlier chunks
+        multiplied by `decay` (1 keeps all of them). The links and scores
+        of each chunk are appended to the output files as soon as the chunk
+        is aligned. Since the chunks after the first start
+        from the model of the previous chunk, they are aligned with the same
+        (smaller) number of iterations as in infer().
+
+        If `snapshot_input_filename` is given, the first chunk is aligned
+        starting from this model snapshot (written by align()), and if
+        `snapshot_filename` is given, the model of the final chunk is
+        written there. Symmetrized links and progress are handled as in
+        align().
+
+        """
+        output_filenames = [
+            filename for filename in (
+                links_filename_fwd, links_filename_rev, links_filename_sym,
+                scores_filename_fwd, scores_filename_rev)
+            if filename is not None]
+        src_input = iter(src_input)
+        trg_input = None if trg_input is None else iter(trg_input)
+        indices = None if snapshot_input_filename is None \
+                else read_snapshot_vocabulary(snapshot_input_filename)
+        snapshot_input = snapshot_input_filename
+        with TemporaryDirectory() as tmpdir, contextlib.ExitStack() as stack:
+            outputs = [stack.enter_context(open(filename, 'wb'))
+                       for filename in output_filenames]
+            # the outputs of each chunk are written here by the binary
+            chunk_filename = {
+                filename: os.path.join(tmpdir, 'output%d' % i)
+                for i, filename in enumerate(output_filenames)}.get
+            for i in itertools.count():
+                src_lines = list(itertools.islice(src_input, chunk_size))
+                trg_lines = None if trg_input is None \
+                        else list(itertools.islice(trg_input, chunk_size))
+                if not (src_lines or trg_lines):
+                    break
+                snapshot_output = os.path.join(tmpdir, 'model%d' % (i % 2))
+                rel_iterations = self.rel_iterations
+                if snapshot_input is not None:
+                    rel_iterations *= INFERENCE_REL_ITERATIONS
+                with NamedTemporaryFile('wb') as srcf, \
+                     NamedTemporaryFile('wb') as trgf:
+                    indices = self.prepare_files(
+                        src_lines, srcf, trg_lines, trgf, None, None,
+                        binary=True, indices=indices)
+                    align(srcf.name, trgf.name,
+                          links_filename_fwd=chunk_filename(
+                              links_filename_fwd),
+                          links_filename_rev=chunk_filename(
+                              links_filename_rev),
+                          scores_filename_fwd=chunk_filename(
+                              scores_filename_fwd),
+                          scores_filename_rev=chunk_filename(
+                              scores_filename_rev),
+                          model=self.model,
+                          score_model=self.score_model,
+                          n_iterations=self.n_iterations,
+                          n_samplers=self.n_samplers,
+                          n_threads=self.n_threads,
+                          quiet=quiet,
+                          rel_iterations=rel_iterations,
+                          null_prior=self.null_prior,
+                          tolerance=self.tolerance, seed=self.seed,
+                          max_memory=self.max_memory or 0,
+                          max_threads=self.max_threads or 0,
+                          snapshot_input_filename=snapshot_input,
+                          snapshot_output_filename=snapshot_output,
+                          decay=decay, dedup=self.dedup,
+                          links_filename_sym=chunk_filename(
+                              links_filename_sym),
+                          symmetrization=symmetrization,
+                          progress=progress)
+                write_snapshot_vocabulary(snapshot_output, *indices)
+                snapshot_input = snapshot_output
+                for filename, outf in zip(output_filenames, outputs):
+                    with open(chunk_filename(filename), 'rb') as f:
+                        shutil.copyfileobj(f, outf)
+                    outf.flush()
+                logger.info('Aligned chunk %d (%d sentences)',
+                            i, len(src_lines))
+            if snapshot_filename is not None and \
+                    snapshot_input != snapshot_input_filename:
+                shutil.copyfile(snapshot_input, snapshot_filename)
+
+    def align_arrays(self, src_sents, trg_sents, scores=False, quiet=True):
+        """Run alignment in-process on encoded sentences
+
+        The sentences should be sequences of np.ndarray(uint32) as returned
+        by read_text(). No temporary files are written and the eflomal
+        binary is not used.
+
+        Returns a tuple (links_fwd, links_rev, scores_fwd, scores_rev), see
+        eflomal.cython.align_arrays() for details. The scores are None unless
+        `scores` is True.
+
+        """
+        if scores:
+            score_model = self.score_model or self.model
+        else:
+            score_model = 0
+        return align_arrays(
+            src_sents, trg_sents,
+            model=self.model,
+            score_model=score_model,
+            n_iterations=self.n_iterations,
+            n_samplers=self.n_samplers,
+            n_threads=self.n_threads,
+            quiet=quiet,
+            rel_iterations=self.rel_iterations,
+            null_prior=self.null_prior,
+            tolerance=self.tolerance, seed=self.seed,
+            max_memory=self.max_memory or 0,
+            max_threads=self.max_threads or 0)
+
+
+class TextIndex:
+    """Word to index mapping with lowercasing and prefix/suffix removal"""
+
+    def __init__(self, index, prefix_len=0, suffix_len=0):
+        self.index = index
+        self.prefix_len = prefix_len
+        self.suffix_len = suffix_len
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, word):
+        word = word.lower()
+        if self.prefix_len != 0:
+            word = word[:self.prefix_len]
+        if self.suffix_len != 0:
+            word = word[-self.suffix_len:]
+        e = self.index.get(word)
+        if e is not None:
+            e = e + 1
+        return e
+
+
+def to_eflomal_text_file(sentencefile, outfile, prefix_len=0, suffix_len=0,
+                         binary=False, index=None):
+    """Write sentences to a file read by eflomal binary
+
+    Arguments:
+
+    sentencefile - input text file object
+    outfile - output file object
+    prefix_len - prefix length to remove
+    suffix_len - suffix length to remove
+    binary - if True, use the (memory-mappable) binary format
+    index - if given, word to index dict to extend (see read_text()),
+            otherwise the words are numbered by frequency
+
+    Returns TextIndex object.
+
+    """
+    sort = index is None
+    sents, index = read_text(
+        sentencefile, True, prefix_len, suffix_len, index)
+    if sort:
+        sents, index = sort_vocabulary(sents, index)
+    return write_eflomal_text(
+        sents, index, outfile, prefix_len, suffix_len, binary)
+
+
+def sort_vocabulary(sents, index):
+    """Renumber the words of sentences from read_text() by frequency
+
+    The most frequent word gets index 0, and so on. The eflomal binary keeps
+    the counts of the first (and thus most frequent) words of the vocabulary
+    in dense arrays, which is faster than the hash tables used for the rest.
+
+    Returns a tuple of a FlatText and the new word to index dict.
+
+    """
+    text = FlatText.from_sentences(sents)
+    n_words = np.bincount(text.tokens, minlength=len(index))
+    order = np.argsort(-n_words, kind='stable')
+    new_ids = np.empty(len(order), dtype=np.uint32)
+    new_ids[order] = np.arange(len(order), dtype=np.uint32)
+    words = [None] * len(index)
+    for word, i in index.items():
+        words[i] = word
+    return (FlatText(new_ids[text.tokens], text.offsets),
+            {words[i]: k for k, i in enumerate(order)})
+
+
+def write_eflomal_text(sents, index, outfile, prefix_len=0, suffix_len=0,
+                       binary=False):
+    """Write sentences from read_text() to a file read by eflomal binary
+
+    Returns a tuple (TextIndex, number of sentences, vocabulary size).
+
+    """
+    n_sents = len(sents)
+    voc_size = len(index)
+    if binary:
+        write_binary_text(outfile, sents, voc_size)
+    else:
+        write_text(outfile, sents, voc_size)
+    return TextIndex(index, prefix_len, suffix_len), n_sents, voc_size
+
+
+def write_binary_priors(outfile, src_voc_size, trg_voc_size, priors_indexed,
+                        hmmf_priors, hmmr_priors, ferf_indexed, ferr_indexed):
+    """Write indexed priors in the binary format read by eflomal binary
+
+    The vocabulary sizes include NULL. See to_eflomal_priors_file() for the
+    other arguments.
+
+    """
+    n_lex = len(priors_indexed)
+    lex = np.array(list(priors_indexed.keys()), dtype=np.uint32).reshape(-1, 2)
+    alphas = np.fromiter(priors_indexed.values(), dtype=np.float32,
+                         count=n_lex)
+    outfile.write(PRIORS_HEADER.pack(
+        PRIORS_MAGIC, PRIORS_VERSION, src_voc_size, trg_voc_size, n_lex,
+        len(hmmf_priors), len(hmmr_priors),
+        len(ferf_indexed), len(ferr_indexed)))
+    # lexical priors, sorted by source token (forward) or target token
+    # (reverse) and then by the other token
+    for e, f, voc_size in ((lex[:, 0], lex[:, 1], src_voc_size),
+                           (lex[:, 1], lex[:, 0], trg_voc_size)):
+        order = np.lexsort((f, e))
+        offsets = np.zeros(voc_size+1, dtype=np.uint64)
+        np.cumsum(np.bincount(e, minlength=voc_size), out=offsets[1:])
+        outfile.write(offsets.astype('<u8').tobytes())
+        outfile.write(f[order].astype('<u4').tobytes())
+        outfile.write(alphas[order].astype('<f4').tobytes())
+    jump_dtype = np.dtype([('jump', '<i4'), ('alpha', '<f4')])
+    for jump_priors in (hmmf_priors, hmmr_priors):
+        outfile.write(np.array(sorted(jump_priors.items()),
+                               dtype=jump_dtype).tobytes())
+    fert_dtype = np.dtype([('e', '<u4'), ('fert', '<u4'), ('alpha', '<f4')])
+    for fert_priors in (ferf_indexed, ferr_indexed):
+        outfile.write(np.array(
+            [(e, fert, alpha) for (e, fert), alpha in
+             sorted(fert_priors.items())], dtype=fert_dtype).tobytes())
+    outfile.flush()
+
+
+def write_snapshot_vocabulary(filename, src_index, trg_index):
+    """Append the vocabularies to a model snapshot written by eflomal
+
+    Arguments:
+
+    filename - snapshot file, written by the eflomal binary
+    src_index - source TextIndex object
+    trg_index - target TextIndex object
+
+    """
+    src_data = '\n'.join(src_index.index).encode('utf-8')
+    trg_data = '\n'.join(trg_index.index).encode('utf-8')
+    with open(filename, 'ab') as f:
+        offset = f.tell()
+        f.write(SNAPSHOT_VOCABULARY.pack(
+            SNAPSHOT_VOCABULARY_MAGIC, SNAPSHOT_VOCABULARY_VERSION,
+            src_index.prefix_len, src_index.suffix_len,
+            trg_index.prefix_len, trg_index.suffix_len,
+            len(src_data), len(trg_data)))
+        f.write(src_data)
+        f.write(trg_data)
+        f.write(struct.pack('<Q', offset))
+
+
+def read_snapshot_vocabulary(filename):
+    """Read the vocabularies appended to a model snapshot
+
+    Returns a tuple of source and target TextIndex objects.
+
+    """
+    with open(filename, 'rb') as f:
+        f.seek(-8, 2)
+        offset, = struct.unpack('<Q', f.read(8))
+        f.seek(offset)
+        (magic, version, src_prefix_len, src_suffix_len,
+         trg_prefix_len, trg_suffix_len, src_size, trg_size) = \
+            SNAPSHOT_VOCABULARY.unpack(f.read(SNAPSHOT_VOCABULARY.size))
+        if magic != SNAPSHOT_VOCABULARY_MAGIC or \
+                version != SNAPSHOT_VOCABULARY_VERSION:
+            raise ValueError('no vocabulary found in snapshot %s' % filename)
+        src_data = f.read(src_size).decode('utf-8')
+        trg_data = f.read(trg_size).decode('utf-8')
+
+    def make_index(data, prefix_len, suffix_len):
+        words = data.split('\n') if data else []
+        return TextIndex({word: i for i, word in enumerate(words)},
+                         prefix_len, suffix_len)
+
+    return (make_index(src_data, src_prefix_len, src_suffix_len),
+            make_index(trg_data, trg_prefix_len, trg_suffix_len))
+
+
+def input_digest(lines):
+    """Hash the content of an input text for CorpusCache
+
+    Returns a tuple of the digest and an iterable over the lines of the
+    input. Files on disk are hashed without reading them through `lines`,
+    which is returned unchanged, while other inputs are read into a list.
+
+    """
+    h = hashlib.sha256()
+    name = getattr(lines, 'name', None)
+    if isinstance(name, str) and os.path.isfile(name):
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(DECOMPRESS_BLOCK_SIZE), b''):
+                h.update(block)
+        return h.digest(), lines
+    lines = list(lines)
+    for line in lines:
+        h.update(line.encode('utf-8'))
+        if not line.endswith('\n'):
+            h.update(b'\n')
+    return h.digest(), lines
+
+
+class CorpusCache:
+    """On-disk cache of texts prepared for the eflomal binary
+
+    Each entry is a directory named by a hash of the input texts and the
+    stemming settings, containing the source and target texts in the binary
+    format and their vocabularies (in the format appended to snapshots).
+    When the entries take up more than `max_size` bytes, the least recently
+    used ones are removed. Entries are written to a temporary directory and
+    then renamed, so a cache directory can be shared between processes.
+
+    """
+
+    def __init__(self, directory, max_size=CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def prepare(self, aligner, src_input, trg_input):
+        """Prepare the input (given as for Aligner.prepare_files()) unless
+        it is already in the cache
+
+        Returns a tuple of the source and target text filenames, and the
+        pair of TextIndex objects.
+
+        """
+        settings = (CACHE_VERSION, TEXT_VERSION, trg_input is None,
+                    aligner.source_prefix_len, aligner.source_suffix_len,
+                    aligner.target_prefix_len, aligner.target_suffix_len)
+        h = hashlib.sha256(repr(settings).encode('ascii'))
+        src_digest, src_input = input_digest(src_input)
+        h.update(src_digest)
+        if trg_input is not None:
+            trg_digest, trg_input = input_digest(trg_input)
+            h.update(trg_digest)
+        path = os.path.join(self.directory, h.hexdigest())
+        src_filename = os.path.join(path, 'source.eflt')
+        trg_filename = os.path.join(path, 'target.eflt')
+        try:
+            indices = read_snapshot_vocabulary(
+                os.path.join(path, 'vocabulary'))
+            os.utime(path)
+            logger.info('Using prepared texts from %s', path)
+            return src_filename, trg_filename, indices
+        except FileNotFoundError:
+            pass
+
+        tmp_path = mkdtemp(prefix='.', dir=self.directory)
+        try:
+            with open(os.path.join(tmp_path, 'source.eflt'), 'wb') as srcf, \
+                 open(os.path.join(tmp_path, 'target.eflt'), 'wb') as trgf:
+                indices = aligner.prepare_files(
+                    src_input, srcf, trg_input, trgf, None, None,
+                    binary=True)
+            write_snapshot_vocabulary(
+                os.path.join(tmp_path, 'vocabulary'), *indices)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # another process added the same entry in the meantime
+                shutil.rmtree(tmp_path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        logger.info('Added prepared texts to %s', path)
+        self.evict(keep=path)
+        return src_filename, trg_filename, indices
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries (except `keep`) until the
+        cache is within its size limit"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            # skip entries being written
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except FileNotFoundError:
+                # removed by another process
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path != keep:
+                logger.info('Removing %s from the cache', path)
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+def read_text_shard(lines, prefix_len, suffix_len):
+    """Index a shard of lines, for use in a worker process
+
+    Returns the token and offset buffers, and the vocabulary of the shard
+    ordered by local index.
+    """
+    sents, index = read_text(lines, True, prefix_len, suffix_len)
+    return sents.tokens, sents.offsets, list(index)
+
+
+def merge_text_shards(shards):
+    """Merge the output of read_text_shard() into one text
+
+    Since words are added to the global index in the order of the shards,
+    and in the order of their local indexes within each shard, the result is
+    identical to what read_text() returns for the whole text.
+
+    Returns a tuple (FlatText sents, dict index).
+    """
+    index = {}
+    tokens = []
+    offsets = [np.zeros(1, dtype=np.uint64)]
+    n_tokens = 0
+    for shard_tokens, shard_offsets, vocabulary in shards:
+        mapping = np.array(
+            [index.setdefault(word, len(index)) for word in vocabulary],
+            dtype=np.uint32)
+        tokens.append(mapping[shard_tokens])
+        offsets.append(shard_offsets[1:] + np.uint64(n_tokens))
+        n_tokens += len(shard_tokens)
+    return FlatText(np.concatenate(tokens + [np.empty(0, np.uint32)]),
+                    np.concatenate(offsets)), index
+
+
+def read_texts_parallel(inputs, n_jobs, shard_size=SHARD_SIZE):
+    """Read several texts concurrently using a pool of processes
+
+    Each text is split into shards of `shard_size` lines, and the shards of
+    all texts are indexed by the worker processes in round-robin order.
+
+    Arguments:
+
+    inputs - sequence of (lines, prefix_len, suffix_len) tuples, where lines
+             is a file object or any iterable over lines
+    n_jobs - number of worker processes
+    shard_size - number of lines per shard
+
+    Returns a list of (FlatText sents, dict index) tuples, as returned by
+    read_text() for each input.
+
+    """
+    def shards(k, lines):
+        lines = iter(lines)
+        while True:
+            shard = list(itertools.islice(lines, shard_size))
+            if not shard:
+                return
+            yield k, shard
+
+    results = [[] for _ in inputs]
+    with ProcessPoolExecutor(n_jobs) as pool:
+        # limit the number of shards in memory that are waiting for a worker
+        pending = deque()
+        for item in itertools.chain.from_iterable(
+                itertools.zip_longest(
+                    *[shards(k, lines)
+                      for k, (lines, _, _) in enumerate(inputs)])):
+            if item is None:
+                continue
+            k, shard = item
+            _, prefix_len, suffix_len = inputs[k]
+            future = pool.submit(
+                read_text_shard, shard, prefix_len, suffix_len)
+            results[k].append(future)
+            pending.append(future)
+            while len(pending) > 2*n_jobs:
+                pending.popleft().result()
+        return [merge_text_shards(future.result() for future in futures)
+                for futures in results]
+
+
+def sentences_from_joint_file(joint_file, index=None):
+    """Yield sentences from joint sentences file"""
+    for i, line in enumerate(joint_file):
+        fields = line.strip().split(' ||| ')
+        if len(fields) != 2:
+            logger.error('line %d does not contain a single |||'
+                         ' separator, or sentence(s) are empty!',
+                         i + 1)
+            raise ValueError('Invalid joint input line %s' % line)
+        if index is None:
+            yield fields[0], fields[1]
+        else:
+            yield fields[index]
+
+
+def split_joint_file(joint_file):
+    """Return iterators over the source and target side of a joint file
+
+    The file is read and split once. The iterators should be consumed
+    in step with each other (e.g. by zip(), or in shards of a fixed size in
+    turn), since lines read by one but not yet by the other are buffered.
+    """
+    src, trg = itertools.tee(sentences_from_joint_file(joint_file))
+    return (pair[0] for pair in src), (pair[1] for pair in trg)
+
+
+class BackgroundReader(io.RawIOBase):
+    """Binary file object with data produced in a background thread
+
+    The data is taken from an iterable over blocks of bytes (such as
+    decompress_blocks()), which are read ahead into a bounded queue so that
+    e.g. decompression overlaps with the processing of the data.
+    """
+
+    def __init__(self, blocks, n_blocks=DECOMPRESS_BLOCKS):
+        super().__init__()
+        self.blocks = blocks
+        self.queue = queue.Queue(n_blocks)
+        self.block = memoryview(b'')
+        self.eof = False
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            for block in self.blocks:
+                if block and not self._put(block):
+                    return
+            self._put(b'')
+        except Exception as e:
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if not self.block and not self.eof:
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                self.eof = True
+                raise item
+            self.eof = not item
+            self.block = memoryview(item)
+        n = min(len(buf), len(self.block))
+        buf[:n] = self.block[:n]
+        self.block = self.block[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stop.set()
+            self.thread.join()
+        super().close()
+
+
+def decompress_blocks(filename, make_decompressor,
+                      block_size=DECOMPRESS_BLOCK_SIZE):
+    """Yield the decompressed data of a file in blocks
+
+    The decompressor objects returned by make_decompressor() should work like
+    those of zlib and lzma. These decompress a whole block of compressed data
+    at a time, without holding the GIL. Files consisting of several
+    concatenated streams are supported.
+    """
+    with open(filename, 'rb') as f:
+        decompressor = make_decompressor()
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            while data:
+                yield decompressor.decompress(data)
+                if not decompressor.eof:
+                    break
+                data = decompressor.unused_data
+                decompressor = make_decompressor()
+
+
+def zstd_blocks(filename, block_size=DECOMPRESS_BLOCK_SIZE):
+    """Yield the decompressed data of a Zstandard-compressed file in blocks
+
+    The zstandard module is used if available, otherwise the zstd program
+    (which then decompresses in a separate process).
+    """
+    try:
+        import zstandard
+    except ImportError:
+        if shutil.which('zstd') is None:
+            raise ImportError(
+                'reading %s requires the zstandard module or the zstd '
+                'program' % filename)
+        with subprocess.Popen(['zstd', '-dcq', filename],
+                              stdout=subprocess.PIPE) as process:
+            yield from iter(lambda: process.stdout.read(block_size), b'')
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, 'zstd')
+        return
+    with open(filename, 'rb') as f, \
+         zstandard.ZstdDecompressor().stream_reader(
+             f, read_across_frames=True) as reader:
+        yield from iter(lambda: reader.read(block_size), b'')
+
+
+# Functions returning the decompressed data of a file in blocks, by file
+# extension
+DECOMPRESSORS = {
+    '.gz': lambda filename: decompress_blocks(
+        filename, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    '.xz': lambda filename: decompress_blocks(
+        filename, lzma.LZMADecompressor),
+    '.zst': zstd_blocks,
+}
+
+
+def open_input(filename, encoding='utf-8'):
+    """Open a text file for reading, which may be compressed
+
+    Files ending with .gz, .xz or .zst are decompressed in a background
+    thread (see BackgroundReader) while the returned text file object is
+    read. The filename - means standard input.
+    """
+    if filename == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding=encoding)
+    blocks = DECOMPRESSORS.get(os.path.splitext(filename)[1])
+    if blocks is None:
+        return open(filename, 'r', encoding=encoding)
+    return io.TextIOWrapper(
+        io.BufferedReader(BackgroundReader(blocks(filename))),
+        encoding=encoding)
+
+
+class BinaryLinks:
+    """Links in the binary format, see read_binary_links()
+
+    `offsets` is an np.ndarray(uint64) with one more element than the number
+    of sentences, and `links` an np.ndarray(uint32) with one row of (source
+    index, target index) per link, so that the links of sentence i are
+    links[offsets[i]:offsets[i+1]]. Iterating over the object (or indexing
+    it) gives these arrays, so it can be used instead of the lines of a text
+    links file, e.g. with calculate_priors().
+    """
+
+    def __init__(self, offsets, links):
+        self.offsets = offsets
+        self.links = links
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.links[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        links = self.links
+        offsets = self.offsets.tolist()
+        for begin, end in zip(offsets, offsets[1:]):
+            yield links[begin:end]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def to_lines(self):
+        """Return the links as lines in the text format"""
+        return [' '.join('%d-%d' % (i, j) for i, j in sent.tolist())
+                for sent in self]
+
+
+def read_binary_links(filename):
+    """Read a file in the binary links format into a BinaryLinks object
+
+    The file is written by the eflomal binary with --binary-links (or with
+    binary_links=True in Python). Its arrays are memory-mapped.
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(LINKS_HEADER.size)
+    if len(header) != LINKS_HEADER.size:
+        raise ValueError('%s is not in the binary links format' % filename)
+    magic, version, n_sentences = LINKS_HEADER.unpack(header)
+    if magic != LINKS_MAGIC:
+        raise ValueError('%s is not in the binary links format' % filename)
+    if version != LINKS_VERSION:
+        raise ValueError('unsupported version %d of %s' % (version, filename))
+    size = os.path.getsize(filename) - LINKS_HEADER.size - \
+        8*(n_sentences+1)
+    if size < 0 or size % 8:
+        raise ValueError('unexpected size of %s' % filename)
+    links = np.memmap(filename, dtype='<u4', mode='r',
+                      offset=LINKS_HEADER.size, shape=(size // 8, 2)) \
+            if size else np.empty((0, 2), dtype=np.uint32)
+    offsets = np.memmap(filename, dtype='<u8', mode='r',
+                        offset=LINKS_HEADER.size + size,
+                        shape=(n_sentences+1,))
+    if offsets[-1] != len(links):
+        raise ValueError('invalid offsets in %s' % filename)
+    return BinaryLinks(offsets, links)
+
+
+def open_links(filename):
+    """Open a links file in either the text or the binary format
+
+    Returns a BinaryLinks object for the binary format, and otherwise a file
+    object as returned by open_input(). Both can be used as context managers
+    and iterated over, as in calculate_priors().
+    """
+    with open(filename, 'rb') as f:
+        is_binary = f.read(len(LINKS_MAGIC)) == LINKS_MAGIC
+    return read_binary_links(filename) if is_binary else open_input(filename)
+
+
+def calculate_priors(src_sentences, trg_sentences,
+                     fwd_alignments, rev_alignments,
+                     reverse, n_jobs=1, shard_size=SHARD_SIZE):
+    """Calculate priors from alignments
+
+    If `reverse` is True, compute priors for the opposite alignment
+    direction.
+
+    The input is split into shards of `shard_size` lines, which are counted
+    with NumPy (see count_priors_shard()). If `n_jobs` is larger than 1, the
+    shards are counted by a pool of that many processes.
+
+    Returns a tuple of Counter objects (priors, hmmf_priors, hmmr_priors,
+    ferf_priors, ferr_priors), as used by write_priors().
+    """
+    lines = zip(src_sentences, trg_sentences, fwd_alignments, rev_alignments)
+
+    def shards():
+        lineno = 0
+        while True:
+            shard = list(itertools.islice(lines, shard_size))
+            if not shard:
+                return
+            yield tuple(zip(*shard)) + (reverse, lineno)
+            lineno += len(shard)
+
+    def counted_shards(pool):
+        # limit the number of shards in memory that are waiting for a worker
+        pending = deque()
+        for args in shards():
+            pending.append(pool.submit(count_priors_shard, *args))
+            while len(pending) > 2*n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            priors, hmmf_priors, hmmr_priors, ferf_priors, ferr_priors = \
+                merge_priors_shards(counted_shards(pool))
+    else:
+        priors, hmmf_priors, hmmr_priors, ferf_priors, ferr_priors = \
+            merge_priors_shards(
+                count_priors_shard(*args) for args in shards())
+    # TODO: confirm EOF in all files
+
+    if reverse:
+        return priors, hmmr_priors, hmmf_priors, ferr_priors, ferf_priors
+    else:
+        return priors, hmmf_priors, hmmr_priors, ferf_priors, ferr_priors
+
+
+def parse_links(lines, lengths1, lengths2, lineno=0):
+    """Parse lines of Moses-style alignments into NumPy arrays
+
+    Arguments:
+
+    lines - sequence of alignment lines
+    lengths1 - np.ndarray with the length of each sentence on the first side
+               of the links
+    lengths2 - the same for the second side
+    lineno - line number of the first line, for error messages
+
+    The lines may also be np.ndarray objects with one (i, j) row per link,
+    as given by BinaryLinks.
+
+    Returns three np.ndarray(int64) with the sentence number and the two
+    token indexes of each link.
+    """
+    values, n_links = split_links(lines, lineno)
+    return check_links(values, n_links, lengths1, lengths2, lineno)
+
+
+def split_links(lines, lineno=0):
+    """Split lines of Moses-style alignments (or BinaryLinks arrays) up
+
+    Returns `values`, an np.ndarray(int64) with i and j of each link in turn,
+    and `n_links`, an np.ndarray(int64) with the number of links on each
+    line.
+    """
+    if len(lines) and isinstance(lines[0], np.ndarray):
+        n_links = np.array([len(links) for links in lines], dtype=np.int64)
+        values = np.concatenate(lines).astype(np.int64).reshape(-1) \
+                if n_links.sum() else np.empty(0, dtype=np.int64)
+        return values, n_links
+    n_links = np.array([line.count('-') for line in lines], dtype=np.int64)
+    # (stripped, since a string of only whitespace would be parsed as [0])
+    values = np.fromstring(' '.join(lines).replace('-', ' ').strip(),
+                           dtype=np.int64, sep=' ')
+    if len(values) != 2*n_links.sum():
+        raise ValueError('Invalid alignments on lines %d-%d' % (
+            lineno + 1, lineno + len(lines)))
+    return values, n_links
+
+
+def check_links(values, n_links, lengths1, lengths2, lineno):
+    """Check the links parsed by parse_links() and split them up
+
+    `values` contains i and j of each link in turn, and `n_links` the number
+    of links of each sentence.
+    """
+    sent = np.repeat(np.arange(len(n_links), dtype=np.int64), n_links)
+    i, j = values[0::2], values[1::2]
+    bad = (i < 0) | (j < 0) | (i >= lengths1[sent]) | (j >= lengths2[sent])
+    if bad.any():
+        k = np.flatnonzero(bad)[0]
+        logger.error('alignment out of bounds in line %d: (%d, %d)',
+                     lineno + sent[k] + 1, i[k], j[k])
+        raise ValueError('Invalid input on line %d' % (lineno + sent[k] + 1))
+    return sent, i, j
+
+
+def count_jumps(sent, pos, key, lengths):
+    """Count HMM jumps from the links of a number of sentences
+
+    Within each sentence, the links are visited in order of key (keeping the
+    original order for equal keys), and for each new key the jump in pos
+    from the previous link is counted. The jump from the last link to the
+    end of the sentence (of length lengths[sent]) is also counted.
+    """
+    order = np.argsort(sent*(key.max(initial=0)+1) + key, kind='stable')
+    sent, pos, key = sent[order], pos[order], key[order]
+    first = np.ones(len(sent), dtype=bool)
+    first[1:] = sent[1:] != sent[:-1]
+    last = np.ones(len(sent), dtype=bool)
+    last[:-1] = first[1:]
+    prev_pos = np.empty_like(pos)
+    prev_pos[1:] = pos[:-1]
+    prev_pos[first] = -1
+    prev_key = np.empty_like(key)
+    prev_key[1:] = key[:-1]
+    prev_key[first] = -1
+    last_pos = np.full(len(lengths), -1, dtype=np.int64)
+    last_pos[sent[last]] = pos[last]
+    return np.unique(np.concatenate(
+        [(pos - prev_pos)[key != prev_key], lengths - last_pos]),
+        return_counts=True)
+
+
+def count_fertility(sent, pos, offsets, tokens):
+    """Count (word, fertility) pairs from the links of a number of sentences
+
+    Returns the keys, encoded as (word << 32) | fertility, and the counts.
+    """
+    linked, fert = np.unique(offsets[sent] + pos, return_counts=True)
+    return np.unique(
+        (tokens[linked] << 32) | fert.astype(np.int64), return_counts=True)
+
+
+def count_priors_shard(src_sentences, trg_sentences,
+                       fwd_alignments, rev_alignments, reverse, lineno=0):
+    """Count the statistics for priors in a shard of sentences
+
+    The arguments are the same as for calculate_priors(), lineno is the
+    number of the first line in the shard. This is used by worker processes.
+
+    Returns the source and target vocabularies of the shard (ordered by local
+    index), followed by tuples (keys, counts) of np.ndarray(int64) for the
+    lexical, forward and reverse jump, and forward and reverse fertility
+    statistics. Lexical keys are (source word << 32) | target word, and
+    fertility keys as in count_fertility().
+    """
+    src_sents, src_index = read_text(src_sentences, False, 0, 0)
+    trg_sents, trg_index = read_text(trg_sentences, False, 0, 0)
+    src_offsets = src_sents.offsets.astype(np.int64)
+    trg_offsets = trg_sents.offsets.astype(np.int64)
+    src_tokens = src_sents.tokens.astype(np.int64)
+    trg_tokens = trg_sents.tokens.astype(np.int64)
+    src_lengths = np.diff(src_offsets)
+    trg_lengths = np.diff(trg_offsets)
+    fwd_sent, fwd_i, fwd_j = parse_links(
+        fwd_alignments, src_lengths, trg_lengths, lineno)
+    rev_sent, rev_i, rev_j = parse_links(
+        rev_alignments, src_lengths, trg_lengths, lineno)
+
+    sent, i, j = (rev_sent, rev_i, rev_j) if reverse else \
+                 (fwd_sent, fwd_i, fwd_j)
+    lex = np.unique((src_tokens[src_offsets[sent] + i] << 32) |
+                    trg_tokens[trg_offsets[sent] + j], return_counts=True)
+    hmmf = count_jumps(fwd_sent, fwd_i, fwd_j, src_lengths)
+    hmmr = count_jumps(rev_sent, rev_j, rev_i, trg_lengths)
+    ferf = count_fertility(fwd_sent, fwd_i, src_offsets, src_tokens)
+    ferr = count_fertility(rev_sent, rev_j, trg_offsets, trg_tokens)
+    return list(src_index), list(trg_index), (lex, hmmf, hmmr, ferf, ferr)
+
+
+def merge_counts(counts):
+    """Merge a list of (keys, counts) tuples into one"""
+    keys, inverse = np.unique(
+        np.concatenate([k for k, _ in counts]), return_inverse=True)
+    totals = np.zeros(len(keys), dtype=np.int64)
+    np.add.at(totals, inverse, np.concatenate([n for _, n in counts]))
+    return keys, totals
+
+
+def merge_priors_shards(shards):
+    """Merge the output of count_priors_shard() into Counter objects
+
+    Returns a tuple (priors, hmmf_priors, hmmr_priors, ferf_priors,
+    ferr_priors) with the statistics in the forward direction.
+    """
+    src_index = {}
+    trg_index = {}
+    empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    merged = [empty]*5
+    pending = [[] for _ in merged]
+    n_pending = 0
+    for src_vocabulary, trg_vocabulary, shard_counts in shards:
+        src_map = np.array(
+            [src_index.setdefault(word, len(src_index))
+             for word in src_vocabulary], dtype=np.int64)
+        trg_map = np.array(
+            [trg_index.setdefault(word, len(trg_index))
+             for word in trg_vocabulary], dtype=np.int64)
+        # translate the keys from local to global word indexes
+        (lex, lex_n), hmmf, hmmr, (ferf, ferf_n), (ferr, ferr_n) = \
+            shard_counts
+        mask = np.int64(0xffffffff)
+        lex = (src_map[lex >> 32] << 32) | trg_map[lex & mask]
+        ferf = (src_map[ferf >> 32] << 32) | (ferf & mask)
+        ferr = (trg_map[ferr >> 32] << 32) | (ferr & mask)
+        for k, counts in enumerate(((lex, lex_n), hmmf, hmmr,
+                                    (ferf, ferf_n), (ferr, ferr_n))):
+            pending[k].append(counts)
+            n_pending += len(counts[0])
+        # merge regularly to save memory, but not so often as to dominate
+        if n_pending > max(SHARD_SIZE, sum(len(k) for k, _ in merged)):
+            merged = [merge_counts([m] + p) for m, p in zip(merged, pending)]
+            pending = [[] for _ in merged]
+            n_pending = 0
+    merged = [merge_counts([m] + p) for m, p in zip(merged, pending)]
+
+    src_words = list(src_index)
+    trg_words = list(trg_index)
+    (lex, lex_n), (hmmf, hmmf_n), (hmmr, hmmr_n), (ferf, ferf_n), \
+        (ferr, ferr_n) = [(k.tolist(), n.tolist()) for k, n in merged]
+    mask = 0xffffffff
+    return (
+        Counter({(src_words[k >> 32], trg_words[k & mask]): n
+                 for k, n in zip(lex, lex_n)}),
+        Counter(dict(zip(hmmf, hmmf_n))),
+        Counter(dict(zip(hmmr, hmmr_n))),
+        Counter({(src_words[k >> 32], k & mask): n
+                 for k, n in zip(ferf, ferf_n)}),
+        Counter({(trg_words[k >> 32], k & mask): n
+                 for k, n in zip(ferr, ferr_n)}))
+
+
+def write_priors(priorsf, priors_list, hmmf_priors, hmmr_priors,
+                 ferf_priors, ferr_priors):
+    """Write priors to file object"""
+    for (src, trg), alpha in sorted(priors_list.items()):
+        print('LEX\t%s\t%s\t%g' % (src, trg, alpha), file=priorsf)
+    for (src, fert), alpha in sorted(ferf_priors.items()):
+        print('FERF\t%s\t%d\t%g' % (src, fert, alpha), file=priorsf)
+    for (trg, fert), alpha in sorted(ferr_priors.items()):
+        print('FERR\t%s\t%d\t%g' % (trg, fert, alpha), file=priorsf)
+    for jump, alpha in sorted(hmmf_priors.items()):
+        print('HMMF\t%d\t%g' % (jump, alpha), file=priorsf)
+    for jump, alpha in sorted(hmmr_priors.items()):
+        print('HMMR\t%d\t%g' % (jump, alpha), file=priorsf)
+
+
+def read_priors(priors_file):
+    """Load priors from file object"""
+    priors_list = []    # list of (srcword, trgword, alpha)
+    ferf_priors = []    # list of (wordform, alpha)
+    ferr_priors = []    # list of (wordform, alpha)
+    hmmf_priors = {}    # dict of jump: alpha
+    hmmr_priors = {}    # dict of jump: alpha
+    # 5 types of lines valid:
+    #
+    # LEX   srcword     trgword     alpha   | lexical prior
+    # HMMF  jump        alpha               | target-side HMM prior
+    # HMMR  jump        alpha               | source-side HMM prior
+    # FERF  srcword     fert   alpha        | source-side fertility p.
+    # FERR  trgword     fert    alpha       | target-side fertility p.
+    for i, line in enumerate(priors_file):
+        fields = line.rstrip('\n').split('\t')
+        try:
+            alpha = float(fields[-1])
+        except ValueError as err:
+            logger.error('priors line %d contains alpha '
+                         'value of "%s" which is not numeric',
+                         i+1, fields[2])
+            raise err
+        if fields[0] == 'LEX' and len(fields) == 4:
+            priors_list.append((fields[1], fields[2], alpha))
+        elif fields[0] == 'HMMF' and len(fields) == 3:
+            hmmf_priors[int(fields[1])] = alpha
+        elif fields[0] == 'HMMR' and len(fields) == 3:
+            hmmr_priors[int(fields[1])] = alpha
+        elif fields[0] == 'FERF' and len(fields) == 4:
+            ferf_priors.append((fields[1], int(fields[2]), alpha))
+        elif fields[0] == 'FERR' and len(fields) == 4:
+            ferr_priors.append((fields[1], int(fields[2]), alpha))
+        else:
+            logger.error('priors line %d is invalid', i + 1)
+            raise ValueError('Invalid input on line %d' % i + 1)
+    return priors_list, hmmf_priors, hmmr_priors, ferf_priors, ferr_priors
+
+
+def to_eflomal_priors_file(priors, src_index, trg_index, outfile,
+                           binary=False):
+    """Write priors to a file read by eflomal binary
+
+    Arguments:
+
+    priors - tuple of priors (priors_list, hmmf_priors, hmmr_priors,
+             ferf_priors, ferr_priors)
+    src_index - vocabulary index for source text
+    tgt_index - vocabulary index for target text
+    outfile - file object for output (opened in binary mode if `binary`)
+    binary - if True, use the (memory-mappable) binary format
+
+    """
+    priors_list, hmmf_priors, hmmr_priors, ferf_priors, ferr_priors = priors
+    priors_indexed = {}
+    for src_word, trg_word, alpha in priors_list:
+        if src_word == '<NULL>':
+            e = 0
+        else:
+            e = src_index[src_word]
+
+        if trg_word == '<NULL>':
+            f = 0
+        else:
+            f = trg_index[trg_word]
+
+        if (e is not None) and (f is not None):
+            priors_indexed[(e, f)] = priors_indexed.get((e, f), 0.0) \
+                + alpha
+    ferf_indexed = {}
+    for src_word, fert, alpha in ferf_priors:
+        e = src_index[src_word]
+        if e is not None:
+            ferf_indexed[(e, fert)] = \
+                ferf_indexed.get((e, fert), 0.0) + alpha
+    ferr_indexed = {}
+    for trg_word, fert, alpha in ferr_priors:
+        f = trg_index[trg_word]
+        if f is not None:
+            ferr_indexed[(f, fert)] = \
+                ferr_indexed.get((f, fert), 0.0) + alpha
+    logger.info('%d (of %d) pairs of lexical priors used',
+                len(priors_indexed), len(priors_list))
+    if binary:
+        write_binary_priors(
+            outfile, len(src_index)+1, len(trg_index)+1, priors_indexed,
+            hmmf_priors, hmmr_priors, ferf_indexed, ferr_indexed)
+        return
+    print('%d %d %d %d %d %d %d' % (
+        len(src_index)+1, len(trg_index)+1, len(priors_indexed),
+        len(hmmf_priors), len(hmmr_priors),
+        len(ferf_indexed), len(ferr_indexed)),
+          file=outfile)
+    for (e, f), alpha in sorted(priors_indexed.items()):
+        print('%d %d %g' % (e, f, alpha), file=outfile)
+    for jump, alpha in sorted(hmmf_priors.items()):
+        print('%d %g' % (jump, alpha), file=outfile)
+    for jump, alpha in sorted(hmmr_priors.items()):
+        print('%d %g' % (jump, alpha), file=outfile)
+    for (e, fert), alpha in sorted(ferf_indexed.items()):
+        print('%d %d %g' % (e, fert, alpha), file=outfile)
+    for (f, fert), alpha in sorted(ferr_indexed.items()):
+        print('%d %d %g' % (f, fert, alpha), file=outfile)
+    outfile.flush()
@@ -0,0 +1,231 @@
+"""Evaluation of word alignments against a gold standard
+
+The scores are those of wa_eval_align.pl from the WPT shared tasks (see
+3rdparty/): precision, recall and F-measure of the sure links and of the
+possible links, and the alignment error rate (AER). Each link is encoded as
+one int64 of its sentence number and its (1-based) source and target
+positions, so that comparing an alignment with the gold standard reduces to
+set operations on sorted arrays.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import re
+
+import numpy as np
+
+from . import SHARD_SIZE, split_links
+
+
+# Links are encoded as sentence << 32 | source << 16 | target
+MAX_POSITION = 0xffff
+MAX_SENTENCE = 0x7fffffff
+
+RE_NUMBERED = re.compile(r'<s snum=(\d+)>')
+RE_CONFIDENCE = re.compile(r'[\d.]+')
+
+
+def encode_links(sent, i, j, lineno=0):
+    """Encode the links (sent[k], i[k], j[k]) as np.ndarray(int64)
+
+    The positions are 1-based, as in the WPT format.
+    """
+    bad = (sent < 0) | (sent > MAX_SENTENCE) | \
+          (i < 0) | (i > MAX_POSITION) | (j < 0) | (j > MAX_POSITION)
+    if bad.any():
+        k = np.flatnonzero(bad)[0]
+        raise ValueError('Link (%d, %d, %d) out of range near line %d' % (
+            sent[k], i[k], j[k], lineno + 1))
+    return (sent << 32) | (i << 16) | j
+
+
+def parse_gold_shard(lines, lineno):
+    """Parse lines of a gold standard in the WPT format
+
+    Each line contains the sentence number, source position and target
+    position of a link, optionally followed by S (sure) or P (possible)
+    and/or a confidence value. As in wa_eval_align.pl, links without S or P
+    are sure, and a link marked both S and P counts as both.
+
+    Returns two np.ndarray(int64) of encoded sure and possible links.
+    """
+    sure = []
+    possible = []
+    for k, line in enumerate(lines):
+        fields = line.split()
+        if not fields:
+            continue
+        n = len(fields)
+        if n < 3:
+            raise ValueError('Invalid gold alignment on line %d' % (
+                lineno + k + 1))
+        if n == 3 or (n == 4 and (fields[3] == 'S' or
+                                  RE_CONFIDENCE.fullmatch(fields[3]))) or \
+                (n == 5 and 'S' in fields[3:]):
+            sure.append(fields[:3])
+        if (n == 4 and fields[3] == 'P') or (n == 5 and 'P' in fields[3:]):
+            possible.append(fields[:3])
+    encoded = []
+    for links in (sure, possible):
+        links = np.array(links, dtype=np.int64).reshape(-1, 3)
+        encoded.append(encode_links(links[:, 0], links[:, 1], links[:, 2],
+                                    lineno))
+    return tuple(encoded)
+
+
+def parse_links_shard(lines, numbers, lineno):
+    """Parse Moses-style links (or BinaryLinks arrays) of some sentences
+
+    `numbers` contains the sentence number of each line. Returns an
+    np.ndarray(int64) of encoded links.
+    """
+    values, n_links = split_links(lines, lineno)
+    sent = np.repeat(np.asarray(numbers, dtype=np.int64), n_links)
+    return encode_links(sent, values[0::2] + 1, values[1::2] + 1, lineno)
+
+
+def map_shards(function, shards, n_jobs):
+    """Return the list of function(*args) for each args in shards
+
+    If `n_jobs` is larger than 1, this uses a pool of that many processes.
+    """
+    if n_jobs <= 1:
+        return [function(*args) for args in shards]
+    results = []
+    with ProcessPoolExecutor(n_jobs) as pool:
+        # limit the number of shards in memory that are waiting for a worker
+        pending = deque()
+        for args in shards:
+            pending.append(pool.submit(function, *args))
+            while len(pending) > 2*n_jobs:
+                results.append(pending.popleft().result())
+        while pending:
+            results.append(pending.popleft().result())
+    return results
+
+
+def read_sentence_numbers(lines):
+    """Read the sentence numbers of a text in the WPT format
+
+    Each line has the form <s snum=N>...</s>, and N is returned for each
+    line, in order.
+    """
+    numbers = []
+    for lineno, line in enumerate(lines):
+        m = RE_NUMBERED.match(line)
+        if not m:
+            raise ValueError('Line %d is not numbered' % (lineno + 1))
+        numbers.append(int(m.group(1)))
+    return numbers
+
+
+def evaluate(gold, links, numbers=None, n_jobs=1, shard_size=SHARD_SIZE):
+    """Evaluate links against a gold standard
+
+    Arguments:
+
+    gold - lines of the gold standard in the WPT format (see
+           parse_gold_shard())
+    links - lines of Moses-style links, or a BinaryLinks object
+    numbers - sentence number of each line of `links` in the gold standard,
+              by default 1, 2, ... If given, only the first len(numbers)
+              lines of `links` are evaluated.
+    n_jobs - number of worker processes
+    shard_size - number of lines parsed at a time (by one worker)
+
+    Returns a dict with the precision, recall and F-measure of the sure
+    links ('sure_precision', 'sure_recall', 'sure_f1') and the possible
+    links ('possible_precision', 'possible_recall', 'possible_f1'), the
+    'aer', and the number of links ('n_links', 'n_sure', 'n_possible').
+    These are the same as computed by wa_eval_align.pl.
+    """
+    def gold_shards():
+        lines = iter(gold)
+        lineno = 0
+        while True:
+            shard = list(itertools.islice(lines, shard_size))
+            if not shard:
+                return
+            yield shard, lineno
+            lineno += len(shard)
+
+    def links_shards():
+        lines = zip(links, numbers) if numbers is not None else \
+                zip(links, itertools.count(1))
+        lineno = 0
+        while True:
+            shard = list(itertools.islice(lines, shard_size))
+            if not shard:
+                return
+            shard_links, shard_numbers = zip(*shard)
+            yield shard_links, shard_numbers, lineno
+            lineno += len(shard)
+
+    def merge(arrays):
+        return np.unique(np.concatenate(arrays)) if arrays else \
+               np.empty(0, dtype=np.int64)
+
+    gold_encoded = map_shards(parse_gold_shard, gold_shards(), n_jobs)
+    sure = merge([s for s, _ in gold_encoded])
+    possible = merge([p for _, p in gold_encoded])
+    predicted = merge(map_shards(parse_links_shard, links_shards(), n_jobs))
+    return score_links(predicted, sure, possible)
+
+
+def score_links(predicted, sure, possible):
+    """Compute the scores returned by evaluate()
+
+    The arguments are sorted np.ndarray(int64) of unique encoded links.
+    """
+    n_sure_match = int(np.isin(predicted, sure, assume_unique=True).sum())
+    n_match = int(np.isin(predicted, np.union1d(sure, possible),
+                          assume_unique=True).sum())
+    n_links, n_sure, n_possible = len(predicted), len(sure), len(possible)
+
+    def ratio(a, b):
+        return a / b if b else 0.0
+
+    def f1(precision, recall):
+        return 2*precision*recall / (precision + recall) \
+               if precision and recall else 0.0
+
+    sure_precision = ratio(n_sure_match, n_links)
+    sure_recall = ratio(n_sure_match, n_sure)
+    # as in wa_eval_align.pl, links that are both sure and possible in the
+    # gold standard are counted twice in the recall of possible links
+    possible_precision = ratio(n_match, n_links)
+    possible_recall = ratio(n_match, n_sure + n_possible)
+    aer = 1.0 - ratio(n_sure_match + n_match, n_links + n_sure) \
+          if n_links else 0.0
+    return {
+        'sure_precision': sure_precision,
+        'sure_recall': sure_recall,
+        'sure_f1': f1(sure_precision, sure_recall),
+        'possible_precision': possible_precision,
+        'possible_recall': possible_recall,
+        'possible_f1': f1(possible_precision, possible_recall),
+        'aer': aer,
+        'n_links': n_links,
+        'n_sure': n_sure,
+        'n_possible': n_possible,
+    }
+
+
+def format_scores(scores):
+    """Format the scores from evaluate() as wa_eval_align.pl does"""
+    return '\n'.join([
+        '    Word Alignment Evaluation   ',
+        '----------------------------------',
+        '   Evaluation of SURE alignments ',
+        '   Precision = %5.4f  ' % scores['sure_precision'],
+        '   Recall    = %5.4f' % scores['sure_recall'],
+        '   F-measure = %5.4f' % scores['sure_f1'],
+        '-----------------------------------',
+        '   Evaluation of PROBABLE alignments',
+        '   Precision = %5.4f' % scores['possible_precision'],
+        '   Recall    = %5.4f' % scores['possible_recall'],
+        '   F-measure = %5.4f' % scores['possible_f1'],
+        '-----------------------------------',
+        '   AER       = %5.4f' % scores['aer'],
+    ])
@@ -1,92 +1,618 @@
 cimport cython
 from cpython cimport bool
 cimport numpy as np
+from libc.stdint cimport uint32_t, uint64_t, int64_t
 from libc.stdio cimport fprintf, fdopen, fputc, fflush, FILE
 
 import os
 import sys
+import json
 import math
+import struct
 import subprocess
 from tempfile import NamedTemporaryFile
 
 import numpy as np
 
 
-cpdef tuple read_text(pyfile, bool lowercase, int prefix_len, int suffix_len):
-    """Read a tokenized text file as a list of indexed sentences.
-    
-    Optionally transform the vocabulary according to the parameters.
-    
-    pyfile -- file to read
-    lowercase -- if True, all tokens are lowercased
-    prefix_len -- if non-zero, all tokens are cut of after so many characters
-    suffix_len -- if non-zero, as above, but cutting from the right side
+# The sampler itself, compiled into this module for align_arrays(). Note
+# that the path is relative, since the C file generated from this module is
+# also called eflomal.c.
+cdef extern from *:
+    """
+    #define EFLOMAL_NO_MAIN
+    #include "../../src/eflomal.c"
+    """
+    ctypedef uint32_t token
+    ctypedef uint32_t position
+    ctypedef float count
 
-    Returns:
-    a tuple (list sents, dict index) containing the actual sentences and the
-    string-to-index mapping used.
+    cdef struct text:
+        char *filename
+        size_t n_sentences
+        token vocabulary_size
+        size_t n_tokens
+        size_t max_length
+        const uint64_t *offsets
+        const token *tokens
+        void *map
+        uint64_t *offsets_buf
+        token *tokens_buf
+
+    cdef struct memory_plan:
+        int n_samplers
+        int n_threads
+        int parallel_directions
+        size_t peak_memory
+
+    int memory_plan_create(
+        memory_plan *plan, const text *source, const text *target,
+        int directions, int keep_results, size_t shared_memory,
+        int n_samplers, int n_threads, size_t max_memory, int max_threads)
+
+    enum:
+        ALIGN_ERROR_MEMORY
+        ALIGN_ERROR_PRIORS
+        ALIGN_ERROR_TEXT
+
+    int align_buffers(
+        const text *source, const text *target,
+        int model, int score_model, double null_prior, int n_samplers,
+        int n_threads, int quiet, const int *n_iters, double tolerance,
+        int64_t seed, const char *priors_filename,
+        size_t max_memory, int max_threads,
+        position *links_fwd, position *links_rev,
+        count *scores_fwd, count *scores_rev) nogil
+
+# Value of links for unaligned tokens in the output of align_arrays()
+NULL_LINK = 0xffffffff
+
+# Symmetrization methods supported by align(), with the same names as in
+# atools from fast_align
+SYMMETRIZATION_METHODS = ('intersect', 'union', 'grow-diag',
+                          'grow-diag-final', 'grow-diag-final-and')
+
+
+cdef class FlatText:
+    """Sentences stored in one flat token buffer
+
+    Sentence i is tokens[offsets[i]:offsets[i+1]], where tokens is an
+    np.ndarray(uint32) and offsets an np.ndarray(uint64) with one element
+    more than the number of sentences. Indexing and iteration give the
+    sentences as views of the token buffer, so a FlatText can be used where
+    a sequence of sentences is expected.
     """
-    cdef:
-        np.ndarray[np.uint32_t, ndim=1] sent
-        list sents, tokens
-        str line, token
-        dict index
-        int i, n, idx
-
-    index = {}
-    sents = []
-    for line in pyfile:
-        if lowercase:
+    cdef readonly np.ndarray tokens
+    cdef readonly np.ndarray offsets
+
+    def __init__(self, tokens, offsets):
+        self.tokens = np.ascontiguousarray(tokens, dtype=np.uint32)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.uint64)
+        if len(self.offsets) == 0 or self.offsets[0] != 0 or \
+                self.offsets[-1] != len(self.tokens):
+            raise ValueError('Offsets do not match token buffer')
+
+    @staticmethod
+    def from_sentences(sents):
+        """Create a FlatText from a sequence of np.ndarray(uint32)"""
+        if isinstance(sents, FlatText):
+            return sents
+        offsets = np.zeros(len(sents)+1, dtype=np.uint64)
+        np.cumsum([len(sent) for sent in sents], out=offsets[1:])
+        tokens = np.concatenate(
+            [np.empty(0, dtype=np.uint32)] + list(sents)).astype(
+                np.uint32, copy=False)
+        return FlatText(tokens, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('sentence index out of range')
+        return self.tokens[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.tokens[self.offsets[i]:self.offsets[i+1]]
+
+    def lengths(self):
+        """Return the length of each sentence as np.ndarray(int64)"""
+        return np.diff(self.offsets).astype(np.int64)
+
+    def without_long(self, size_t max_length=0x3ff):
+        """Return a FlatText where longer sentences are empty
+
+        Also returns a boolean mask over the tokens of this text, which is
+        True for the tokens that were kept.
+        """
+        lengths = self.lengths()
+        too_long = lengths > max_length
+        if not too_long.any():
+            return self, np.ones(len(self.tokens), dtype=bool)
+        keep = np.repeat(~too_long, lengths)
+        lengths[too_long] = 0
+        offsets = np.zeros(len(lengths)+1, dtype=np.uint64)
+        np.cumsum(lengths, out=offsets[1:])
+        return FlatText(self.tokens[keep], offsets), keep
+
+
+cdef np.ndarray grow_array(np.ndarray a, size_t n, size_t new_size):
+    cdef np.ndarray b = np.empty(new_size, dtype=a.dtype)
+    b[:n] = a[:n]
+    return b
+
+
+@cython.final
+cdef class TextBuilder:
+    """Indexed sentences in a flat buffer, which are added one at a time
+
+    This is used by read_text() and read_joint_text().
+    """
+    cdef np.ndarray token_array, offset_array
+    # data of token_array and offset_array
+    cdef np.uint32_t *token_buf
+    cdef np.uint64_t *offset_buf
+    cdef size_t n_tokens, n_sents, token_capacity, offset_capacity
+    cdef dict index
+    cdef bint lowercase
+    cdef int prefix_len, suffix_len
+
+    def __init__(self, bool lowercase, int prefix_len, int suffix_len,
+                 dict index=None):
+        # the buffers are grown geometrically, and trimmed in-place at the end
+        self.token_array = np.empty(0x10000, dtype=np.uint32)
+        self.offset_array = np.empty(0x1000, dtype=np.uint64)
+        self.token_buf = <np.uint32_t*>self.token_array.data
+        self.offset_buf = <np.uint64_t*>self.offset_array.data
+        self.offset_buf[0] = 0
+        self.token_capacity = len(self.token_array)
+        self.offset_capacity = len(self.offset_array)
+        self.n_tokens = 0
+        self.n_sents = 0
+        self.index = {} if index is None else dict(index)
+        self.lowercase = lowercase
+        self.prefix_len = prefix_len
+        self.suffix_len = suffix_len
+
+    cdef add(self, str line):
+        cdef:
+            list tokens
+            str token
+            size_t i, n
+            size_t n_tokens = self.n_tokens
+            int idx
+            dict index = self.index
+
+        if self.lowercase:
             tokens = line.lower().split()
         else:
             tokens = line.split()
         n = len(tokens)
-        sent = np.empty(n, dtype=np.uint32)
+        if n_tokens + n > self.token_capacity:
+            self.token_capacity = max(n_tokens + n, 2*n_tokens)
+            self.token_array = grow_array(
+                self.token_array, n_tokens, self.token_capacity)
+            self.token_buf = <np.uint32_t*>self.token_array.data
+        if self.n_sents + 2 > self.offset_capacity:
+            self.offset_capacity = 2*self.n_sents
+            self.offset_array = grow_array(
+                self.offset_array, self.n_sents+1, self.offset_capacity)
+            self.offset_buf = <np.uint64_t*>self.offset_array.data
 
         for i in range(n):
             token = tokens[i]
-            if prefix_len != 0: token = token[:prefix_len]
-            elif suffix_len != 0: token = token[-suffix_len:]
+            if self.prefix_len != 0: token = token[:self.prefix_len]
+            elif self.suffix_len != 0: token = token[-self.suffix_len:]
             idx = index.get(token, -1)
             if idx == -1:
                 idx = len(index)
                 index[token] = idx
-            sent[i] = idx
+            self.token_buf[n_tokens] = idx
+            n_tokens += 1
+
+        self.n_tokens = n_tokens
+        self.n_sents += 1
+        self.offset_buf[self.n_sents] = n_tokens
+
+    cdef tuple finish(self):
+        self.token_buf = NULL
+        self.offset_buf = NULL
+        self.token_array.resize(self.n_tokens, refcheck=False)
+        self.offset_array.resize(self.n_sents+1, refcheck=False)
+        return (FlatText(self.token_array, self.offset_array), self.index)
+
+
+cpdef tuple read_text(pyfile, bool lowercase, int prefix_len, int suffix_len,
+                      dict index=None):
+    """Read a tokenized text file as indexed sentences in a flat buffer.
+    
+    Optionally transform the vocabulary according to the parameters.
+    
+    pyfile -- file to read
+    lowercase -- if True, all tokens are lowercased
+    prefix_len -- if non-zero, all tokens are cut of after so many characters
+    suffix_len -- if non-zero, as above, but cutting from the right side
+    index -- if given, a string-to-index mapping (as returned by a previous
+             call) to extend, so that known words keep their indexes
+
+    Returns:
+    a tuple (FlatText sents, dict index) containing the actual sentences and
+    the string-to-index mapping used.
+    """
+    cdef TextBuilder text = TextBuilder(
+        lowercase, prefix_len, suffix_len, index)
+    cdef str line
+
+    for line in pyfile:
+        text.add(line)
+    return text.finish()
 
-        sents.append(sent)
 
-    return (sents, index)
+cpdef tuple read_joint_text(pyfile, bool lowercase,
+                            int source_prefix_len, int source_suffix_len,
+                            int target_prefix_len, int target_suffix_len,
+                            dict source_index=None, dict target_index=None):
+    """Read a fast_align style joint file in a single pass
+
+    Each line contains a source and a target sentence, separated by |||.
+    The arguments are the same as for read_text(), for the source and
+    target side respectively.
+
+    Returns:
+    a tuple ((FlatText, dict), (FlatText, dict)) with the source and target
+    sentences and indexes, as returned by read_text().
+    """
+    # lines are lowercased here, once for both sides
+    cdef TextBuilder source = TextBuilder(
+        False, source_prefix_len, source_suffix_len, source_index)
+    cdef TextBuilder target = TextBuilder(
+        False, target_prefix_len, target_suffix_len, target_index)
+    cdef str line
+    cdef list fields
+    cdef size_t lineno = 0
+
+    for line in pyfile:
+        lineno += 1
+        if lowercase:
+            line = line.lower()
+        fields = line.strip().split(' ||| ')
+        if len(fields) != 2:
+            raise ValueError('Line %d does not contain a single ||| '
+                             'separator, or sentence(s) are empty' % lineno)
+        source.add(fields[0])
+        target.add(fields[1])
+    return source.finish(), target.finish()
 
 
-cpdef write_text(pyfile, tuple sents, int voc_size):
+cpdef write_text(pyfile, sents, int voc_size):
     """Write a sequence of sentences in the format expected by eflomal
 
     Arguments:
     pyfile -- Python file object to write to
-    sents -- tuple of sentences, each encoded as np.ndarray(uint32)
+    sents -- FlatText, or sequence of sentences each encoded as
+             np.ndarray(uint32)
     voc_size -- size of vocabulary
     """
-    cdef int token, i, n
+    cdef size_t i, j, n_sents
     cdef FILE *f
-    cdef np.ndarray[np.uint32_t, ndim=1] sent
+    cdef np.uint32_t[:] tokens
+    cdef np.uint64_t[:] offsets
+    cdef FlatText text
+
+    text = FlatText.from_sentences(sents)
+    tokens = text.tokens
+    offsets = text.offsets
+    n_sents = len(text)
 
     f = fdopen(pyfile.fileno(), 'wb')
-    fprintf(f, '%d %d\n', len(sents), voc_size)
-    for sent in sents:
-        n = len(sent)
-        if n < 0x400:
-            i = 0
-            fprintf(f, '%d', n)
-            while i < n:
-                fprintf(f, ' %d', sent[i])
-                i += 1
-            fputc(10, f)
-        else:
-            fputc(48, f)
-            fputc(10, f)
+    fprintf(f, '%zd %d\n', n_sents, voc_size)
+    for i in range(n_sents):
+        fprintf(f, '%d', <int>(offsets[i+1] - offsets[i]))
+        for j in range(offsets[i], offsets[i+1]):
+            fprintf(f, ' %d', tokens[j])
+        fputc(10, f)
     fflush(f)
 
 
+# Header of the binary text format, see struct text_header in eflomal.c
+TEXT_MAGIC = b'EFLT'
+TEXT_VERSION = 1
+TEXT_HEADER = struct.Struct('<4sIQQII')
+
+
+cpdef write_binary_text(pyfile, sents, int voc_size):
+    """Write a sequence of sentences in the binary format of eflomal
+
+    The eflomal binary memory-maps files in this format, which avoids parsing
+    the text format written by write_text().
+
+    Arguments:
+    pyfile -- Python file object (opened in binary mode) to write to
+    sents -- FlatText, or sequence of sentences each encoded as
+             np.ndarray(uint32)
+    voc_size -- size of vocabulary
+    """
+    cdef FlatText text
+    cdef size_t start, chunk_size = 0x100000
+
+    text = FlatText.from_sentences(sents)
+    pyfile.write(TEXT_HEADER.pack(
+        TEXT_MAGIC, TEXT_VERSION, len(text), len(text.tokens), voc_size,
+        int(text.lengths().max(initial=0))))
+    pyfile.write(text.offsets.astype('<u8', copy=False).tobytes())
+    # token 0 is reserved for NULL in the binary format, so all tokens are
+    # shifted by one (in chunks, to avoid copying the whole buffer)
+    buf = np.empty(min(chunk_size, len(text.tokens)), dtype='<u4')
+    for start in range(0, len(text.tokens), chunk_size):
+        chunk = text.tokens[start:start+chunk_size]
+        np.add(chunk, 1, out=buf[:len(chunk)])
+        pyfile.write(buf[:len(chunk)].tobytes())
+    pyfile.flush()
+
+
+def read_n_sentences(str filename):
+    """Return the number of sentences in a text file for the eflomal binary
+
+    The file can be in either of the formats written by write_text() and
+    write_binary_text().
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(TEXT_HEADER.size)
+        if header.startswith(TEXT_MAGIC):
+            return TEXT_HEADER.unpack(header)[2]
+        return int(header.split()[0])
+
+
+def plan_resources(str source_filename, str target_filename,
+                   int n_samplers=1, int n_threads=1, size_t max_memory=0,
+                   int max_threads=0, int directions=3,
+                   bool keep_results=False, str priors_filename=None):
+    """Plan the resources used by the eflomal binary to align two texts
+
+    This uses the same estimate as the binary itself, based on the headers
+    of texts written by write_binary_text().
+
+    Arguments:
+    n_samplers, n_threads -- requested number of samplers, and threads per
+                             sampler
+    max_memory -- if non-zero, memory budget in bytes
+    max_threads -- if non-zero, budget for the total number of threads
+    directions -- directions to align (1 = forward, 2 = reverse, 3 = both)
+    keep_results -- True if the alignments of both directions are kept
+                    until the end (for snapshots and symmetrization)
+    priors_filename -- if given, the priors file to be used
+
+    Returns:
+    a dict with the number of samplers and threads per sampler, whether
+    the directions are aligned in parallel, and the estimated peak memory
+    use in bytes, reduced as needed to fit the budget. MemoryError is raised
+    if the budget can not be met even with one sampler.
+    """
+    cdef text texts[2]
+    cdef memory_plan plan
+    for i, filename in enumerate((source_filename, target_filename)):
+        with open(filename, 'rb') as f:
+            header = f.read(TEXT_HEADER.size)
+        if not header.startswith(TEXT_MAGIC):
+            raise ValueError('%s is not in the binary text format' % filename)
+        _, _, n_sentences, n_tokens, voc_size, max_length = \
+                TEXT_HEADER.unpack(header)
+        texts[i].n_sentences = n_sentences
+        texts[i].n_tokens = n_tokens
+        texts[i].max_length = max_length
+        texts[i].vocabulary_size = voc_size + 1
+    shared_memory = 0 if priors_filename is None \
+            else os.path.getsize(priors_filename)
+    result = memory_plan_create(
+        &plan, &texts[0], &texts[1], directions, keep_results,
+        shared_memory, n_samplers, n_threads, max_memory, max_threads)
+    if result:
+        raise MemoryError(
+            'estimated memory use (%d MiB) exceeds the limit of %d MiB, '
+            'even with a single sampler' % (
+                plan.peak_memory >> 20, max_memory >> 20))
+    return {'n_samplers': plan.n_samplers, 'n_threads': plan.n_threads,
+            'parallel_directions': bool(plan.parallel_directions),
+            'peak_memory': plan.peak_memory}
+
+
+def default_n_iterations(int model, size_t n_sentences,
+                         double rel_iterations=1.0):
+    """Return the default 3-tuple of iterations per model for a corpus"""
+    iters = max(2, int(round(
+        rel_iterations*5000 / math.sqrt(max(1, n_sentences)))))
+    iters4 = max(1, iters//4)
+    if model == 1:
+        return (iters, 0, 0)
+    elif model == 2:
+        return (max(2, iters4), iters, 0)
+    else:
+        return (max(2, iters4), iters4, iters)
+
+
+cdef np.ndarray sampler_tokens(np.ndarray tokens, bint sort):
+    """Shift tokens by one, since 0 is NULL in the sampler
+
+    If sort is True, the tokens are also renumbered by decreasing frequency
+    (as by sort_vocabulary() in the eflomal module), which does not change
+    the links but lets the sampler use dense counts for frequent words.
+    """
+    if not sort or len(tokens) == 0:
+        return tokens + 1
+    order = np.argsort(-np.bincount(tokens), kind='stable')
+    new_ids = np.empty(len(order), dtype=np.uint32)
+    new_ids[order] = np.arange(1, len(order)+1, dtype=np.uint32)
+    return new_ids[tokens]
+
+
+cdef np.ndarray scatter_links(np.ndarray links, np.ndarray keep):
+    cdef np.ndarray result = np.full(len(keep), NULL_LINK, dtype=np.uint32)
+    result[keep] = links
+    return result
+
+
+def align_arrays(
+        sources,
+        targets,
+        int model=3,
+        int score_model=0,
+        tuple n_iterations=None,
+        int n_samplers=1,
+        int n_threads=1,
+        bool quiet=True,
+        double rel_iterations=1.0,
+        double null_prior=0.2,
+        str priors_filename=None,
+        double tolerance=0.0,
+        seed=None,
+        size_t max_memory=0,
+        int max_threads=0,
+        source_vocabulary_size=None,
+        target_vocabulary_size=None):
+    """Perform word alignment in-process, without calling the eflomal binary
+
+    Arguments:
+    sources -- source sentences as returned by read_text(), either a
+               FlatText or a sequence of np.ndarray(uint32)
+    targets -- target sentences, of the same length
+    score_model -- if non-zero, also compute sentence scores with this model
+    priors_filename -- if given, read Dirichlet priors (in the format written
+                       by to_eflomal_priors_file()) from here
+    max_memory -- if non-zero, memory budget in bytes (see plan_resources())
+    source_vocabulary_size, target_vocabulary_size -- if given, the sizes
+                       of the vocabularies (as passed to write_text()), which
+                       must match those of the priors. By default, the
+                       largest token of each side plus one is used, which
+                       only works with priors if every word occurs.
+    The remaining arguments are the same as for align().
+
+    Raises MemoryError if the memory budget can not be met, OSError if the
+    priors can not be read (or their vocabulary sizes do not match), and
+    ValueError for invalid arguments.
+
+    Returns:
+    a tuple (links_fwd, links_rev, scores_fwd, scores_rev). links_fwd is an
+    np.ndarray(uint32) with the index of the linked source token for each
+    target token (in the order of the concatenated target sentences, i.e.
+    indexed like FlatText.tokens), and links_rev contains the index of the
+    linked target token for each source token. Unaligned tokens are linked
+    to NULL_LINK, and so are all tokens of sentence pairs where either
+    sentence is too long for its indexes to fit in the links (NULL_LINK tokens
+    or more). The scores are np.ndarray(float32) with one value per sentence,
+    or None if score_model is 0.
+    """
+    cdef text source, target
+    cdef FlatText source_text, target_text
+    cdef np.ndarray[np.uint32_t, ndim=1] source_tokens, target_tokens
+    cdef np.ndarray[np.uint64_t, ndim=1] source_offsets, target_offsets
+    cdef np.ndarray[np.uint32_t, ndim=1] links_fwd, links_rev
+    cdef np.ndarray[np.float32_t, ndim=1] scores_fwd, scores_rev
+    cdef int iters[3]
+    cdef int quiet_flag = quiet
+    cdef bytes priors_bytes = None
+    cdef const char *priors_ptr = NULL
+    cdef int64_t c_seed = -1
+    cdef int result
+
+    if len(sources) != len(targets):
+        raise ValueError('Source and target have different numbers of '
+                         'sentences (%d vs %d)' % (len(sources), len(targets)))
+
+    source_text, source_keep = FlatText.from_sentences(sources).without_long(
+        NULL_LINK-1)
+    target_text, target_keep = FlatText.from_sentences(targets).without_long(
+        NULL_LINK-1)
+    source_offsets = source_text.offsets
+    target_offsets = target_text.offsets
+    # token 0 is reserved for NULL in the sampler
+    source_tokens = sampler_tokens(source_text.tokens, priors_filename is None)
+    target_tokens = sampler_tokens(target_text.tokens, priors_filename is None)
+
+    if n_iterations is None:
+        n_iterations = default_n_iterations(
+            model, len(sources), rel_iterations)
+    for i in range(3):
+        iters[i] = n_iterations[i]
+    if priors_filename is not None:
+        priors_bytes = priors_filename.encode('utf-8')
+        priors_ptr = priors_bytes
+    if seed is not None:
+        if seed < 0:
+            raise ValueError('seed must be non-negative')
+        c_seed = seed
+    # largest token of each side, or -1 if there are none
+    source_max = int(source_text.tokens.max()) \
+        if len(source_text.tokens) else -1
+    target_max = int(target_text.tokens.max()) \
+        if len(target_text.tokens) else -1
+    if source_vocabulary_size is None:
+        source_vocabulary_size = source_max + 1
+    elif source_vocabulary_size <= source_max:
+        raise ValueError('source token %d is out of range for a vocabulary '
+                         'of %d words' % (source_max, source_vocabulary_size))
+    if target_vocabulary_size is None:
+        target_vocabulary_size = target_max + 1
+    elif target_vocabulary_size <= target_max:
+        raise ValueError('target token %d is out of range for a vocabulary '
+                         'of %d words' % (target_max, target_vocabulary_size))
+
+    source.filename = b'<source>'
+    source.n_sentences = len(sources)
+    # plus one for NULL, as in the sampler tokens
+    source.vocabulary_size = source_vocabulary_size + 1
+    source.n_tokens = len(source_tokens)
+    source.max_length = source_text.lengths().max(initial=0)
+    source.offsets = <const uint64_t*>source_offsets.data
+    source.tokens = <const token*>source_tokens.data
+    source.map = NULL
+    source.offsets_buf = NULL
+    source.tokens_buf = NULL
+
+    target.filename = b'<target>'
+    target.n_sentences = len(targets)
+    target.vocabulary_size = target_vocabulary_size + 1
+    target.n_tokens = len(target_tokens)
+    target.max_length = target_text.lengths().max(initial=0)
+    target.offsets = <const uint64_t*>target_offsets.data
+    target.tokens = <const token*>target_tokens.data
+    target.map = NULL
+    target.offsets_buf = NULL
+    target.tokens_buf = NULL
+
+    links_fwd = np.empty(len(target_tokens), dtype=np.uint32)
+    links_rev = np.empty(len(source_tokens), dtype=np.uint32)
+    scores_fwd = np.zeros(len(sources), dtype=np.float32)
+    scores_rev = np.zeros(len(sources), dtype=np.float32)
+
+    with nogil:
+        result = align_buffers(
+            &source, &target, model, score_model, null_prior, n_samplers,
+            n_threads, quiet_flag, iters, tolerance, c_seed, priors_ptr,
+            max_memory, max_threads,
+            <position*>links_fwd.data, <position*>links_rev.data,
+            <count*>scores_fwd.data, <count*>scores_rev.data)
+    if result == ALIGN_ERROR_MEMORY:
+        raise MemoryError('estimated memory use exceeds the limit of %d MiB, '
+                          'even with a single sampler' % (max_memory >> 20))
+    elif result == ALIGN_ERROR_PRIORS:
+        raise OSError('unable to read priors from %s (missing, invalid, or '
+                      'with different vocabulary sizes)' % priors_filename)
+    elif result == ALIGN_ERROR_TEXT:
+        raise ValueError('unable to segment the sentences')
+
+    if not target_keep.all():
+        links_fwd = scatter_links(links_fwd, target_keep)
+    if not source_keep.all():
+        links_rev = scatter_links(links_rev, source_keep)
+
+    if score_model > 0:
+        return links_fwd, links_rev, scores_fwd, scores_rev
+    return links_fwd, links_rev, None, None
+
+
 def align(
         str source_filename,
         str target_filename,
@@ -100,15 +626,32 @@ def align(
         int score_model=0,
         tuple n_iterations=None,
         int n_samplers=1,
+        int n_threads=1,
         bool quiet=True,
         double rel_iterations=1.0,
         double null_prior=0.2,
-        bool use_gdb=False):
+        bool use_gdb=False,
+        str snapshot_output_filename=None,
+        str snapshot_input_filename=None,
+        str links_filename_sym=None,
+        str symmetrization='grow-diag-final-and',
+        double tolerance=0.0,
+        str telemetry_filename=None,
+        progress=None,
+        seed=None,
+        double decay=0.0,
+        size_t max_memory=0,
+        int max_threads=0,
+        str query_source_filename=None,
+        str query_target_filename=None,
+        bool binary_links=False,
+        bool dedup=False):
     """Call the eflomal binary to perform word alignment
 
     Arguments:
     source_filename -- str with source text filename, this and the target
-                       text should both be written using write_text()
+                       text should both be written using write_text() or
+                       write_binary_text()
     target_filename -- str with target text filename
     links_filename_fwd -- if given, write links here (forward direction)
     links_filename_rev -- if given, write links here (reverse direction)
@@ -120,23 +663,60 @@ def align(
                     not given the numbers will be computed automatically based
                     on rel_iterations
     n_samplers -- number of independent samplers to run
+    n_threads -- number of threads used by each sampler, values above 1
+                 sample shards of the corpus in parallel (approximate, and
+                 not reproducible between runs)
     quiet -- if True, suppress output
     rel_iterations -- number of iterations relative to the default
+    snapshot_output_filename -- if given, write a model snapshot here
+    snapshot_input_filename -- if given, continue from the model snapshot in
+                               this file rather than from scratch (can not
+                               be combined with priors_filename)
+    links_filename_sym -- if given, write links symmetrized from both
+                          directions here
+    symmetrization -- symmetrization method for links_filename_sym, one of
+                      SYMMETRIZATION_METHODS
+    tolerance -- if positive, n_iterations is an upper bound and each
+                 sampler moves on to the next model once the fraction of
+                 links changed per iteration has stopped decreasing by more
+                 than this (relative) amount
+    telemetry_filename -- if given, write telemetry records (one JSON object
+                          per line) here, see the README for their fields
+    progress -- if given, a function which is called with each telemetry
+                record (as a dict) while the binary is running (can not be
+                combined with telemetry_filename)
+    seed -- if given, a non-negative integer used to seed the random number
+            generator, so that the output is reproducible (with n_threads=1)
+    decay -- if both snapshot_input_filename and snapshot_output_filename
+             are given, the counts of the input snapshot are multiplied by
+             this (between 0 and 1) and added to those of the output
+    max_memory -- if non-zero, memory budget in bytes: the number of samplers
+                  and threads is reduced, and the directions are aligned one
+                  after the other, as needed to fit the estimated memory use
+                  into this, and MemoryError is raised if that is not enough
+                  (see plan_resources())
+    max_threads -- if non-zero, budget for the total number of threads,
+                   handled like max_memory
+    query_source_filename -- if given (with query_target_filename), the
+                             source text of sentences which are aligned
+                             using the model trained on the input, without
+                             contributing to it: only the links and scores
+                             of these are written, and the input sentences
+                             are only sampled as needed for training
+    query_target_filename -- target text of the query sentences
+    binary_links -- if True, the links are written in the binary format
+                    (see read_binary_links() in the eflomal module) rather
+                    than as text
+    dedup -- if True, identical sentence pairs of the input are aligned
+             once, with their statistics weighted by the number of copies
+             (the links and scores are still written for every line)
     """
 
-    with open(source_filename, 'rb') as f:
-        n_sentences = int(f.readline().split()[0])
+    n_sentences = read_n_sentences(source_filename)
 
     if n_iterations is None:
-        iters = max(2, int(round(
-            rel_iterations*5000 / math.sqrt(n_sentences))))
-        iters4 = max(1, iters//4)
-        if model == 1:
-            n_iterations = (iters, 0, 0)
-        elif model == 2:
-            n_iterations = (max(2, iters4), iters, 0)
-        else:
-            n_iterations = (max(2, iters4), iters4, iters)
+        n_iterations = default_n_iterations(
+            model, n_sentences, rel_iterations)
 
     executable = os.path.join(os.path.dirname(__file__), 'bin', 'eflomal')
     args = [executable,
@@ -144,19 +724,84 @@ def align(
             '-s', source_filename,
             '-t', target_filename,
             '-n', str(n_samplers),
+            '--threads', str(n_threads),
             '-N', str(null_prior),
             '-1', str(n_iterations[0])]
     if quiet: args.append('-q')
+    if binary_links: args.append('--binary-links')
+    if dedup: args.append('--dedup')
+    if tolerance > 0: args.extend(['--tolerance', str(tolerance)])
+    if seed is not None: args.extend(['--seed', str(seed)])
+    if decay > 0: args.extend(['--decay', str(decay)])
+    if (query_source_filename is None) != (query_target_filename is None):
+        raise ValueError('both query_source_filename and '
+                         'query_target_filename are needed')
+    if query_source_filename is not None:
+        args.extend(['--query-source', query_source_filename,
+                     '--query-target', query_target_filename])
+    if max_memory or max_threads:
+        # fail before starting the binary if possible, which plans the same
+        # way (with the budget in whole MiB)
+        if max_memory: max_memory = max(1, max_memory >> 20) << 20
+        directions = 0
+        for reverse, links, scores in (
+                (0, links_filename_fwd, scores_filename_fwd),
+                (1, links_filename_rev, scores_filename_rev)):
+            if links or scores or snapshot_output_filename or \
+                    links_filename_sym or \
+                    not (reverse or links_filename_fwd or links_filename_rev):
+                directions |= 1 << reverse
+        try:
+            plan_resources(
+                source_filename, target_filename, n_samplers, n_threads,
+                max_memory, max_threads, directions,
+                bool(snapshot_output_filename or links_filename_sym),
+                priors_filename or snapshot_input_filename)
+        except ValueError:
+            # texts in the text format are only planned by the binary
+            pass
+        if max_memory: args.extend(['--max-memory', str(max_memory >> 20)])
+        if max_threads: args.extend(['--max-threads', str(max_threads)])
     if model >= 2: args.extend(['-2', str(n_iterations[1])])
     if model >= 3: args.extend(['-3', str(n_iterations[2])])
     if links_filename_fwd: args.extend(['-f', links_filename_fwd])
     if links_filename_rev: args.extend(['-r', links_filename_rev])
+    if links_filename_sym:
+        if symmetrization not in SYMMETRIZATION_METHODS:
+            raise ValueError('Unknown symmetrization method: %s' %
+                             symmetrization)
+        args.extend(['-o', links_filename_sym,
+                     '--symmetrize', symmetrization])
     if statistics_filename: args.extend(['-S', statistics_filename])
     if score_model > 0: args.extend(['-M', str(score_model)])
     if scores_filename_fwd: args.extend(['-F', scores_filename_fwd])
     if scores_filename_rev: args.extend(['-R', scores_filename_rev])
     if priors_filename: args.extend(['-p', priors_filename])
+    if snapshot_output_filename:
+        args.extend(['--save-snapshot', snapshot_output_filename])
+    if snapshot_input_filename:
+        args.extend(['--load-snapshot', snapshot_input_filename])
+    if telemetry_filename: args.extend(['--telemetry', telemetry_filename])
+    if progress is None:
+        if not quiet: sys.stderr.write(' '.join(args) + '\n')
+        if use_gdb: args = ['gdb', '-ex=run', '--args'] + args
+        subprocess.run(args, check=True)
+        return
+
+    if telemetry_filename:
+        raise ValueError('progress can not be combined with '
+                         'telemetry_filename')
+    # the records are read from a pipe, which the binary opens through
+    # /dev/fd since it expects a filename
+    read_fd, write_fd = os.pipe()
+    args.extend(['--telemetry', '/dev/fd/%d' % write_fd])
     if not quiet: sys.stderr.write(' '.join(args) + '\n')
     if use_gdb: args = ['gdb', '-ex=run', '--args'] + args
-    subprocess.run(args, check=True)
+    with subprocess.Popen(args, pass_fds=(write_fd,)) as proc:
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'r', encoding='utf-8') as records:
+            for line in records:
+                progress(json.loads(line))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args)
 
@@ -2,8 +2,8 @@
 
 # Usage:
 #  align_symmetrize source.txt target.txt output.moses method [eflomal options]
-# Where method is one of the symmetrization methods from atools (the -c
-# argument).
+# Where method is one of the symmetrization methods of eflomal-align
+# --symmetrize, which are the same as those of atools (the -c argument).
 
 if [ -z $4 ] ; then
     echo "Error: symmetrization argument missing!"
@@ -20,11 +20,7 @@ if [ "$SYMMETRIZATION" == "none" ]; then
 elif [ "$SYMMETRIZATION" == "reverse" ]; then
     python3 $DIR/align.py $OPTIONS --overwrite -s "$1" -t "$2" -r "$3" "${@:5}"
 else
-    FWD=`mktemp`
-    BWD=`mktemp`
     python3 $DIR/align.py $OPTIONS --overwrite -s "$1" -t "$2" \
-        -f "$FWD" -r "$BWD" "${@:5}"
-    atools -c $SYMMETRIZATION -i "$FWD" -j "$BWD" >"$3"
-    rm -f "$FWD" "$BWD"
+        -o "$3" --symmetrize $SYMMETRIZATION "${@:5}"
 fi
 
@@ -10,12 +10,18 @@
 #   time python3 scripts/evaluate.py fast_align test.eng.hin.wa \
 #       test.eng test.hin training.eng training.hin
 #
-# atools (from the fast_align package) must be installed and in $PATH
+# For fast_align, atools (from the fast_align package) must be installed and
+# in $PATH
+#
+# The links are scored by eflomal.evaluate, which gives the same results as
+# 3rdparty/wa_eval_align.pl.
 
 import re, sys, subprocess, os
 from multiprocessing import Pool
 from tempfile import NamedTemporaryFile
 
+from eflomal.evaluate import evaluate, format_scores
+
 RE_NUMBERED = re.compile(r'<s snum=(\d+)>(.*?)</s>\s*$')
 
 def wpteval(align, train_filenames, test_filename, gold_wa):
@@ -60,16 +66,10 @@ def wpteval(align, train_filenames, test_filename, gold_wa):
         outf2.flush()
         align(outf1.name, outf2.name, mosesf.name)
 
-    with NamedTemporaryFile('w', encoding='utf-8') as outf:
-        for lineno in test_numbers:
-            for i,j in map(lambda s: s.split('-'), mosesf.readline().split()):
-                print('%s %d %d' % (lineno, int(i)+1, int(j)+1), file=outf)
-
-        outf.flush()
-        subprocess.call(
-                ['perl', '3rdparty/wa_check_align.pl', outf.name])
-        subprocess.call(
-                ['perl', '3rdparty/wa_eval_align.pl', gold_wa, outf.name])
+    with open(gold_wa, 'r', encoding='utf-8') as goldf:
+        scores = evaluate(goldf, mosesf,
+                          numbers=[int(number) for number in test_numbers])
+    print(format_scores(scores))
 
     mosesf.close()
 
@@ -17,7 +17,11 @@ class build_py(_build_py):
 
 
 cyalign_ext=Extension('eflomal.cython', ['python/eflomal/eflomal.pyx'],
-                      include_dirs=[numpy.get_include()])
+                      include_dirs=[numpy.get_include()],
+                      depends=['src/eflomal.c', 'src/natmap.c', 'src/hash.c',
+                               'src/random.c', 'src/simd_math_prims.h'],
+                      extra_compile_args=['-O3', '-fopenmp'],
+                      extra_link_args=['-fopenmp'])
 
 with open('README.md', 'r') as fh:
     long_description = fh.read()
@@ -43,6 +47,7 @@ setup(
         'eflomal': ['bin/eflomal']
     },
     ext_modules=cythonize(cyalign_ext, language_level='3'),
-    scripts=['python/scripts/eflomal-align', 'python/scripts/eflomal-makepriors'],
+    scripts=['python/scripts/eflomal-align', 'python/scripts/eflomal-makepriors',
+             'python/scripts/eflomal-evaluate'],
     cmdclass={'build_py': build_py}
 )
@@ -1,10 +1,16 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <stdint.h>
+#include <stdarg.h>
 #include <unistd.h>
+#include <getopt.h>
 #include <inttypes.h>
 #include <assert.h>
 #include <time.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <sys/resource.h>
 #include <omp.h>
 
 #ifndef EXACT_MATH
@@ -24,6 +30,14 @@ typedef uint32_t token;
 
 #define NULL_LINK   0xffffU
 
+// Links within the sampler are indexes into sentences of at most
+// MAX_SENT_LEN tokens, but sentences longer than that are split into
+// segments (see struct segmentation), so positions within the original
+// sentences need a wider type
+typedef uint32_t position;
+
+#define NULL_POSITION   0xffffffffU
+
 #define JUMP_ALPHA  0.5
 #define FERT_ALPHA  0.5
 #define LEX_ALPHA   0.001
@@ -47,9 +61,32 @@ typedef double count;
 // distribution per word type, so we need to be a bit strict about its size)
 #define FERT_ARRAY_LEN  0x08
 
-// maximum size of sentences (for fixed-size buffers)
+// maximum length of sentences given to the sampler, longer sentence pairs
+// are split into segments (see struct segmentation)
 #define MAX_SENT_LEN    0x400
 
+// width of the sentence length buckets that determine the order in which
+// sentences are sampled (see text_alignment_order())
+#define LENGTH_BUCKET_WIDTH 0x10
+
+// minimum number of sentences per thread when sampling in parallel
+#define MIN_THREAD_SENTENCES    0x400
+
+// number of consecutive iterations that must satisfy the convergence
+// criterion before a sampler moves on to the next model (see align_sample())
+#define CONVERGENCE_PATIENCE    3
+
+// estimated number of hash table slots per link in the lexical count tables
+// (source_count), used by memory_plan_create(): the tables have at most one
+// item per link, and are resized when they are half full
+#define MAP_SLOTS_PER_LINK      2
+
+// a source word gets a dense row of counts (with one element per target
+// word) instead of a hash table if it is expected to be linked at least once
+// per DENSE_LINK_RATIO target words, so that the row takes at most about as
+// much space as the table (see text_alignment_create())
+#define DENSE_LINK_RATIO        4
+
 #include "random.c"
 #include "hash.c"
 
@@ -67,19 +104,189 @@ typedef double count;
 #define HASH_KEY        hash_u32_u32
 #include "natmap.c"
 
+// maps from (e, f) pairs, used for thread-local count deltas
+#undef MAKE_NAME
+#undef KEY_TYPE
+#undef EMPTY_KEY
+#undef HASH_KEY
+#define MAKE_NAME(NAME) map_pair_u32 ## NAME
+#define KEY_TYPE        uint64_t
+#define EMPTY_KEY       ((uint64_t)0xffffffffffffffffULL)
+#define HASH_KEY        hash_u64_u64
+#include "natmap.c"
+
+static inline uint64_t pair_key(token e, token f) {
+    return ((uint64_t)e << 32) | (uint64_t)f;
+}
+
 #define MIN(x,y)    (((x)<(y))?(x):(y))
 #define MAX(x,y)    (((x)>(y))?(x):(y))
 
-struct sentence {
-    link_t length;
-    token tokens[];
+// Binary text format, written by write_binary_text() in the Python module:
+//
+//  struct text_header
+//  uint64_t offsets[n_sentences+1]    sentence i is tokens[offsets[i]:...]
+//  uint32_t tokens[n_tokens]          (1-based, 0 is reserved for NULL)
+//
+// All values are little-endian. The token array is used directly from a
+// read-only memory map when possible, so no per-sentence data structures are
+// needed. Empty sentences (length 0) are not aligned.
+#define TEXT_MAGIC      "EFLT"
+#define TEXT_VERSION    1
+
+struct text_header {
+    char magic[4];
+    uint32_t version;
+    uint64_t n_sentences;
+    uint64_t n_tokens;
+    // note that this does not include the NULL token
+    uint32_t vocabulary_size;
+    uint32_t max_length;
 };
 
 struct text {
     char *filename;
     size_t n_sentences;
     token vocabulary_size;
-    struct sentence **sentences;
+    size_t n_tokens;
+    // length of the longest sentence
+    size_t max_length;
+    const uint64_t *offsets;
+    const token *tokens;
+    // if non-NULL, offsets and tokens point into this memory map
+    void *map;
+    size_t map_size;
+    // if non-NULL, offsets and tokens point to these buffers owned by the
+    // struct
+    uint64_t *offsets_buf;
+    token *tokens_buf;
+};
+
+static inline size_t text_sentence_length(const struct text *text, size_t i) {
+    return (size_t)(text->offsets[i+1] - text->offsets[i]);
+}
+
+static inline const token *text_sentence_tokens(
+        const struct text *text, size_t i) {
+    return text->tokens + text->offsets[i];
+}
+
+// Sentence pairs where either sentence is longer than MAX_SENT_LEN are split
+// into segments, which are aligned as separate sentence pairs (see
+// segmentation_create()). The links of the segments are put together again
+// when writing the output.
+struct segmentation {
+    // number of lines of the input, with one sentence pair each
+    size_t n_lines;
+    // the first n_training of these are only used for training, and their
+    // links are not written (see main())
+    size_t n_training;
+    // if non-NULL, identical sentence pairs of the input were merged (see
+    // text_deduplicate()), and line i is a copy of sentence lines[i] of the
+    // texts. Otherwise the lines are the sentences.
+    uint64_t *lines;
+    // number of sentences in the texts
+    size_t n_sentences;
+    // segments first[i] up to (not including) first[i+1] belong to sentence
+    // i, or NULL if no sentence was split and the segments are the original
+    // sentences
+    uint64_t *first;
+    // the segmented texts (or the original texts, if first is NULL)
+    const struct text *source;
+    const struct text *target;
+    // if first is non-NULL, source and target point to these, which share
+    // the token arrays of the original texts
+    struct text segments[2];
+    // number of copies of each segment in the input, or NULL if the texts
+    // were not deduplicated
+    uint32_t *weights;
+};
+
+// Return the index of the first segment of sentence i
+static inline size_t segmentation_first(
+        const struct segmentation *seg, size_t i) {
+    return (seg->first == NULL)? i: (size_t)seg->first[i];
+}
+
+// Return the sentence that line i of the input is a copy of (or
+// n_sentences for i = n_lines)
+static inline size_t segmentation_sentence(
+        const struct segmentation *seg, size_t i) {
+    if (seg->lines == NULL) return i;
+    return (i == seg->n_lines)? seg->n_sentences: (size_t)seg->lines[i];
+}
+
+// Dirichlet priors for one alignment direction. These are read once per
+// process (see priors_read() and priors_read_snapshot()) and shared
+// read-only by all samplers of that direction.
+struct priors {
+    token source_vocabulary_size;
+    token target_vocabulary_size;
+    // lexical priors, or NULL if there are none: the priors of source token
+    // e are lex_alphas[i] for target token lex_keys[i], where i ranges from
+    // lex_offsets[e] to lex_offsets[e+1]-1 (sorted by target token)
+    const uint64_t *lex_offsets;
+    const token *lex_keys;
+    const float *lex_alphas;
+    // sum of the lexical priors of each source token, plus LEX_ALPHA for
+    // each target token
+    count *lex_sum;
+    int has_jump;
+    count jump[JUMP_ARRAY_LEN];
+    // fertility priors (indexed by get_fert_index()), or NULL if there are
+    // none
+    count *fert;
+    // if non-NULL, the lexical priors point into this binary priors file,
+    // which is memory-mapped (or read into a buffer if map_is_buffer is
+    // set). It is owned by the forward direction.
+    void *map;
+    size_t map_size;
+    int map_is_buffer;
+    // otherwise, they point to these buffers
+    uint64_t *lex_offsets_buf;
+    token *lex_keys_buf;
+    float *lex_alphas_buf;
+};
+
+// Return the lexical prior of f given e (not including LEX_ALPHA)
+static inline float priors_get_lex(const struct priors *p, token e, token f)
+{
+    size_t lo = p->lex_offsets[e], hi = p->lex_offsets[e+1];
+    while (lo < hi) {
+        const size_t mid = lo + (hi - lo) / 2;
+        const token key = p->lex_keys[mid];
+        if (key == f) return p->lex_alphas[mid];
+        if (key < f) lo = mid + 1;
+        else hi = mid;
+    }
+    return 0.0f;
+}
+
+// Buffers used by text_alignment_sample_range(), with room for the longest
+// sentences of an alignment. Each thread that samples the alignment gets its
+// own set, which is allocated the first time it is needed and kept until
+// the alignment is freed (see text_alignment_buffers()).
+struct sample_buffers {
+    // sentences order_begin up to (not including) order_end, in the order
+    // given by text_alignment_order()
+    size_t *order;
+    size_t order_begin, order_end;
+    // lexical terms (see lex_weight()) of the sentence pair being sampled,
+    // with one row per distinct target token and one column per distinct
+    // source token (and NULL, last)
+    count *lex;
+    // inverse count sums of each distinct source token (and NULL)
+    count *inv_sums;
+    // accumulated distributions for argmax, allocated when first needed
+    count *acc_ps;
+    // distinct tokens of the sentence pair, see sentence_types()
+    size_t *source_types, *target_types;
+    token *source_type_tokens, *target_type_tokens;
+    // hash table used by sentence_types(), a power of two larger than the
+    // longest sentence
+    size_t table_size;
+    token *table_keys;
+    size_t *table_values;
 };
 
 struct text_alignment {
@@ -88,12 +295,16 @@ struct text_alignment {
     const struct text *target;
     link_t **sentence_links;
     link_t *buf;
-    struct map_token_u32 *source_prior;
-    count *source_prior_sum;
-    int has_jump_prior;
-    count jump_prior[JUMP_ARRAY_LEN];
-    count *fert_prior;
+    // NULL if no priors are used, otherwise shared with other samplers
+    const struct priors *priors;
     struct map_token_u32 *source_count;
+    // counts of the first n_dense source words (always including NULL),
+    // stored as dense rows of target->vocabulary_size elements rather than
+    // in source_count. Since the vocabularies are ordered by frequency, see
+    // write_eflomal_text() in the Python module, these are the most frequent
+    // words.
+    uint32_t *dense_counts;
+    token n_dense;
     count *inv_source_count_sum;
     count jump_counts[JUMP_ARRAY_LEN];
     count *fert_counts;
@@ -101,28 +312,162 @@ struct text_alignment {
     // contribute to the statistics (anything after this should still be
     // aligned, but don't trust the statistics):
     size_t n_clean; // 0 (the default) means all sentences should be used
+    // if non-NULL, the number of copies of each sentence in the input (see
+    // text_deduplicate()), which all contribute to the statistics
+    const uint32_t *weights;
+    // sentences sample_begin up to (not including) sample_end are sampled
+    // by text_alignment_sample() and text_alignment_sample_parallel(), by
+    // default all of them
+    size_t sample_begin, sample_end;
     count null_prior;
+    // if non-NULL, changes to source_count are stored here (as deltas to
+    // the read-only source_count) rather than in source_count itself, see
+    // text_alignment_sample_parallel()
+    struct map_pair_u32 *count_delta;
+    // length of the longest source and target sentence, which determines
+    // the size of the buffers used during sampling
+    size_t max_source_length;
+    size_t max_target_length;
+    // number of links (target tokens in sentences that are aligned)
+    size_t n_links;
+    // number of links that changed during the last sampling iteration
+    size_t n_changed;
+    // number of hash table resizes during the last sampling iteration, by
+    // all threads
+    size_t n_resizes;
+    // buffers of the threads sampling this alignment
+    struct sample_buffers *buffers;
+    int n_buffers;
 };
 
+// Return the number of copies of sentence sent, see text_deduplicate()
+static inline uint32_t text_alignment_weight(
+        const struct text_alignment *ta, size_t sent) {
+    return (ta->weights == NULL)? 1: ta->weights[sent];
+}
+
 double seconds(void) {
     struct timespec ts;
     clock_gettime(CLOCK_REALTIME, &ts);
     return 1e-9*(double)ts.tv_nsec + (double)ts.tv_sec;
 }
 
-void text_alignment_free(struct text_alignment *ta) {
-    if (ta->source_prior != NULL) {
-        for (size_t i=0; i<ta->source->vocabulary_size; i++)
-            map_token_u32_clear(ta->source_prior + i);
-        free(ta->source_prior);
-        free(ta->source_prior_sum);
+// Telemetry records are written here if it is non-NULL (see
+// telemetry_write()), with times relative to telemetry_t0
+static FILE *telemetry_file = NULL;
+static double telemetry_t0;
+
+// Return the peak resident set size of the process, in kilobytes
+static long max_rss_kb(void) {
+    struct rusage usage;
+    if (getrusage(RUSAGE_SELF, &usage)) return -1;
+    return usage.ru_maxrss;
+}
+
+// Write a telemetry record as one line of JSON. The format string should
+// produce the fields of the record (without braces), to which the time since
+// the start and the peak RSS are added.
+static void telemetry_write(const char *format, ...) {
+    if (telemetry_file == NULL) return;
+#pragma omp critical(telemetry)
+    {
+        va_list ap;
+        va_start(ap, format);
+        fputc('{', telemetry_file);
+        vfprintf(telemetry_file, format, ap);
+        fprintf(telemetry_file, ", \"time\": %.6f, \"max_rss_kb\": %ld}\n",
+                seconds() - telemetry_t0, max_rss_kb());
+        fflush(telemetry_file);
+        va_end(ap);
+    }
+}
+
+static void sample_buffers_create(
+        struct sample_buffers *buf, size_t max_source_length,
+        size_t max_target_length) {
+    const size_t max_length = MAX(max_source_length, max_target_length);
+    buf->order = NULL;
+    buf->order_begin = buf->order_end = 0;
+    buf->lex = malloc(MAX(1, max_target_length)*(max_source_length+1)*
+                      sizeof(count));
+    buf->inv_sums = malloc((max_source_length+1)*sizeof(count));
+    buf->acc_ps = NULL;
+    buf->source_types = malloc((max_source_length+1)*sizeof(size_t));
+    buf->target_types = malloc(MAX(1, max_target_length)*sizeof(size_t));
+    buf->source_type_tokens = malloc((max_source_length+1)*sizeof(token));
+    buf->target_type_tokens = malloc(MAX(1, max_target_length)*
+                                     sizeof(token));
+    buf->table_size = 1;
+    while (buf->table_size <= 2*max_length) buf->table_size <<= 1;
+    buf->table_keys = calloc(buf->table_size, sizeof(token));
+    buf->table_values = malloc(buf->table_size*sizeof(size_t));
+    if (buf->lex == NULL || buf->inv_sums == NULL ||
+        buf->source_types == NULL || buf->target_types == NULL ||
+        buf->source_type_tokens == NULL || buf->target_type_tokens == NULL ||
+        buf->table_keys == NULL || buf->table_values == NULL)
+    {
+        perror("sample_buffers_create(): failed to allocate buffers");
+        exit(EXIT_FAILURE);
     }
-    if (ta->fert_prior != NULL) {
-        free(ta->fert_prior);
+}
+
+static void sample_buffers_free(struct sample_buffers *buf) {
+    free(buf->order);
+    free(buf->lex);
+    free(buf->inv_sums);
+    free(buf->acc_ps);
+    free(buf->source_types);
+    free(buf->target_types);
+    free(buf->source_type_tokens);
+    free(buf->target_type_tokens);
+    free(buf->table_keys);
+    free(buf->table_values);
+}
+
+// Return the size of the buffers allocated by sample_buffers_create(), plus
+// the argmax buffer if argmax is non-zero
+static size_t sample_buffers_memory(
+        size_t max_source_length, size_t max_target_length, int argmax) {
+    const size_t max_length = MAX(max_source_length, max_target_length);
+    size_t table_size = 1;
+    while (table_size <= 2*max_length) table_size <<= 1;
+    return (size_t)(1 + (argmax != 0))*MAX(1, max_target_length)*
+               (max_source_length+1)*sizeof(count) +
+           (max_source_length+1)*(sizeof(count) + sizeof(size_t) +
+                                  sizeof(token)) +
+           MAX(1, max_target_length)*(sizeof(size_t) + sizeof(token)) +
+           table_size*(sizeof(token) + sizeof(size_t));
+}
+
+// Return the sampling buffers of ta for n threads, allocating the buffers
+// of any threads that do not have them yet. This is called before sampling
+// rather than by the sampling threads.
+static struct sample_buffers *text_alignment_buffers(
+        struct text_alignment *ta, int n) {
+    if (n > ta->n_buffers) {
+        struct sample_buffers *buffers =
+            realloc(ta->buffers, n*sizeof(struct sample_buffers));
+        if (buffers == NULL) {
+            perror("text_alignment_buffers(): failed to allocate buffers");
+            exit(EXIT_FAILURE);
+        }
+        for (int t=ta->n_buffers; t<n; t++)
+            sample_buffers_create(buffers + t, ta->max_source_length,
+                                  ta->max_target_length);
+        ta->buffers = buffers;
+        ta->n_buffers = n;
     }
+    return ta->buffers;
+}
+
+void text_alignment_free(struct text_alignment *ta) {
+    for (int t=0; t<ta->n_buffers; t++)
+        sample_buffers_free(ta->buffers + t);
+    free(ta->buffers);
     for (size_t i=0; i<ta->source->vocabulary_size; i++)
         map_token_u32_clear(ta->source_count + i);
     free(ta->source_count);
+    free(ta->dense_counts);
     free(ta->inv_source_count_sum);
     free(ta->sentence_links);
     free(ta->buf);
@@ -130,31 +475,285 @@ void text_alignment_free(struct text_alignment *ta) {
     free(ta);
 }
 
+// Binary links format, written instead of the text format with -B (see
+// read_binary_links() in the Python module):
+//
+//  struct links_header
+//  uint32_t links[n_links][2]         (source index, target index) pairs
+//  uint64_t offsets[n_sentences+1]    sentence i is links[offsets[i]:...]
+//
+// All values are little-endian. The offsets come last so that the file can
+// be written in one pass (e.g. to a pipe), and n_links follows from the size
+// of the file.
+#define LINKS_MAGIC     "EFLL"
+#define LINKS_VERSION   1
+
+struct links_header {
+    char magic[4];
+    uint32_t version;
+    uint64_t n_sentences;
+};
+
+// Output of links with one line (or entry) per sentence, in the text format
+// (i-j pairs) or the binary format
+struct links_writer {
+    FILE *file;
+    int binary;
+    // text format: no link has been written on the current line yet
+    int first;
+    // binary format: offsets of the sentences written so far, and the
+    // number of links written
+    uint64_t *offsets;
+    size_t n_sentences;
+    size_t sentence;
+    uint64_t n_links;
+};
+
+static void links_writer_init(
+        struct links_writer *w, FILE *file, int binary, size_t n_sentences) {
+    w->file = file;
+    w->binary = binary;
+    w->first = 1;
+    w->offsets = NULL;
+    w->n_sentences = n_sentences;
+    w->sentence = 0;
+    w->n_links = 0;
+    if (!binary) return;
+    if ((w->offsets = malloc((n_sentences+1)*sizeof(uint64_t))) == NULL) {
+        perror("links_writer_init(): failed to allocate offsets");
+        exit(EXIT_FAILURE);
+    }
+    w->offsets[0] = 0;
+    struct links_header header;
+    memcpy(header.magic, LINKS_MAGIC, 4);
+    header.version = LINKS_VERSION;
+    header.n_sentences = n_sentences;
+    fwrite(&header, sizeof(header), 1, file);
+}
+
+static inline void links_writer_add(
+        struct links_writer *w, size_t i, size_t j) {
+    if (w->binary) {
+        // the positions fit, see segmentation_create()
+        const position pair[2] = {(position)i, (position)j};
+        fwrite(pair, sizeof(position), 2, w->file);
+        w->n_links++;
+    } else {
+        fprintf(w->file, w->first? "%zd-%zd": " %zd-%zd", i, j);
+        w->first = 0;
+    }
+}
+
+static void links_writer_end_sentence(struct links_writer *w) {
+    if (w->binary) {
+        w->offsets[++w->sentence] = w->n_links;
+    } else {
+        fputc('\n', w->file);
+        w->first = 1;
+    }
+}
+
+// Write the offsets (in the binary format) and free the writer, but do not
+// close the file
+static void links_writer_finish(struct links_writer *w) {
+    if (w->binary) {
+        assert (w->sentence == w->n_sentences);
+        fwrite(w->offsets, sizeof(uint64_t), w->n_sentences+1, w->file);
+        free(w->offsets);
+    }
+}
+
+// Write the links of ta, with one line per line of the input
 void text_alignment_write_moses(
-        const struct text_alignment *ta, FILE *file, int reverse) {
-    for (size_t sent=0; sent<ta->target->n_sentences; sent++) {
-        if (ta->target->sentences[sent] == NULL ||
-            ta->source->sentences[sent] == NULL) {
-            fputc('\n', file);
-        } else {
-            size_t length = ta->target->sentences[sent]->length;
-            const link_t *links = ta->sentence_links[sent];
-            int first = 1;
+        const struct text_alignment *ta, const struct segmentation *seg,
+        struct links_writer *out, int reverse) {
+    const struct text *source = ta->source;
+    const struct text *target = ta->target;
+    for (size_t line=seg->n_training; line<seg->n_lines; line++) {
+        const size_t sent = segmentation_sentence(seg, line);
+        const size_t first_segment = segmentation_first(seg, sent);
+        const size_t end_segment = segmentation_first(seg, sent+1);
+        for (size_t k=first_segment; k<end_segment; k++) {
+            const link_t *links = ta->sentence_links[k];
+            if (links == NULL) continue;
+            // positions of this segment within the sentence
+            const size_t i0 =
+                source->offsets[k] - source->offsets[first_segment];
+            const size_t j0 =
+                target->offsets[k] - target->offsets[first_segment];
+            size_t length = text_sentence_length(target, k);
             for (size_t j=0; j<length; j++) {
                 if (links[j] != NULL_LINK) {
-                    if (reverse) {
-                        fprintf(file, first? "%d-%d": " %d-%d",
-                                (int)j, (int)links[j]);
-                    } else {
-                        fprintf(file, first? "%d-%d": " %d-%d",
-                                (int)links[j], (int)j);
+                    if (reverse)
+                        links_writer_add(out, j0+j, i0+links[j]);
+                    else
+                        links_writer_add(out, i0+links[j], j0+j);
+                }
+            }
+        }
+        links_writer_end_sentence(out);
+    }
+}
+
+// Symmetrization methods, with the same names as in atools (fast_align)
+enum symmetrization {
+    SYM_INTERSECT,
+    SYM_UNION,
+    SYM_GROW_DIAG,
+    SYM_GROW_DIAG_FINAL,
+    SYM_GROW_DIAG_FINAL_AND,
+    SYM_N_METHODS
+};
+
+static const char *symmetrization_names[SYM_N_METHODS] = {
+    "intersect", "union", "grow-diag", "grow-diag-final",
+    "grow-diag-final-and"
+};
+
+// Return the symmetrization method with the given name, or -1 if there is
+// no such method
+int symmetrization_from_name(const char *name) {
+    if (!strcmp(name, "intersection")) return SYM_INTERSECT;
+    for (int i=0; i<SYM_N_METHODS; i++)
+        if (!strcmp(name, symmetrization_names[i])) return i;
+    return -1;
+}
+
+// flags of the cells in the alignment grid used by symmetrize_grid()
+#define GRID_FWD    1
+#define GRID_REV    2
+#define GRID_SYM    4
+
+static inline void symmetrize_add(
+        uint8_t *grid, size_t n, size_t i, size_t j,
+        uint8_t *source_aligned, uint8_t *target_aligned) {
+    grid[i*n + j] |= GRID_SYM;
+    source_aligned[i] = 1;
+    target_aligned[j] = 1;
+}
+
+// Symmetrize the alignments of a sentence with m source and n target tokens.
+// grid[i*n + j] has the GRID_FWD and GRID_REV flags set for the links of
+// the forward and reverse alignments, and GRID_SYM is set for the links of
+// the symmetrized alignment. This follows the definitions of Koehn et al.
+// (2005), as implemented in atools.
+static void symmetrize_grid(
+        uint8_t *grid, size_t m, size_t n, int method,
+        uint8_t *source_aligned, uint8_t *target_aligned) {
+    const uint8_t both = GRID_FWD | GRID_REV;
+    memset(source_aligned, 0, m);
+    memset(target_aligned, 0, n);
+    for (size_t i=0; i<m; i++) {
+        for (size_t j=0; j<n; j++) {
+            const uint8_t g = grid[i*n + j] & both;
+            if ((method == SYM_UNION)? g != 0: g == both)
+                symmetrize_add(grid, n, i, j, source_aligned, target_aligned);
+        }
+    }
+    if (method == SYM_INTERSECT || method == SYM_UNION) return;
+
+    // grow-diag: add neighbouring links from the union that align a
+    // previously unaligned token, until no more links can be added
+    int added;
+    do {
+        added = 0;
+        for (size_t i=0; i<m; i++) {
+            for (size_t j=0; j<n; j++) {
+                if (!(grid[i*n + j] & GRID_SYM)) continue;
+                for (int di=-1; di<=1; di++) {
+                    for (int dj=-1; dj<=1; dj++) {
+                        if ((di == 0 && dj == 0) ||
+                            (di < 0 && i == 0) || (dj < 0 && j == 0) ||
+                            i+di >= m || j+dj >= n)
+                            continue;
+                        const size_t i1 = i+di, j1 = j+dj;
+                        const uint8_t g = grid[i1*n + j1];
+                        if ((g & both) && !(g & GRID_SYM) &&
+                            (!source_aligned[i1] || !target_aligned[j1]))
+                        {
+                            symmetrize_add(grid, n, i1, j1,
+                                           source_aligned, target_aligned);
+                            added = 1;
+                        }
                     }
-                    first = 0;
                 }
             }
-            fputc('\n', file);
         }
+    } while (added);
+    if (method == SYM_GROW_DIAG) return;
+
+    // final(-and): add the remaining links of the forward, then the reverse
+    // alignment, where either (or, for final-and, both) tokens are
+    // unaligned
+    for (uint8_t flag=GRID_FWD; flag<=GRID_REV; flag <<= 1) {
+        for (size_t i=0; i<m; i++) {
+            for (size_t j=0; j<n; j++) {
+                const uint8_t g = grid[i*n + j];
+                if (!(g & flag) || (g & GRID_SYM)) continue;
+                if ((method == SYM_GROW_DIAG_FINAL_AND)
+                        ? (!source_aligned[i] && !target_aligned[j])
+                        : (!source_aligned[i] || !target_aligned[j]))
+                    symmetrize_add(grid, n, i, j,
+                                   source_aligned, target_aligned);
+            }
+        }
+    }
+}
+
+// Write the symmetrization of the forward alignment ta_fwd (of seg->source
+// to seg->target) and the reverse alignment ta_rev (of seg->target to
+// seg->source), in the same format as text_alignment_write_moses() but with
+// the links ordered by source index.
+void text_alignment_write_symmetrized(
+        const struct text_alignment *ta_fwd,
+        const struct text_alignment *ta_rev,
+        const struct segmentation *seg, int method,
+        struct links_writer *out) {
+    const struct text *source = ta_fwd->source;
+    const struct text *target = ta_fwd->target;
+    const size_t max_m = ta_fwd->max_source_length;
+    const size_t max_n = ta_fwd->max_target_length;
+    uint8_t *grid = malloc(MAX(1, max_m*max_n));
+    uint8_t *source_aligned = malloc(max_m+1);
+    uint8_t *target_aligned = malloc(max_n+1);
+    if (grid == NULL || source_aligned == NULL || target_aligned == NULL) {
+        perror("text_alignment_write_symmetrized(): failed to allocate "
+               "alignment grid");
+        exit(EXIT_FAILURE);
+    }
+    for (size_t line=seg->n_training; line<seg->n_lines; line++) {
+        const size_t sent = segmentation_sentence(seg, line);
+        const size_t first_segment = segmentation_first(seg, sent);
+        const size_t end_segment = segmentation_first(seg, sent+1);
+        for (size_t k=first_segment; k<end_segment; k++) {
+            const link_t *fwd = ta_fwd->sentence_links[k];
+            const link_t *rev = ta_rev->sentence_links[k];
+            if (fwd == NULL || rev == NULL) continue;
+            const size_t m = text_sentence_length(source, k);
+            const size_t n = text_sentence_length(target, k);
+            const size_t i0 =
+                source->offsets[k] - source->offsets[first_segment];
+            const size_t j0 =
+                target->offsets[k] - target->offsets[first_segment];
+            memset(grid, 0, m*n);
+            for (size_t j=0; j<n; j++)
+                if (fwd[j] != NULL_LINK) grid[fwd[j]*n + j] |= GRID_FWD;
+            for (size_t i=0; i<m; i++)
+                if (rev[i] != NULL_LINK) grid[i*n + rev[i]] |= GRID_REV;
+            symmetrize_grid(grid, m, n, method,
+                            source_aligned, target_aligned);
+            for (size_t i=0; i<m; i++) {
+                for (size_t j=0; j<n; j++) {
+                    if (grid[i*n + j] & GRID_SYM)
+                        links_writer_add(out, i0+i, j0+j);
+                }
+            }
+        }
+        links_writer_end_sentence(out);
     }
+    free(grid);
+    free(source_aligned);
+    free(target_aligned);
 }
 
 //void text_alignment_write_vocab(const struct text_alignment *ta, FILE *file) {
@@ -214,115 +813,294 @@ inline static size_t get_fert_index(size_t e, int fert) {
     return e*FERT_ARRAY_LEN + (size_t)MIN(fert, FERT_ARRAY_LEN-1);
 }
 
-void text_alignment_sample(
-        struct text_alignment *ta, random_state *state,
-        count *sentence_scores, struct text_alignment **tas,
-        int n_samplers) {
-    const int n_samples = 1;
-    const int argmax = tas != NULL;
-    const int model = ta->model;
-    struct sentence **source_sentences = ta->source->sentences;
-    struct sentence **target_sentences = ta->target->sentences;
-    // probability distribution to sample from
-    count ps[MAX_SENT_LEN+1];
+inline static uint32_t *get_dense_count(
+        const struct text_alignment *ta, token e, token f)
+{
+    return ta->dense_counts + (size_t)e*ta->target->vocabulary_size + f;
+}
+
+// Get the number of times f is currently aligned to e
+inline static uint32_t get_count(struct text_alignment *ta, token e, token f)
+{
+    uint32_t n = 0;
+    if (e < ta->n_dense)
+        n = *get_dense_count(ta, e, f);
+    else
+        map_token_u32_get(ta->source_count + e, f, &n);
+    if (ta->count_delta != NULL) {
+        uint32_t delta = 0;
+        map_pair_u32_get(ta->count_delta, pair_key(e, f), &delta);
+        n += delta;
+    }
+    return n;
+}
+
+// Add delta (possibly negative, as in (uint32_t)-1) to the count of f being
+// aligned to e, and return the new count
+inline static uint32_t add_count(
+        struct text_alignment *ta, token e, token f, uint32_t delta)
+{
+    if (ta->count_delta == NULL) {
+        if (e < ta->n_dense)
+            return *get_dense_count(ta, e, f) += delta;
+        return map_token_u32_add(ta->source_count + e, f, delta);
+    }
+    uint32_t n = 0;
+    if (e < ta->n_dense)
+        n = *get_dense_count(ta, e, f);
+    else
+        map_token_u32_get(ta->source_count + e, f, &n);
+    return n + map_pair_u32_add(ta->count_delta, pair_key(e, f), delta);
+}
+
+// Remove the (zero) count of f being aligned to e, to save space
+inline static void remove_count(struct text_alignment *ta, token e, token f)
+{
+    if (ta->count_delta == NULL) {
+        if (e < ta->n_dense) return;
+        int r = map_token_u32_delete(ta->source_count + e, f);
+        assert (r);
+    } else {
+        // the delta can only be removed if there is no global count
+        uint32_t delta = 1;
+        map_pair_u32_get(ta->count_delta, pair_key(e, f), &delta);
+        if (delta == 0) map_pair_u32_delete(ta->count_delta, pair_key(e, f));
+    }
+}
+
+// The fertility distributions (unlike the jump and lexical distributions)
+// are sampled explicitly, and the categorical distributions are fixed
+// throughout the iteration. This samples them for model 3, and needs to be
+// done before the sentences are sampled in each iteration.
+static void text_alignment_sample_fert(
+        struct text_alignment *ta, random_state *state) {
+    const struct text *source = ta->source;
+    const struct text *target = ta->target;
     // fertility of tokens in sentence
-    int fert[MAX_SENT_LEN];
-    count *jump_counts = ta->jump_counts;
+    int fert[ta->max_source_length+1];
     count *fert_counts = ta->fert_counts;
     const size_t n_sentences =
         ta->n_clean? ta->n_clean: ta->target->n_sentences;
 
-    // the fertility distributions (unlike the jump and lexical distributions)
-    // are sampled explicitly, and the categorical distributions are fixed
-    // throughout the iteration.
-    if (model >= 3) {
-        size_t *e_count = malloc(sizeof(size_t)*ta->source->vocabulary_size);
-        if (e_count == NULL) {
-            perror("text_alignment_sample(): unable to allocate e_count");
-            exit(1);
-        }
+    size_t *e_count = malloc(sizeof(size_t)*ta->source->vocabulary_size);
+    if (e_count == NULL) {
+        perror("text_alignment_sample(): unable to allocate e_count");
+        exit(1);
+    }
 
-        for (size_t i=0; i<ta->source->vocabulary_size; i++)
-            e_count[i] = 0;
+    for (size_t i=0; i<ta->source->vocabulary_size; i++)
+        e_count[i] = 0;
 
-        if (ta->fert_prior != NULL) {
-            // TODO: decide on whether to add FERT_ALPHA
-            // TODO: 0 or 1-based? NULL included?
-            for (size_t i=0; i<FERT_ARRAY_LEN*ta->source->vocabulary_size; i++)
-            {
-                fert_counts[i] = ta->fert_prior[i] + (count) FERT_ALPHA;
-            }
-        } else {
-            for (size_t i=0; i<FERT_ARRAY_LEN*ta->source->vocabulary_size; i++)
-                fert_counts[i] = (count) FERT_ALPHA;
+    if (ta->priors != NULL && ta->priors->fert != NULL) {
+        // TODO: decide on whether to add FERT_ALPHA
+        // TODO: 0 or 1-based? NULL included?
+        for (size_t i=0; i<FERT_ARRAY_LEN*ta->source->vocabulary_size; i++)
+        {
+            fert_counts[i] = ta->priors->fert[i] + (count) FERT_ALPHA;
         }
+    } else {
+        for (size_t i=0; i<FERT_ARRAY_LEN*ta->source->vocabulary_size; i++)
+            fert_counts[i] = (count) FERT_ALPHA;
+    }
 
-        // go through the text and compute fertility statistics
-        for (size_t sent=0; sent<n_sentences; sent++) {
-            link_t *links = ta->sentence_links[sent];
-            // in case this sentence pair should not be aligned, skip it
-            if (links == NULL) continue;
-            const struct sentence *source_sentence = source_sentences[sent];
-            const struct sentence *target_sentence = target_sentences[sent];
-            const size_t source_length = source_sentence->length;
-            const size_t target_length = target_sentence->length;
-            const token *source_tokens = source_sentence->tokens;
-
-            for (size_t i=0; i<source_length; i++)
-                fert[i] = 0;
-            for (size_t j=0; j<target_length; j++)
-                if (links[j] != NULL_LINK)
-                    fert[links[j]]++;
-            for (size_t i=0; i<source_length; i++) {
-                e_count[source_tokens[i]]++;
-                fert_counts[get_fert_index(source_tokens[i], fert[i])] += 1.0;
-            }
+    // go through the text and compute fertility statistics
+    for (size_t sent=0; sent<n_sentences; sent++) {
+        link_t *links = ta->sentence_links[sent];
+        // in case this sentence pair should not be aligned, skip it
+        if (links == NULL) continue;
+        const size_t source_length = text_sentence_length(source, sent);
+        const size_t target_length = text_sentence_length(target, sent);
+        const token *source_tokens = text_sentence_tokens(source, sent);
+        const uint32_t weight = text_alignment_weight(ta, sent);
+
+        for (size_t i=0; i<source_length; i++)
+            fert[i] = 0;
+        for (size_t j=0; j<target_length; j++)
+            if (links[j] != NULL_LINK)
+                fert[links[j]]++;
+        for (size_t i=0; i<source_length; i++) {
+            e_count[source_tokens[i]] += weight;
+            fert_counts[get_fert_index(source_tokens[i], fert[i])] +=
+                (count)weight;
         }
+    }
 
-        // sample a categorical fertility distribution from the posterior
-        // for each source word e.
-        //
-        // since we only ever want to use
-        //      P(phi(i)) / P(phi(i)-1)
-        // position i directly stores this value.
-        // Index 0 is undefined, and the maximum value contains a very
-        // low probability (because it should never be used).
-        for (token e=1; e<ta->source->vocabulary_size; e++) {
-            // skip vocabulary items that do not actually occur in this text
-            if (e_count[e] == 0) continue;
-            count alpha[FERT_ARRAY_LEN];
-            count *buf = fert_counts + get_fert_index(e, 0);
-            memcpy(alpha, buf, FERT_ARRAY_LEN*sizeof(count));
+    // sample a categorical fertility distribution from the posterior
+    // for each source word e.
+    //
+    // since we only ever want to use
+    //      P(phi(i)) / P(phi(i)-1)
+    // position i directly stores this value.
+    // Index 0 is undefined, and the maximum value contains a very
+    // low probability (because it should never be used).
+    for (token e=1; e<ta->source->vocabulary_size; e++) {
+        // skip vocabulary items that do not actually occur in this text
+        if (e_count[e] == 0) continue;
+        count alpha[FERT_ARRAY_LEN];
+        count *buf = fert_counts + get_fert_index(e, 0);
+        memcpy(alpha, buf, FERT_ARRAY_LEN*sizeof(count));
 #if COUNT_BITS == 32
-            random_dirichlet32_unnormalized(state, FERT_ARRAY_LEN, alpha, buf);
+        random_dirichlet32_unnormalized(state, FERT_ARRAY_LEN, alpha, buf);
 #else
-            random_dirichlet64_unnormalized(state, FERT_ARRAY_LEN, alpha, buf);
+        random_dirichlet64_unnormalized(state, FERT_ARRAY_LEN, alpha, buf);
 #endif
-            buf[FERT_ARRAY_LEN-1] = (count) 1e-10;
-            for (size_t i=FERT_ARRAY_LEN-2; i; i--)
-                buf[i] /= buf[i-1];
-        }
+        buf[FERT_ARRAY_LEN-1] = (count) 1e-10;
+        for (size_t i=FERT_ARRAY_LEN-2; i; i--)
+            buf[i] /= buf[i-1];
+    }
+
+    free(e_count);
+}
+
+// Write the indexes sent_begin up to (not including) sent_end to order,
+// sorted by the length of the target sentences in buckets of
+// LENGTH_BUCKET_WIDTH tokens (and by index within each bucket). Sampling
+// sentences of similar length after each other means that the same parts of
+// the sampling buffers and jump distribution stay in the cache.
+static void text_alignment_order(
+        const struct text_alignment *ta, size_t sent_begin, size_t sent_end,
+        size_t *order) {
+    const size_t n_buckets = ta->max_target_length/LENGTH_BUCKET_WIDTH + 1;
+    size_t *bucket_start = calloc(n_buckets+1, sizeof(size_t));
+    if (bucket_start == NULL) {
+        perror("text_alignment_order(): failed to allocate buckets");
+        exit(EXIT_FAILURE);
+    }
+    for (size_t sent=sent_begin; sent<sent_end; sent++)
+        bucket_start[1 + text_sentence_length(ta->target, sent) /
+                         LENGTH_BUCKET_WIDTH]++;
+    for (size_t i=1; i<n_buckets; i++)
+        bucket_start[i] += bucket_start[i-1];
+    for (size_t sent=sent_begin; sent<sent_end; sent++)
+        order[bucket_start[text_sentence_length(ta->target, sent) /
+                           LENGTH_BUCKET_WIDTH]++] = sent;
+    free(bucket_start);
+}
+
+// The lexical term (prior plus count) of f being aligned to e, as used in the
+// sampling distribution. Index 0 is NULL.
+inline static count lex_weight(
+        const struct priors *lex_priors, token e, token f, uint32_t n)
+{
+    if (e == 0) return (count)NULL_ALPHA + (count)n;
+    if (lex_priors != NULL)
+        return (count)(priors_get_lex(lex_priors, e, f) + LEX_ALPHA) +
+               (count)n;
+    return (count)LEX_ALPHA + (count)n;
+}
 
-        free(e_count);
+// Number the distinct tokens of a sentence in order of first occurrence:
+// types[i] is the number of the token at position i, and type_tokens[t] the
+// token numbered t. The tokens are looked up in the hash table of buf, which
+// is empty before and after. Returns the number of distinct tokens.
+static size_t sentence_types(
+        struct sample_buffers *buf, const token *tokens, size_t length,
+        size_t *types, token *type_tokens)
+{
+    token *keys = buf->table_keys;
+    size_t *values = buf->table_values;
+    const size_t mask = buf->table_size - 1;
+    size_t n_types = 0;
+    for (size_t i=0; i<length; i++) {
+        // tokens are never 0 (NULL), which marks empty slots
+        size_t slot = hash_u32_u32(tokens[i]) & mask;
+        while (keys[slot] != 0 && keys[slot] != tokens[i])
+            slot = (slot+1) & mask;
+        if (keys[slot] == 0) {
+            keys[slot] = tokens[i];
+            values[slot] = n_types;
+            type_tokens[n_types++] = tokens[i];
+        }
+        types[i] = values[slot];
     }
+    // Empty the table in the reverse order of insertion, so that the slots
+    // probed when inserting a token are still occupied when it is removed
+    for (size_t t=n_types; t>0; t--) {
+        size_t slot = hash_u32_u32(type_tokens[t-1]) & mask;
+        while (keys[slot] != type_tokens[t-1])
+            slot = (slot+1) & mask;
+        keys[slot] = 0;
+    }
+    return n_types;
+}
+
+// Sample the alignments of sentences sent_begin up to (not including)
+// sent_end, in the order given by text_alignment_order(), using the buffers
+// buf of the calling thread. See text_alignment_sample() for the other
+// arguments.
+static void text_alignment_sample_range(
+        struct text_alignment *ta, struct sample_buffers *buf,
+        random_state *state, count *sentence_scores,
+        struct text_alignment **tas, int n_samplers,
+        size_t sent_begin, size_t sent_end) {
+    const int n_samples = 1;
+    const int argmax = tas != NULL;
+    const int model = ta->model;
+    const struct text *source = ta->source;
+    const struct text *target = ta->target;
+    // probability distribution to sample from
+    count ps[ta->max_source_length+1];
+    // fertility of tokens in sentence
+    int fert[ta->max_source_length+1];
+    count *jump_counts = ta->jump_counts;
+    count *fert_counts = ta->fert_counts;
+    const struct priors *lex_priors =
+        (ta->priors != NULL && ta->priors->lex_offsets != NULL)
+        ? ta->priors : NULL;
+    const size_t n_sentences =
+        ta->n_clean? ta->n_clean: ta->target->n_sentences;
 
-    count *acc_ps = NULL;
-    if (argmax) acc_ps = malloc(MAX_SENT_LEN*(MAX_SENT_LEN+1)*sizeof(count));
+    if (argmax && buf->acc_ps == NULL) {
+        buf->acc_ps = malloc(ta->max_target_length*(ta->max_source_length+1)*
+                             sizeof(count));
+        if (buf->acc_ps == NULL) {
+            perror("text_alignment_sample(): failed to allocate acc_ps");
+            exit(EXIT_FAILURE);
+        }
+    }
+    count *acc_ps = buf->acc_ps;
+    // The lexical terms of the sentence pair being sampled are gathered into
+    // lex and inv_sums once per sentence (and sampler), and then kept up to
+    // date as the counts change, so that the sampling distributions are
+    // computed without looking up any counts.
+    count *lex = buf->lex;
+    count *inv_sums = buf->inv_sums;
+    size_t *source_types = buf->source_types;
+    size_t *target_types = buf->target_types;
+    token *source_type_tokens = buf->source_type_tokens;
+    token *target_type_tokens = buf->target_type_tokens;
+    if (buf->order_begin != sent_begin || buf->order_end != sent_end) {
+        size_t *order = realloc(buf->order,
+                                MAX(1, sent_end-sent_begin)*sizeof(size_t));
+        if (order == NULL) {
+            perror("text_alignment_sample(): failed to allocate order");
+            exit(EXIT_FAILURE);
+        }
+        text_alignment_order(ta, sent_begin, sent_end, order);
+        buf->order = order;
+        buf->order_begin = sent_begin;
+        buf->order_end = sent_end;
+    }
+    const size_t *order = buf->order;
     // aa_jp1_table[j] will contain the alignment of the nearest non-NULL
     // aligned word to the right (or source_sentence->length if there is no
     // such word)
-    int aa_jp1_table[MAX_SENT_LEN];
+    int aa_jp1_table[ta->max_target_length+1];
     int aa_jp1;
-    for (size_t sent=0; sent<ta->target->n_sentences; sent++) {
+    size_t n_changed = 0;
+    for (size_t k=0; k<sent_end-sent_begin; k++) {
+        const size_t sent = order[k];
         link_t *links = ta->sentence_links[sent];
         // in case this sentence pair should not be aligned, skip it
         if (links == NULL) continue;
-        const struct sentence *source_sentence = source_sentences[sent];
-        const struct sentence *target_sentence = target_sentences[sent];
-        const size_t source_length = source_sentence->length;
-        const size_t target_length = target_sentence->length;
-        const token *source_tokens = source_sentence->tokens;
-        const token *target_tokens = target_sentence->tokens;
+        const size_t source_length = text_sentence_length(source, sent);
+        const size_t target_length = text_sentence_length(target, sent);
+        const token *source_tokens = text_sentence_tokens(source, sent);
+        const token *target_tokens = text_sentence_tokens(target, sent);
+        // all copies of the sentence pair have the same links, so the
+        // counts change by this much for each link
+        const uint32_t weight = text_alignment_weight(ta, sent);
+        const count c_weight = (count)weight;
 
         int samples_left = n_samples-1;
         int samplers_left = n_samplers-1;
@@ -332,6 +1110,17 @@ void text_alignment_sample(
                 acc_ps[k] = (count) 0.0;
         }
 
+        const size_t n_source_types = sentence_types(
+                buf, source_tokens, source_length, source_types,
+                source_type_tokens);
+        const size_t n_target_types = sentence_types(
+                buf, target_tokens, target_length, target_types,
+                target_type_tokens);
+        const size_t stride = n_source_types+1;
+        // NULL is the last source type
+        source_types[source_length] = n_source_types;
+        source_type_tokens[n_source_types] = 0;
+
         // This is the head of a loop (look for gotos below) which iterates
         // n_samples * n_samplers times, accumulating distributions from the
         // independent samplers.
@@ -340,6 +1129,16 @@ resample:;
         size_t acc_base = 0;
         links = ta->sentence_links[sent];
 
+        for (size_t s=0; s<stride; s++) {
+            const token e = source_type_tokens[s];
+            inv_sums[s] = ta->inv_source_count_sum[e];
+            for (size_t t=0; t<n_target_types; t++) {
+                const token f = target_type_tokens[t];
+                lex[t*stride + s] = lex_weight(
+                        lex_priors, e, f, get_count(ta, e, f));
+            }
+        }
+
         // if HMM model is used:
         if (model >= 2) {
             // initialize table of nearest non-NULL alignment to the right
@@ -377,14 +1176,21 @@ resample:;
                     fert[old_i]--;
             }
 
+            // the lexical terms of f, and the column of old_e
+            count *lex_row = lex + target_types[j]*stride;
+            const size_t old_s = source_types[
+                (old_i == NULL_LINK)? source_length: (size_t)old_i];
+
             uint32_t reduced_count = 0;
             if (sent < n_sentences) {
                 ta->inv_source_count_sum[old_e] =
                       (count)1.0
                     / ((count)1.0/ta->inv_source_count_sum[old_e] -
-                            (count)1.0);
-                reduced_count =
-                    map_token_u32_add(ta->source_count + old_e, f, -1);
+                            c_weight);
+                reduced_count = add_count(ta, old_e, f, -weight);
+                inv_sums[old_s] = ta->inv_source_count_sum[old_e];
+                lex_row[old_s] = lex_weight(lex_priors, old_e, f,
+                                            reduced_count);
                 if (reduced_count & 0x80000000UL) {
                     fprintf(stderr,
                         "old_e = %"PRItoken", n_items = %zd, dynamic = %u\n",
@@ -405,152 +1211,83 @@ resample:;
                 if (links[j] == NULL_LINK) {
                     // if this target token is NULL aligned, only one jump
                     // needs to be removed from the statistics:
-                    jump_counts[JUMP_SUM] -= (count) 1.0;
-                    jump_counts[skip_jump] -= (count) 1.0;
+                    jump_counts[JUMP_SUM] -= c_weight;
+                    jump_counts[skip_jump] -= c_weight;
                 } else {
                     // otherwise, there are two jumps:
                     const size_t old_jump1 = get_jump_index(
                             aa_jm1, links[j], source_length);
                     const size_t old_jump2 = get_jump_index(
                             links[j], aa_jp1, source_length);
-                    jump_counts[JUMP_SUM] -= (count) 2.0;
-                    jump_counts[old_jump1] -= (count) 1.0;
-                    jump_counts[old_jump2] -= (count) 1.0;
+                    jump_counts[JUMP_SUM] -= (count)2.0 * c_weight;
+                    jump_counts[old_jump1] -= c_weight;
+                    jump_counts[old_jump2] -= c_weight;
                 }
             }
 
-            count ps_sum = 0.0;
-            uint32_t null_n = 0;
-            map_token_u32_get(ta->source_count + 0, f, &null_n);
             // for speed, we use separate versions of the inner loop depending
-            // on the model used (in spite of the code redundancy)
+            // on the model used, which fill ps with the (unnormalized)
+            // probabilities of the source positions
             if (model >= 3) {
                 size_t jump1 = get_jump_index(
                         aa_jm1, 0, source_length);
                 size_t jump2 = get_jump_index(
                         0, aa_jp1, source_length);
                 for (size_t i=0; i<source_length; i++) {
-                    const token e = source_tokens[i];
-                    const size_t fert_idx = get_fert_index(e, fert[i]+1);
-                    uint32_t n = 0;
-                    map_token_u32_get(ta->source_count + e, f, &n);
-                    if (ta->source_prior != NULL) {
-                        float alpha = 0.0f;
-                        map_token_u32_get(ta->source_prior + e, f,
-                                          (uint32_t*)&alpha);
-                        alpha += LEX_ALPHA;
-                        ps_sum += ta->inv_source_count_sum[e] *
-                                  ((count)alpha + (count)n) *
-                                  jump_counts[jump1] * jump_counts[jump2] *
-                                  fert_counts[fert_idx];
-                    } else {
-                        ps_sum += ta->inv_source_count_sum[e] *
-                                  (LEX_ALPHA + (count)n) *
-                                  jump_counts[jump1] * jump_counts[jump2] *
-                                  fert_counts[fert_idx];
-                    }
-                    ps[i] = ps_sum;
+                    const size_t fert_idx =
+                        get_fert_index(source_tokens[i], fert[i]+1);
+                    const size_t s = source_types[i];
+                    ps[i] = inv_sums[s] * lex_row[s] *
+                            jump_counts[jump1] * jump_counts[jump2] *
+                            fert_counts[fert_idx];
                     // We can same a few cycles by replacing calls to
                     // get_jump_index() with bounded increment/decrement
                     // operations of the jump length distribution indexes
                     jump1 = MIN(JUMP_ARRAY_LEN-1, jump1+1);
                     jump2 = MAX(0, jump2-1);
                 }
-                if (sentence_scores != NULL) {
-                    count max_p = 0.0;
-                    for (size_t i=0; i<source_length; i++) {
-                        const count p = ps[i] - (i? ps[i-1]: 0.0);
-                        if (p > max_p) max_p = p;
-                    }
-                    sentence_scores[sent] += logf(
-                            max_p / ((count)jump_counts[JUMP_SUM]*
-                                     (count)jump_counts[JUMP_SUM]));
-                }
-                // rather than scaling the non-NULL probabilities with Z^-2
-                // for the jump distribution normalization factor Z, we scale
-                // the NULL probability with Z^1 instead, since the sampling
-                // distribution will be normalized anyway.
-                // Beware of this if you ever make modifications here!
-                ps_sum += ta->null_prior * ta->inv_source_count_sum[0] *
-                          (NULL_ALPHA +(count)null_n) *
-                          jump_counts[JUMP_SUM] * jump_counts[skip_jump];
             } else if (model >= 2) {
                 size_t jump1 = get_jump_index(
                         aa_jm1, 0, source_length);
                 size_t jump2 = get_jump_index(
                         0, aa_jp1, source_length);
                 for (size_t i=0; i<source_length; i++) {
-                    const token e = source_tokens[i];
-                    uint32_t n = 0;
-                    map_token_u32_get(ta->source_count + e, f, &n);
-                    if (ta->source_prior != NULL) {
-                        float alpha = 0.0f;
-                        map_token_u32_get(ta->source_prior + e, f,
-                                          (uint32_t*)&alpha);
-                        alpha += LEX_ALPHA;
-                        ps_sum += ta->inv_source_count_sum[e] *
-                                  (alpha + (count)n) *
-                                  jump_counts[jump1] * jump_counts[jump2];
-                    } else {
-                        ps_sum += ta->inv_source_count_sum[e] *
-                                  (LEX_ALPHA + (count)n) *
-                                  jump_counts[jump1] * jump_counts[jump2];
-                    }
-                    ps[i] = ps_sum;
-                    // We can same a few cycles by replacing calls to
-                    // get_jump_index() with bounded increment/decrement
-                    // operations of the jump length distribution indexes
+                    const size_t s = source_types[i];
+                    ps[i] = inv_sums[s] * lex_row[s] *
+                            jump_counts[jump1] * jump_counts[jump2];
                     jump1 = MIN(JUMP_ARRAY_LEN-1, jump1+1);
                     jump2 = MAX(0, jump2-1);
                 }
-                if (sentence_scores != NULL) {
-                    count max_p = 0.0;
-                    for (size_t i=0; i<source_length; i++) {
-                        const count p = ps[i] - (i? ps[i-1]: 0.0);
-                        if (p > max_p) max_p = p;
-                    }
-                    sentence_scores[sent] += logf(
-                            max_p / ((count)jump_counts[JUMP_SUM]*
-                                     (count)jump_counts[JUMP_SUM]));
-                }
-                // rather than scaling the non-NULL probabilities with Z^-2
-                // for the jump distribution normalization factor Z, we scale
-                // the NULL probability with Z^1 instead, since the sampling
-                // distribution will be normalized anyway.
-                // Beware of this if you ever make modifications here!
-                ps_sum += ta->null_prior * ta->inv_source_count_sum[0] *
-                          (NULL_ALPHA + (count)null_n) *
-                          jump_counts[JUMP_SUM] * jump_counts[skip_jump];
             } else {
                 for (size_t i=0; i<source_length; i++) {
-                    const token e = source_tokens[i];
-                    uint32_t n = 0;
-                    map_token_u32_get(ta->source_count + e, f, &n);
-                    if (ta->source_prior != NULL) {
-                        float alpha = 0.0f;
-                        map_token_u32_get(ta->source_prior + e, f,
-                                          (uint32_t*)&alpha);
-                        alpha += LEX_ALPHA;
-                        ps_sum += ta->inv_source_count_sum[e] *
-                                  (alpha + (count)n);
-                    } else {
-                        ps_sum += ta->inv_source_count_sum[e] *
-                                  (LEX_ALPHA + (count)n);
-                    }
-                    ps[i] = ps_sum;
-                }
-                if (sentence_scores != NULL) {
-                    count max_p = 0.0;
-                    for (size_t i=0; i<source_length; i++) {
-                        const count p = ps[i] - (i? ps[i-1]: 0.0);
-                        if (p > max_p) max_p = p;
-                    }
-                    sentence_scores[sent] += logf(max_p);
+                    const size_t s = source_types[i];
+                    ps[i] = inv_sums[s] * lex_row[s];
                 }
-                ps_sum += ta->null_prior * ta->inv_source_count_sum[0] *
-                          (NULL_ALPHA + (count)null_n);
             }
-            ps[source_length] = ps_sum;
+            if (sentence_scores != NULL) {
+                count max_p = 0.0;
+                for (size_t i=0; i<source_length; i++)
+                    if (ps[i] > max_p) max_p = ps[i];
+                if (model >= 2)
+                    max_p /= (count)jump_counts[JUMP_SUM]*
+                             (count)jump_counts[JUMP_SUM];
+                sentence_scores[sent] += logf(max_p);
+            }
+            ps[source_length] = ta->null_prior * inv_sums[n_source_types] *
+                                lex_row[n_source_types];
+            // rather than scaling the non-NULL probabilities with Z^-2
+            // for the jump distribution normalization factor Z, we scale
+            // the NULL probability with Z^1 instead, since the sampling
+            // distribution will be normalized anyway.
+            // Beware of this if you ever make modifications here!
+            if (model >= 2)
+                ps[source_length] *= jump_counts[JUMP_SUM] *
+                                     jump_counts[skip_jump];
+            count ps_sum = 0.0;
+            for (size_t i=0; i<source_length+1; i++) {
+                ps_sum += ps[i];
+                ps[i] = ps_sum;
+            }
 
             if (argmax) {
                 count scale = (count)1.0 / ps_sum;
@@ -598,33 +1335,36 @@ resample:;
                 if (model >= 3)
                     fert[new_i]++;
             }
+            if (links[j] != old_i) n_changed++;
 
             if (sent < n_sentences) {
                 if (old_e != new_e && reduced_count == 0) {
                     // If we reduced the old count to zero and we sampled a
                     // link to a different source token, remove the old zero
                     // count in order to save space.
-                    int r = map_token_u32_delete(ta->source_count + old_e, f);
-                    assert (r);
+                    remove_count(ta, old_e, f);
                 }
                 ta->inv_source_count_sum[new_e] =
                       (count)1.0
-                    / ((count)1.0/ta->inv_source_count_sum[new_e] + (count)1.0);
-                map_token_u32_add(ta->source_count + new_e, f, 1);
+                    / ((count)1.0/ta->inv_source_count_sum[new_e] + c_weight);
+                const uint32_t n = add_count(ta, new_e, f, weight);
+                const size_t new_s = source_types[new_i];
+                inv_sums[new_s] = ta->inv_source_count_sum[new_e];
+                lex_row[new_s] = lex_weight(lex_priors, new_e, f, n);
             }
 
             if (sent < n_sentences && model >= 2) {
                 if (new_e == 0) {
-                    jump_counts[JUMP_SUM] += (count) 1.0;
-                    jump_counts[skip_jump] += (count) 1.0;
+                    jump_counts[JUMP_SUM] += c_weight;
+                    jump_counts[skip_jump] += c_weight;
                 } else {
                     const size_t new_jump1 = get_jump_index(
                             aa_jm1, new_i, source_length);
                     const size_t new_jump2 = get_jump_index(
                             new_i, aa_jp1, source_length);
-                    jump_counts[JUMP_SUM] += (count) 2.0;
-                    jump_counts[new_jump1] += (count) 1.0;
-                    jump_counts[new_jump2] += (count) 1.0;
+                    jump_counts[JUMP_SUM] += (count)2.0 * c_weight;
+                    jump_counts[new_jump1] += c_weight;
+                    jump_counts[new_jump2] += c_weight;
                 }
             }
             if (model >= 2 && new_e != 0)
@@ -644,13 +1384,170 @@ resample:;
             }
         }
     }
-    if (argmax) free(acc_ps);
+    if (!argmax) ta->n_changed = n_changed;
+}
+
+// Perform one sampling iteration over all sentences.
+//
+// If sentence_scores is non-NULL, no sampling is done but the score of each
+// sentence under the current model is added to it. If tas is non-NULL, the
+// n_samplers alignments in tas are combined and the argmax alignment is
+// stored in tas[0] (which should be the same as ta).
+void text_alignment_sample(
+        struct text_alignment *ta, random_state *state,
+        count *sentence_scores, struct text_alignment **tas,
+        int n_samplers) {
+    const size_t n_resizes = map_token_u32_n_resizes + map_pair_u32_n_resizes;
+    if (ta->model >= 3) text_alignment_sample_fert(ta, state);
+    text_alignment_sample_range(ta, text_alignment_buffers(ta, 1), state,
+                                sentence_scores, tas, n_samplers,
+                                ta->sample_begin, ta->sample_end);
+    ta->n_resizes = map_token_u32_n_resizes + map_pair_u32_n_resizes -
+                    n_resizes;
+}
+
+// Return the number of links sampled by text_alignment_sample()
+static size_t text_alignment_n_sampled(const struct text_alignment *ta) {
+    if (ta->sample_begin == 0 && ta->sample_end == ta->target->n_sentences)
+        return ta->n_links;
+    return ta->target->offsets[ta->sample_end] -
+           ta->target->offsets[ta->sample_begin];
+}
+
+// Return the index of the first sentence that starts at or after the given
+// token position
+static size_t text_find_token(const struct text *text, size_t position) {
+    size_t lo = 0, hi = text->n_sentences;
+    while (lo < hi) {
+        const size_t mid = lo + (hi - lo) / 2;
+        if (text->offsets[mid] < position) lo = mid + 1;
+        else hi = mid;
+    }
+    return lo;
+}
+
+// Perform one sampling iteration (like text_alignment_sample() without
+// scores or argmax) using n_threads threads.
+//
+// The sentences are split into one shard per thread, with about the same
+// number of target tokens each. Each thread samples its shard using the
+// lexical and jump counts from the start of the iteration plus its own
+// changes to them, which are kept in thread-local deltas and merged at the
+// end of the iteration. This approximates the sequential sampler, since
+// the threads do not see each others' changes within an iteration. The
+// fertility distributions are fixed during an iteration anyway, so they are
+// shared by all threads.
+void text_alignment_sample_parallel(
+        struct text_alignment *ta, random_state *state, int n_threads) {
+    const size_t vocabulary_size = ta->source->vocabulary_size;
+    const struct text *target = ta->target;
+    struct text_alignment *shards;
+    random_state shard_states[n_threads];
+    count jump_counts[JUMP_ARRAY_LEN];
+    // hash table resizes by each thread, since the counters are per thread
+    size_t shard_resizes[n_threads];
+
+    if (ta->model >= 3) text_alignment_sample_fert(ta, state);
+
+    if ((shards = malloc(n_threads*sizeof(*shards))) == NULL) {
+        perror("text_alignment_sample_parallel(): failed to allocate shards");
+        exit(EXIT_FAILURE);
+    }
+    for (int t=0; t<n_threads; t++) {
+        shards[t] = *ta;
+        shards[t].inv_source_count_sum = malloc(sizeof(count)*vocabulary_size);
+        shards[t].count_delta = malloc(sizeof(struct map_pair_u32));
+        if (shards[t].inv_source_count_sum == NULL ||
+            shards[t].count_delta == NULL)
+        {
+            perror("text_alignment_sample_parallel(): failed to allocate "
+                   "thread-local counts");
+            exit(EXIT_FAILURE);
+        }
+        memcpy(shards[t].inv_source_count_sum, ta->inv_source_count_sum,
+               sizeof(count)*vocabulary_size);
+        map_pair_u32_create(shards[t].count_delta);
+        shard_states[t] = random_split_state(state);
+    }
+
+    struct sample_buffers *buffers = text_alignment_buffers(ta, n_threads);
+    const size_t first_token = target->offsets[ta->sample_begin];
+    const size_t n_tokens = target->offsets[ta->sample_end] - first_token;
+#pragma omp parallel for num_threads(n_threads)
+    for (int t=0; t<n_threads; t++) {
+        const size_t thread_resizes =
+            map_token_u32_n_resizes + map_pair_u32_n_resizes;
+        const size_t begin = (t == 0)? ta->sample_begin
+            : text_find_token(target, first_token + n_tokens*t/n_threads);
+        const size_t end = (t == n_threads-1)? ta->sample_end
+            : text_find_token(target,
+                              first_token + n_tokens*(t+1)/n_threads);
+        text_alignment_sample_range(
+                shards + t, buffers + t, shard_states + t, NULL, NULL, 1,
+                begin, end);
+        shard_resizes[t] = map_token_u32_n_resizes + map_pair_u32_n_resizes -
+                           thread_resizes;
+    }
+
+    // the calling thread also sampled a shard, which is already counted in
+    // shard_resizes, so only its resizes while merging are counted from here
+    const size_t n_resizes = map_token_u32_n_resizes + map_pair_u32_n_resizes;
+
+    // merge the thread-local changes into ta
+    int32_t *sum_delta = calloc(vocabulary_size, sizeof(int32_t));
+    if (sum_delta == NULL) {
+        perror("text_alignment_sample_parallel(): failed to allocate "
+               "sum_delta");
+        exit(EXIT_FAILURE);
+    }
+    memcpy(jump_counts, ta->jump_counts, sizeof(jump_counts));
+    ta->n_changed = 0;
+    ta->n_resizes = 0;
+    for (int t=0; t<n_threads; t++) {
+        ta->n_changed += shards[t].n_changed;
+        ta->n_resizes += shard_resizes[t];
+        struct map_pair_u32 *delta = shards[t].count_delta;
+        const size_t n_items = delta->n_items;
+        uint64_t *keys = malloc(MAX(1, n_items)*sizeof(uint64_t));
+        uint32_t *values = malloc(MAX(1, n_items)*sizeof(uint32_t));
+        if (keys == NULL || values == NULL) {
+            perror("text_alignment_sample_parallel(): failed to allocate "
+                   "delta buffers");
+            exit(EXIT_FAILURE);
+        }
+        map_pair_u32_items(delta, keys, values);
+        for (size_t i=0; i<n_items; i++) {
+            if (values[i] == 0) continue;
+            const token e = (token)(keys[i] >> 32);
+            const token f = (token)(keys[i] & 0xffffffffUL);
+            if (add_count(ta, e, f, values[i]) == 0)
+                remove_count(ta, e, f);
+            sum_delta[e] += (int32_t)values[i];
+        }
+        for (size_t i=0; i<JUMP_ARRAY_LEN; i++)
+            ta->jump_counts[i] += shards[t].jump_counts[i] - jump_counts[i];
+        free(keys);
+        free(values);
+        map_pair_u32_clear(delta);
+        free(delta);
+        free(shards[t].inv_source_count_sum);
+    }
+    for (size_t e=0; e<vocabulary_size; e++) {
+        if (sum_delta[e] != 0)
+            ta->inv_source_count_sum[e] =
+                (count)1.0 / ((count)1.0/ta->inv_source_count_sum[e] +
+                              (count)sum_delta[e]);
+    }
+    free(sum_delta);
+    free(shards);
+    ta->n_resizes += map_token_u32_n_resizes + map_pair_u32_n_resizes -
+                     n_resizes;
 }
 
 void text_alignment_make_counts(struct text_alignment *ta) {
     const int model = ta->model;
-    struct sentence **source_sentences = ta->source->sentences;
-    struct sentence **target_sentences = ta->target->sentences;
+    const struct text *source = ta->source;
+    const struct text *target = ta->target;
 
     // TODO: do we need a special case for NULL links? Probably not, since
     //       NULL alignment statistics could also provide valuable prior
@@ -659,22 +1556,24 @@ void text_alignment_make_counts(struct text_alignment *ta) {
     //ta->inv_source_count_sum[0] =
     //    NULL_ALPHA * (count)ta->target->vocabulary_size;
 
+    memset(ta->dense_counts, 0, (size_t)ta->n_dense*
+                                ta->target->vocabulary_size*sizeof(uint32_t));
     for (size_t i=0; i<ta->source->vocabulary_size; i++) {
         map_token_u32_reset(ta->source_count + i);
-        if (ta->source_prior != NULL) {
-            ta->inv_source_count_sum[i] = ta->source_prior_sum[i];
+        if (ta->priors != NULL && ta->priors->lex_offsets != NULL) {
+            ta->inv_source_count_sum[i] = ta->priors->lex_sum[i];
         } else {
             ta->inv_source_count_sum[i] =
                 LEX_ALPHA * (count)ta->target->vocabulary_size;
         }
     }
     if (model >= 2) {
-        if (ta->has_jump_prior) {
+        if (ta->priors != NULL && ta->priors->has_jump) {
             // TODO: decide on whether to add JUMP_ALPHA
             ta->jump_counts[JUMP_SUM] = (count) (JUMP_MAX_EST*JUMP_ALPHA);
             for (size_t i=0; i<JUMP_ARRAY_LEN-1; i++) {
-                ta->jump_counts[i] = ta->jump_prior[i] + (count) JUMP_ALPHA;
-                ta->jump_counts[JUMP_SUM] += ta->jump_prior[i];
+                ta->jump_counts[i] = ta->priors->jump[i] + (count) JUMP_ALPHA;
+                ta->jump_counts[JUMP_SUM] += ta->priors->jump[i];
             }
         } else {
             for (size_t i=0; i<JUMP_ARRAY_LEN-1; i++)
@@ -687,28 +1586,29 @@ void text_alignment_make_counts(struct text_alignment *ta) {
     for (size_t sent=0; sent<n_sentences; sent++) {
         link_t *links = ta->sentence_links[sent];
         if (links == NULL) continue;
-        const struct sentence *source_sentence = source_sentences[sent];
-        const struct sentence *target_sentence = target_sentences[sent];
-        const size_t source_length = source_sentence->length;
-        const size_t target_length = target_sentence->length;
+        const size_t source_length = text_sentence_length(source, sent);
+        const size_t target_length = text_sentence_length(target, sent);
+        const token *source_tokens = text_sentence_tokens(source, sent);
+        const token *target_tokens = text_sentence_tokens(target, sent);
+        const uint32_t weight = text_alignment_weight(ta, sent);
         int aa_jm1 = -1;
         for (size_t j=0; j<target_length; j++) {
             const link_t i = links[j];
-            const token e = (i == NULL_LINK)? 0 : source_sentence->tokens[i];
-            const token f = target_sentence->tokens[j];
-            ta->inv_source_count_sum[e] += (count)1.0;
-            map_token_u32_add(ta->source_count + e, f, 1);
+            const token e = (i == NULL_LINK)? 0 : source_tokens[i];
+            const token f = target_tokens[j];
+            ta->inv_source_count_sum[e] += (count)weight;
+            add_count(ta, e, f, weight);
             if (model >= 2 && e != 0) {
                 const size_t jump = get_jump_index(aa_jm1, i, source_length);
                 aa_jm1 = i;
-                ta->jump_counts[jump] += (count)1.0;
-                ta->jump_counts[JUMP_SUM] += (count)1.0;
+                ta->jump_counts[jump] += (count)weight;
+                ta->jump_counts[JUMP_SUM] += (count)weight;
             }
         }
         if (model >= 2 && aa_jm1 >= 0) {
             ta->jump_counts[get_jump_index(
-                    aa_jm1, source_length, source_length)] += (count) 1.0;
-            ta->jump_counts[JUMP_SUM] += (count) 1.0;
+                    aa_jm1, source_length, source_length)] += (count)weight;
+            ta->jump_counts[JUMP_SUM] += (count)weight;
         }
     }
     for (size_t i=0; i<ta->source->vocabulary_size; i++)
@@ -716,35 +1616,180 @@ void text_alignment_make_counts(struct text_alignment *ta) {
 }
 
 void text_alignment_randomize(struct text_alignment *ta, random_state *state) {
-    struct sentence **source_sentences = ta->source->sentences;
-    struct sentence **target_sentences = ta->target->sentences;
     for (size_t sent=0; sent<ta->target->n_sentences; sent++) {
         link_t *links = ta->sentence_links[sent];
         if (links == NULL) continue;
-        const struct sentence *source_sentence = source_sentences[sent];
-        const struct sentence *target_sentence = target_sentences[sent];
-        for (size_t j=0; j<target_sentence->length; j++) {
+        const size_t source_length = text_sentence_length(ta->source, sent);
+        const size_t target_length = text_sentence_length(ta->target, sent);
+        for (size_t j=0; j<target_length; j++) {
             if (random_uniform32(state) < ta->null_prior) {
                 links[j] = NULL_LINK;
             } else {
-                links[j] = random_uint32_biased(state, source_sentence->length);
+                links[j] = random_uint32_biased(state, source_length);
             }
         }
     }
 }
 
-int text_alignment_load_priors(
-        struct text_alignment *ta, const char *filename, int reverse)
+// Binary priors format, written by to_eflomal_priors_file() in the Python
+// module with binary=True:
+//
+//  struct priors_header
+//  for the forward, then the reverse direction:
+//      uint64_t lex_offsets[source_vocabulary_size+1]
+//      uint32_t lex_keys[n_lex]
+//      float lex_alphas[n_lex]
+//  struct jump_prior fwd_jump[n_fwd_jump], rev_jump[n_rev_jump]
+//  struct fert_prior fwd_fert[n_fwd_fert], rev_fert[n_rev_fert]
+//
+// where the vocabulary sizes (including NULL) are those of the forward
+// direction, and the reverse direction has them swapped. The lexical priors
+// are in the format of struct priors, so they can be used directly from a
+// memory map.
+#define PRIORS_MAGIC    "EFLP"
+#define PRIORS_VERSION  1
+
+struct priors_header {
+    char magic[4];
+    uint32_t version;
+    uint32_t source_vocabulary_size;
+    uint32_t target_vocabulary_size;
+    uint64_t n_lex;
+    uint32_t n_fwd_jump;
+    uint32_t n_rev_jump;
+    uint32_t n_fwd_fert;
+    uint32_t n_rev_fert;
+};
+
+struct jump_prior {
+    int32_t jump;
+    float alpha;
+};
+
+struct fert_prior {
+    uint32_t e;
+    uint32_t fert;
+    float alpha;
+};
+
+struct lex_prior {
+    token e;
+    token f;
+    float alpha;
+};
+
+static int lex_prior_cmp(const void *a, const void *b) {
+    const struct lex_prior *x = a, *y = b;
+    if (x->e != y->e) return (x->e < y->e)? -1: 1;
+    if (x->f != y->f) return (x->f < y->f)? -1: 1;
+    return 0;
+}
+
+static void priors_init(
+        struct priors *p, size_t source_vocabulary_size,
+        size_t target_vocabulary_size)
 {
-    size_t lineno = 1;
-    FILE *file = (!strcmp(filename, "-"))? stdin: fopen(filename, "r");
-    if (file == NULL) {
-        perror("text_alignment_load_priors(): failed to open text file");
-        return -1;
+    memset(p, 0, sizeof(*p));
+    p->source_vocabulary_size = source_vocabulary_size;
+    p->target_vocabulary_size = target_vocabulary_size;
+}
+
+void priors_free(struct priors *p) {
+    if (p->map != NULL) {
+        if (p->map_is_buffer) free(p->map);
+        else munmap(p->map, p->map_size);
+    }
+    free(p->lex_offsets_buf);
+    free(p->lex_keys_buf);
+    free(p->lex_alphas_buf);
+    free(p->lex_sum);
+    free(p->fert);
+}
+
+// Compute lex_sum from the lexical priors (once these are set)
+static void priors_set_lex_sum(struct priors *p) {
+    if ((p->lex_sum = malloc(sizeof(count)*p->source_vocabulary_size))
+            == NULL)
+    {
+        perror("priors_set_lex_sum(): failed to allocate counter array");
+        exit(EXIT_FAILURE);
+    }
+    for (size_t e=0; e<p->source_vocabulary_size; e++) {
+        count sum = LEX_ALPHA * (count)p->target_vocabulary_size;
+        for (size_t i=p->lex_offsets[e]; i<p->lex_offsets[e+1]; i++)
+            sum += (count)p->lex_alphas[i];
+        p->lex_sum[e] = sum;
+    }
+}
+
+// Set the lexical priors from n (e, f, alpha) triples, which are sorted in
+// the process. Priors of the same (e, f) pair are added.
+static int priors_set_lex(struct priors *p, struct lex_prior *lex, size_t n)
+{
+    qsort(lex, n, sizeof(*lex), lex_prior_cmp);
+    p->lex_offsets_buf = calloc(p->source_vocabulary_size+1, sizeof(uint64_t));
+    p->lex_keys_buf = malloc(MAX(1, n)*sizeof(token));
+    p->lex_alphas_buf = malloc(MAX(1, n)*sizeof(float));
+    if (p->lex_offsets_buf == NULL || p->lex_keys_buf == NULL ||
+        p->lex_alphas_buf == NULL)
+    {
+        perror("priors_set_lex(): failed to allocate lexical priors");
+        exit(EXIT_FAILURE);
+    }
+    size_t n_unique = 0;
+    for (size_t i=0; i<n; i++) {
+        if (lex[i].e >= p->source_vocabulary_size ||
+            lex[i].f >= p->target_vocabulary_size)
+            return -1;
+        if (i && !lex_prior_cmp(lex+i-1, lex+i)) {
+            p->lex_alphas_buf[n_unique-1] += lex[i].alpha;
+        } else {
+            p->lex_keys_buf[n_unique] = lex[i].f;
+            p->lex_alphas_buf[n_unique] = lex[i].alpha;
+            p->lex_offsets_buf[lex[i].e+1]++;
+            n_unique++;
+        }
+    }
+    for (size_t e=0; e<p->source_vocabulary_size; e++)
+        p->lex_offsets_buf[e+1] += p->lex_offsets_buf[e];
+    p->lex_offsets = p->lex_offsets_buf;
+    p->lex_keys = p->lex_keys_buf;
+    p->lex_alphas = p->lex_alphas_buf;
+    priors_set_lex_sum(p);
+    return 0;
+}
+
+static void priors_add_jump(struct priors *p, int jump, float alpha) {
+    if (!p->has_jump) {
+        p->has_jump = 1;
+        for (size_t i=0; i<JUMP_ARRAY_LEN; i++)
+            p->jump[i] = 0.0;
+    }
+    p->jump[MAX(0, MIN(JUMP_ARRAY_LEN-1, jump + JUMP_ARRAY_LEN/2))] += alpha;
+}
+
+static int priors_add_fert(struct priors *p, token e, int fert, float alpha)
+{
+    if (e >= p->source_vocabulary_size || fert < 0) return -1;
+    if (p->fert == NULL) {
+        if ((p->fert = calloc(p->source_vocabulary_size*FERT_ARRAY_LEN,
+                              sizeof(count))) == NULL)
+        {
+            perror("priors_add_fert(): failed to allocate fertility "
+                   "prior array");
+            exit(EXIT_FAILURE);
+        }
     }
- 
+    p->fert[get_fert_index(e, fert)] += alpha;
+    return 0;
+}
+
+static int priors_read_text(
+        FILE *file, const char *filename,
+        struct priors *fwd, struct priors *rev)
+{
+    size_t lineno = 1;
     size_t source_vocabulary_size, target_vocabulary_size, n_lex_priors,
-           n_jump_priors, n_fert_priors,
            n_fwd_jump_priors, n_fwd_fert_priors,
            n_rev_jump_priors, n_rev_fert_priors;
     if (fscanf(file, "%zd %zd %zd %zd %zd %zd %zd\n",
@@ -756,203 +1801,607 @@ int text_alignment_load_priors(
                 &n_fwd_fert_priors,
                 &n_rev_fert_priors) != 7)
     {
-        fprintf(stderr,
-                "text_alignment_load_priors(): failed to read header in %s\n",
+        fprintf(stderr, "priors_read(): failed to read header in %s\n",
                 filename);
-        if (file != stdin) fclose(file);
         return -1;
     }
     lineno++;
 
-    if (reverse) {
-        n_jump_priors = n_rev_jump_priors;
-        n_fert_priors = n_rev_fert_priors;
-    } else {
-        n_jump_priors = n_fwd_jump_priors;
-        n_fert_priors = n_fwd_fert_priors;
+    if (source_vocabulary_size != fwd->source_vocabulary_size ||
+        target_vocabulary_size != fwd->target_vocabulary_size)
+    {
+        fprintf(stderr,
+                "priors_read(): vocabulary size mismatch, "
+                "source is %zd (expected %"PRItoken") "
+                "and target is %zd (expected %"PRItoken") in %s\n",
+                source_vocabulary_size, fwd->source_vocabulary_size,
+                target_vocabulary_size, fwd->target_vocabulary_size,
+                filename);
+        return -1;
     }
 
     if (n_lex_priors) {
-        if ((ta->source_prior =
-             malloc(ta->source->vocabulary_size*sizeof(struct map_token_u32))
-            ) == NULL)
-        {
-            perror("text_alignment_load_priors(): "
-                   "failed to allocate buffer pointers");
+        struct lex_prior *lex = malloc(n_lex_priors*sizeof(*lex));
+        if (lex == NULL) {
+            perror("priors_read(): failed to allocate lexical priors");
             exit(EXIT_FAILURE);
         }
-        for (size_t i=0; i<ta->source->vocabulary_size; i++)
-            map_token_u32_create(ta->source_prior + i);
-        if ((ta->source_prior_sum =
-             malloc(sizeof(count)*ta->source->vocabulary_size)) == NULL)
-        {
-            perror("text_alignment_load_priors(): "
-                   "failed to allocate counter array");
-            exit(EXIT_FAILURE);
+        for (size_t i=0; i<n_lex_priors; i++) {
+            if (fscanf(file, "%"SCNtoken" %"SCNtoken" %f\n",
+                       &lex[i].e, &lex[i].f, &lex[i].alpha) != 3)
+            {
+                fprintf(stderr,
+                        "priors_read(): error in line %zd of %s\n",
+                        lineno, filename);
+                free(lex);
+                return -1;
+            }
+            lineno++;
         }
-        for (size_t i=0; i<ta->source->vocabulary_size; i++) {
-            ta->source_prior_sum[i] = 0.0;
+        int r = priors_set_lex(fwd, lex, n_lex_priors);
+        for (size_t i=0; i<n_lex_priors && !r; i++) {
+            const token t = lex[i].e;
+            lex[i].e = lex[i].f;
+            lex[i].f = t;
+        }
+        if (!r) r = priors_set_lex(rev, lex, n_lex_priors);
+        free(lex);
+        if (r) {
+            fprintf(stderr, "priors_read(): lexical prior out of range "
+                            "in %s\n", filename);
+            return -1;
         }
     }
 
-    if (n_fert_priors) {
-        if ((ta->fert_prior =
-             malloc(ta->source->vocabulary_size*sizeof(count)*FERT_ARRAY_LEN))
-                == NULL)
-        {
-            perror("text_alignment_create(): failed to allocate fertility "
-                   "prior array");
-            exit(EXIT_FAILURE);
+    for (int reverse=0; reverse<=1; reverse++) {
+        const size_t n = reverse? n_rev_jump_priors: n_fwd_jump_priors;
+        for (size_t i=0; i<n; i++) {
+            int jump;
+            float alpha;
+            if (fscanf(file, "%d %f\n", &jump, &alpha) != 2) {
+                fprintf(stderr,
+                        "priors_read(): error in line %zd of %s\n",
+                        lineno, filename);
+                return -1;
+            }
+            priors_add_jump(reverse? rev: fwd, jump, alpha);
+            lineno++;
         }
-        for (size_t i=0;i<ta->source->vocabulary_size*FERT_ARRAY_LEN;i++)
-            ta->fert_prior[i] = 0.0;
     }
 
-    // TODO: check that JUMP_ALPHA and FERT_ALPHA are added where they should,
-    // otherwise add here! (above and below)
-    if (n_jump_priors) {
-        ta->has_jump_prior = 1;
-
-        for (size_t i=0; i<JUMP_ARRAY_LEN; i++)
-            ta->jump_prior[i] = 0.0;
+    for (int reverse=0; reverse<=1; reverse++) {
+        const size_t n = reverse? n_rev_fert_priors: n_fwd_fert_priors;
+        for (size_t i=0; i<n; i++) {
+            int k;
+            token e;
+            float alpha;
+            if (fscanf(file, "%"SCNtoken" %d %f\n", &e, &k, &alpha) != 3) {
+                fprintf(stderr,
+                        "priors_read(): error in line %zd of %s\n",
+                        lineno, filename);
+                return -1;
+            }
+            if (priors_add_fert(reverse? rev: fwd, e, k, alpha)) {
+                fprintf(stderr,
+                        "priors_read(): index %"PRItoken" out of range "
+                        "in line %zd of %s\n", e, lineno, filename);
+                return -1;
+            }
+            lineno++;
+        }
     }
 
-    size_t t;
-    if (reverse) {
-        t = source_vocabulary_size;
-        source_vocabulary_size = target_vocabulary_size;
-        target_vocabulary_size = t;
+    return 0;
+}
+
+static int priors_read_binary(
+        FILE *file, const char *filename,
+        struct priors *fwd, struct priors *rev)
+{
+    struct stat st;
+    if (file != stdin && fstat(fileno(file), &st) == 0 &&
+            S_ISREG(st.st_mode))
+    {
+        fwd->map_size = st.st_size;
+        fwd->map = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE,
+                        fileno(file), 0);
+        if (fwd->map == MAP_FAILED) {
+            fwd->map = NULL;
+            perror("priors_read(): failed to map file");
+            return -1;
+        }
+    } else {
+        // not a regular file (e.g. a pipe), read it into a buffer
+        size_t size = 0x10000;
+        fwd->map_is_buffer = 1;
+        if ((fwd->map = malloc(size)) == NULL) {
+            perror("priors_read(): failed to allocate buffer");
+            exit(EXIT_FAILURE);
+        }
+        size_t n;
+        while ((n = fread((char*)fwd->map + fwd->map_size, 1,
+                          size - fwd->map_size, file)) > 0)
+        {
+            fwd->map_size += n;
+            if (fwd->map_size == size) {
+                size *= 2;
+                if ((fwd->map = realloc(fwd->map, size)) == NULL) {
+                    perror("priors_read(): failed to allocate buffer");
+                    exit(EXIT_FAILURE);
+                }
+            }
+        }
     }
 
-    if (source_vocabulary_size != ta->source->vocabulary_size ||
-        target_vocabulary_size != ta->target->vocabulary_size)
+    struct priors_header header;
+    const char *data = fwd->map;
+    if (fwd->map_size < sizeof(header)) goto truncated;
+    memcpy(&header, data, sizeof(header));
+    if (memcmp(header.magic, PRIORS_MAGIC, 4)) {
+        fprintf(stderr, "priors_read(): invalid header in %s\n", filename);
+        return -1;
+    }
+    if (header.version != PRIORS_VERSION) {
+        fprintf(stderr, "priors_read(): unsupported version %"PRIu32" of %s\n",
+                header.version, filename);
+        return -1;
+    }
+    if (header.source_vocabulary_size != fwd->source_vocabulary_size ||
+        header.target_vocabulary_size != fwd->target_vocabulary_size)
     {
         fprintf(stderr,
-                "text_alignment_load_priors(): vocabulary size mismatch, "
-                "source is %zd (expected %"PRItoken") "
-                "and target is %zd (expected %"PRItoken") in %s\n",
-                source_vocabulary_size, ta->source->vocabulary_size,
-                target_vocabulary_size, ta->target->vocabulary_size,
+                "priors_read(): vocabulary size mismatch, "
+                "source is %"PRIu32" (expected %"PRItoken") "
+                "and target is %"PRIu32" (expected %"PRItoken") in %s\n",
+                header.source_vocabulary_size, fwd->source_vocabulary_size,
+                header.target_vocabulary_size, fwd->target_vocabulary_size,
                 filename);
-        if (file != stdin) fclose(file);
         return -1;
     }
 
-    for (size_t i=0; i<n_lex_priors; i++) {
-        token e, f, t;
-        float alpha;
-        if (fscanf(file, "%"SCNtoken" %"SCNtoken" %f\n", &e, &f, &alpha) != 3) {
-            fprintf(stderr,
-                    "text_alignment_load_priors(): error in line %zd of %s\n",
-                    i+2, filename);
-            if (file != stdin) fclose(file);
-            return -1;
+    const size_t n_lex = header.n_lex;
+    size_t pos = sizeof(header);
+    for (int reverse=0; reverse<=1; reverse++) {
+        struct priors *p = reverse? rev: fwd;
+        const size_t size = (p->source_vocabulary_size+1)*sizeof(uint64_t) +
+                            n_lex*(sizeof(token)+sizeof(float));
+        if (fwd->map_size < pos + size) goto truncated;
+        if (n_lex) {
+            p->lex_offsets = (const uint64_t*)(data + pos);
+            p->lex_keys = (const token*)(p->lex_offsets +
+                                         p->source_vocabulary_size + 1);
+            p->lex_alphas = (const float*)(p->lex_keys + n_lex);
+            if (p->lex_offsets[p->source_vocabulary_size] != n_lex) {
+                fprintf(stderr, "priors_read(): invalid lexical priors "
+                                "in %s\n", filename);
+                return -1;
+            }
+            for (size_t i=0; i<n_lex; i++) {
+                if (p->lex_keys[i] >= p->target_vocabulary_size) {
+                    fprintf(stderr, "priors_read(): lexical prior out of "
+                                    "range in %s\n", filename);
+                    return -1;
+                }
+            }
+            priors_set_lex_sum(p);
         }
-        lineno++;
-        if (reverse) {
-            t = e;
-            e = f;
-            f = t;
+        pos += size;
+    }
+
+    const size_t n_jump[2] = {header.n_fwd_jump, header.n_rev_jump};
+    for (int reverse=0; reverse<=1; reverse++) {
+        if (fwd->map_size < pos + n_jump[reverse]*sizeof(struct jump_prior))
+            goto truncated;
+        for (size_t i=0; i<n_jump[reverse]; i++) {
+            struct jump_prior jp;
+            memcpy(&jp, data + pos, sizeof(jp));
+            priors_add_jump(reverse? rev: fwd, jp.jump, jp.alpha);
+            pos += sizeof(jp);
         }
-        // TODO: fix this properly
-        map_token_u32_add(ta->source_prior + e, f, *((uint32_t*)&alpha));
-        ta->source_prior_sum[e] += alpha;
     }
 
-    if (n_lex_priors) {
-        for (size_t e=0; e<ta->source->vocabulary_size; e++) {
-            ta->source_prior_sum[e] +=
-                LEX_ALPHA * (float)ta->target->vocabulary_size;
+    const size_t n_fert[2] = {header.n_fwd_fert, header.n_rev_fert};
+    for (int reverse=0; reverse<=1; reverse++) {
+        if (fwd->map_size < pos + n_fert[reverse]*sizeof(struct fert_prior))
+            goto truncated;
+        for (size_t i=0; i<n_fert[reverse]; i++) {
+            struct fert_prior fp;
+            memcpy(&fp, data + pos, sizeof(fp));
+            if (priors_add_fert(reverse? rev: fwd, fp.e, fp.fert, fp.alpha)) {
+                fprintf(stderr, "priors_read(): index %"PRIu32" out of "
+                                "range in %s\n", fp.e, filename);
+                return -1;
+            }
+            pos += sizeof(fp);
         }
     }
 
-    for (size_t i=0; i<n_fwd_jump_priors; i++) {
-        int jump;
-        size_t jump_index;
-        float alpha;
-        if (fscanf(file, "%d %f\n", &jump, &alpha) != 2) {
-            fprintf(stderr,
-                    "text_alignment_load_priors(): error in line %zd of %s\n",
-                    lineno, filename);
-            if (file != stdin) fclose(file);
-            return -1;
+    return 0;
+
+truncated:
+    fprintf(stderr, "priors_read(): unexpected end of %s\n", filename);
+    return -1;
+}
+
+// Read priors for both directions from a file in the text or binary format
+// (the latter is detected by PRIORS_MAGIC). The vocabulary sizes (including
+// NULL) must match those of the source and target texts. On error, -1 is
+// returned and fwd and rev should still be freed with priors_free().
+int priors_read(
+        const char *filename, token source_vocabulary_size,
+        token target_vocabulary_size, struct priors *fwd, struct priors *rev)
+{
+    priors_init(fwd, source_vocabulary_size, target_vocabulary_size);
+    priors_init(rev, target_vocabulary_size, source_vocabulary_size);
+    FILE *file = (!strcmp(filename, "-"))? stdin: fopen(filename, "rb");
+    if (file == NULL) {
+        perror("priors_read(): failed to open priors file");
+        return -1;
+    }
+    const int c = getc(file);
+    ungetc(c, file);
+    const int r = (c == PRIORS_MAGIC[0])
+        ? priors_read_binary(file, filename, fwd, rev)
+        : priors_read_text(file, filename, fwd, rev);
+    if (file != stdin) fclose(file);
+    return r;
+}
+
+// Model snapshot format, written with -w after the final iteration and
+// loaded with -l to align new data without retraining:
+//
+//  struct snapshot_header
+//  for the forward, then the reverse direction:
+//      uint64_t n_lex
+//      struct snapshot_count lex[n_lex]    (e, f, times f is aligned to e)
+//      float jump[JUMP_ARRAY_LEN]          jump counts (JUMP_SUM is unused)
+//      uint64_t n_fert
+//      struct snapshot_count fert[n_fert]  (e, fertility, times e has it)
+//
+// The counts are those of the final alignment, without priors or
+// pseudo-counts. If the model was itself trained from a snapshot, the counts
+// of that snapshot can be carried over, multiplied by a decay factor (see
+// snapshot_write()). Jump and fertility counts are zero or missing if the
+// model did not use them. Data following this (such as the vocabulary,
+// appended by the Python module) is ignored.
+#define SNAPSHOT_MAGIC      "EFLM"
+#define SNAPSHOT_VERSION    1
+
+// Carried-over lexical counts below this are dropped from snapshots, so that
+// the number of counts stays bounded when decaying them
+#define SNAPSHOT_MIN_COUNT  0.01f
+
+struct snapshot_header {
+    char magic[4];
+    uint32_t version;
+    uint32_t model;
+    // as in struct text_header, these do not include the NULL token
+    uint32_t source_vocabulary_size;
+    uint32_t target_vocabulary_size;
+    uint32_t reserved;
+};
+
+struct snapshot_count {
+    uint32_t e;
+    uint32_t f;
+    float n;
+};
+
+static int snapshot_write_counts(
+        const struct snapshot_count *counts, uint64_t n, FILE *file)
+{
+    if (fwrite(&n, sizeof(n), 1, file) != 1) return -1;
+    if (n && fwrite(counts, sizeof(*counts), n, file) != n) return -1;
+    return 0;
+}
+
+// Copy the counts of the source word e (the non-zero ones, for a dense row)
+// to keys and values, with room for target->vocabulary_size elements, and
+// return their number
+static size_t text_alignment_get_counts(
+        const struct text_alignment *ta, token e, token *keys,
+        uint32_t *values)
+{
+    if (e < ta->n_dense) {
+        const uint32_t *row = get_dense_count(ta, e, 0);
+        size_t n = 0;
+        for (token f=0; f<ta->target->vocabulary_size; f++) {
+            if (row[f]) {
+                keys[n] = f;
+                values[n] = row[f];
+                n++;
+            }
         }
-        jump_index = MAX(0, MIN(JUMP_ARRAY_LEN-1, jump + JUMP_ARRAY_LEN/2));
-        if (! reverse)
-            ta->jump_prior[jump_index] += alpha;
-        lineno++;
-    }
-
-    for (size_t i=0; i<n_rev_jump_priors; i++) {
-        int jump;
-        size_t jump_index;
-        float alpha;
-        if (fscanf(file, "%d %f\n", &jump, &alpha) != 2) {
-            fprintf(stderr,
-                    "text_alignment_load_priors(): error in line %zd of %s\n",
-                    i+2, filename);
-            if (file != stdin) fclose(file);
-            return -1;
+        return n;
+    }
+    map_token_u32_items(ta->source_count + e, keys, values);
+    return ta->source_count[e].n_items;
+}
+
+// Write the section of the snapshot file for one direction. If decay is
+// positive, the priors of ta (which should then be read from a snapshot)
+// multiplied by decay are added to the counts.
+static int text_alignment_write_snapshot(
+        const struct text_alignment *ta, int model, double decay, FILE *file)
+{
+    const struct text *source = ta->source;
+    const struct text *target = ta->target;
+    const size_t vocabulary_size = source->vocabulary_size;
+    const struct priors *carried = (decay > 0.0)? ta->priors: NULL;
+    const int carry_lex = carried != NULL && carried->lex_offsets != NULL;
+    token *keys = malloc(target->vocabulary_size*sizeof(token));
+    uint32_t *values = malloc(target->vocabulary_size*sizeof(uint32_t));
+    if (keys == NULL || values == NULL) {
+        perror("text_alignment_write_snapshot(): failed to allocate buffers");
+        exit(EXIT_FAILURE);
+    }
+    size_t n_items = 0;
+    for (size_t e=0; e<vocabulary_size; e++)
+        n_items += text_alignment_get_counts(ta, e, keys, values);
+    if (carry_lex) n_items += carried->lex_offsets[vocabulary_size];
+
+    struct snapshot_count *counts = malloc(
+            MAX(n_items, vocabulary_size*FERT_ARRAY_LEN)*sizeof(*counts));
+    if (counts == NULL) {
+        perror("text_alignment_write_snapshot(): failed to allocate counts");
+        exit(EXIT_FAILURE);
+    }
+
+    uint64_t n = 0;
+    for (size_t e=0; e<vocabulary_size; e++) {
+        struct map_token_u32 *m = ta->source_count + e;
+        const size_t n_e = text_alignment_get_counts(ta, e, keys, values);
+        for (size_t i=0; i<n_e; i++) {
+            float c = (float)values[i];
+            if (carry_lex)
+                c += (float)decay * priors_get_lex(carried, e, keys[i]);
+            if (c < SNAPSHOT_MIN_COUNT) continue;
+            counts[n].e = e;
+            counts[n].f = keys[i];
+            counts[n].n = c;
+            n++;
         }
-        jump_index = MAX(0, MIN(JUMP_ARRAY_LEN-1, jump + JUMP_ARRAY_LEN/2));
-        if (reverse)
-            ta->jump_prior[jump_index] += alpha;
-        lineno++;
-    }
-
-    for (size_t i=0; i<n_fwd_fert_priors; i++) {
-        int k;
-        token e;
-        size_t fert_index;
-        float alpha;
-        if (fscanf(file, "%"SCNtoken" %d %f\n", &e, &k, &alpha) != 3) {
-            fprintf(stderr,
-                    "text_alignment_load_priors(): error in line %zd of %s\n",
-                    lineno, filename);
-            if (file != stdin) fclose(file);
-            return -1;
+        if (!carry_lex) continue;
+        // carried-over counts of pairs that are not aligned in ta
+        for (size_t i=carried->lex_offsets[e]; i<carried->lex_offsets[e+1];
+             i++)
+        {
+            const token f = carried->lex_keys[i];
+            const float c = (float)decay * carried->lex_alphas[i];
+            uint32_t value;
+            if (c < SNAPSHOT_MIN_COUNT) continue;
+            if ((e < ta->n_dense)? *get_dense_count(ta, e, f) != 0
+                                 : map_token_u32_get(m, f, &value))
+                continue;
+            counts[n].e = e;
+            counts[n].f = f;
+            counts[n].n = c;
+            n++;
         }
-        fert_index = get_fert_index(e, k);
-        if (! reverse) {
-            if (e >= ta->source->vocabulary_size) {
-                fprintf(stderr,
-                        "text_alignment_load_priors(): index %"PRItoken" out"
-                        " of range (forward)", e);
-                if (file != stdin) fclose(file);
-                return -1;
-            }
-            ta->fert_prior[fert_index] += alpha;
+    }
+    if (snapshot_write_counts(counts, n, file)) goto fail;
+
+    float jump[JUMP_ARRAY_LEN];
+    for (size_t i=0; i<JUMP_ARRAY_LEN; i++) {
+        if (model >= 2 && i != JUMP_SUM) {
+            count c = ta->jump_counts[i] - (count)JUMP_ALPHA;
+            if (ta->priors != NULL && ta->priors->has_jump)
+                c -= ta->priors->jump[i];
+            if (carried != NULL && carried->has_jump)
+                c += (count)decay * carried->jump[i];
+            jump[i] = (float) MAX((count)0.0, c);
+        } else {
+            jump[i] = 0.0f;
         }
-        lineno++;
     }
+    if (fwrite(jump, sizeof(float), JUMP_ARRAY_LEN, file) != JUMP_ARRAY_LEN)
+        goto fail;
 
-    for (size_t i=0; i<n_rev_fert_priors; i++) {
-        int k;
-        token e;
-        size_t fert_index;
-        float alpha;
-        if (fscanf(file, "%"SCNtoken" %d %f\n", &e, &k, &alpha) != 3) {
-            fprintf(stderr,
-                    "text_alignment_load_priors(): error in line %zd of %s\n",
-                    lineno, filename);
-            if (file != stdin) fclose(file);
-            return -1;
+    // fertility counts are not stored in ta, so compute them from the links
+    n = 0;
+    if (model >= 3) {
+        float *fert_counts = calloc(
+                vocabulary_size*FERT_ARRAY_LEN, sizeof(float));
+        int fert[ta->max_source_length+1];
+        if (fert_counts == NULL) {
+            perror("text_alignment_write_snapshot(): failed to allocate "
+                   "fertility counts");
+            exit(EXIT_FAILURE);
         }
-        fert_index = get_fert_index(e, k);
-        if (reverse) {
-            if (e >= ta->source->vocabulary_size) {
-                fprintf(stderr,
-                        "text_alignment_load_priors(): index %"PRItoken" out"
-                        " of range (reverse)", e);
-                if (file != stdin) fclose(file);
-                return -1;
+        const size_t n_sentences =
+            ta->n_clean? ta->n_clean: target->n_sentences;
+        for (size_t sent=0; sent<n_sentences; sent++) {
+            const link_t *links = ta->sentence_links[sent];
+            if (links == NULL) continue;
+            const size_t source_length = text_sentence_length(source, sent);
+            const size_t target_length = text_sentence_length(target, sent);
+            const token *source_tokens = text_sentence_tokens(source, sent);
+            for (size_t i=0; i<source_length; i++)
+                fert[i] = 0;
+            for (size_t j=0; j<target_length; j++)
+                if (links[j] != NULL_LINK)
+                    fert[links[j]]++;
+            for (size_t i=0; i<source_length; i++)
+                fert_counts[get_fert_index(source_tokens[i], fert[i])] +=
+                    (float)text_alignment_weight(ta, sent);
+        }
+        if (carried != NULL && carried->fert != NULL) {
+            for (size_t i=0; i<vocabulary_size*FERT_ARRAY_LEN; i++)
+                fert_counts[i] += (float)decay * (float)carried->fert[i];
+        }
+        for (size_t e=0; e<vocabulary_size; e++) {
+            for (int k=0; k<FERT_ARRAY_LEN; k++) {
+                const float c = fert_counts[get_fert_index(e, k)];
+                if (c < SNAPSHOT_MIN_COUNT) continue;
+                counts[n].e = e;
+                counts[n].f = k;
+                counts[n].n = c;
+                n++;
             }
-            ta->fert_prior[fert_index] += alpha;
         }
-        lineno++;
+        free(fert_counts);
     }
+    if (snapshot_write_counts(counts, n, file)) goto fail;
 
+    free(counts);
+    free(keys);
+    free(values);
     return 0;
+
+fail:
+    perror("text_alignment_write_snapshot(): failed to write");
+    free(counts);
+    free(keys);
+    free(values);
+    return -1;
+}
+
+// Write a snapshot of the forward (tas[0]) and reverse (tas[1]) alignments,
+// trained with the given model, to filename. If the alignments were trained
+// from another snapshot, a positive decay carries over its counts
+// multiplied by decay (so 1 accumulates all counts, and 0 keeps only those
+// of the current alignments).
+int snapshot_write(
+        struct text_alignment *const *tas, int model, double decay,
+        const char *filename)
+{
+    FILE *file = (!strcmp(filename, "-"))? stdout: fopen(filename, "wb");
+    if (file == NULL) {
+        perror("snapshot_write(): failed to open file");
+        return -1;
+    }
+    struct snapshot_header header;
+    memcpy(header.magic, SNAPSHOT_MAGIC, 4);
+    header.version = SNAPSHOT_VERSION;
+    header.model = model;
+    header.source_vocabulary_size = tas[0]->source->vocabulary_size - 1;
+    header.target_vocabulary_size = tas[0]->target->vocabulary_size - 1;
+    header.reserved = 0;
+    int r = fwrite(&header, sizeof(header), 1, file) != 1;
+    for (int reverse=0; reverse<=1 && !r; reverse++)
+        r = text_alignment_write_snapshot(tas[reverse], model, decay, file);
+    if (file != stdout) {
+        if (fclose(file)) r = -1;
+    }
+    if (r) fprintf(stderr, "snapshot_write(): failed to write %s\n", filename);
+    return r;
+}
+
+static int snapshot_read_counts(
+        struct snapshot_count **counts, uint64_t *n, FILE *file)
+{
+    if (fread(n, sizeof(*n), 1, file) != 1) return -1;
+    if ((*counts = malloc(MAX(1, *n)*sizeof(**counts))) == NULL) {
+        perror("snapshot_read_counts(): failed to allocate buffer");
+        exit(EXIT_FAILURE);
+    }
+    if (fread(*counts, sizeof(**counts), *n, file) != *n) {
+        free(*counts);
+        return -1;
+    }
+    return 0;
+}
+
+// Read a snapshot written by snapshot_write() as priors for both directions,
+// so that sampling continues from the statistics of the snapshot. The
+// vocabularies of the texts may extend those of the snapshot (new words are
+// added at the end by the Python module). On error, -1 is returned and fwd
+// and rev should still be freed with priors_free().
+int priors_read_snapshot(
+        const char *filename, int model, token source_vocabulary_size,
+        token target_vocabulary_size, struct priors *fwd, struct priors *rev)
+{
+    priors_init(fwd, source_vocabulary_size, target_vocabulary_size);
+    priors_init(rev, target_vocabulary_size, source_vocabulary_size);
+    FILE *file = fopen(filename, "rb");
+    if (file == NULL) {
+        perror("priors_read_snapshot(): failed to open file");
+        return -1;
+    }
+    struct snapshot_header header;
+    if (fread(&header, sizeof(header), 1, file) != 1 ||
+        memcmp(header.magic, SNAPSHOT_MAGIC, 4))
+    {
+        fprintf(stderr, "priors_read_snapshot(): invalid header in %s\n",
+                filename);
+        fclose(file);
+        return -1;
+    }
+    if (header.version != SNAPSHOT_VERSION) {
+        fprintf(stderr, "priors_read_snapshot(): unsupported version "
+                        "%"PRIu32" of %s\n", header.version, filename);
+        fclose(file);
+        return -1;
+    }
+    if (header.model < (uint32_t)model) {
+        fprintf(stderr, "priors_read_snapshot(): %s was trained with model "
+                        "%"PRIu32", can not use model %d\n",
+                filename, header.model, model);
+        fclose(file);
+        return -1;
+    }
+    if (header.source_vocabulary_size >= source_vocabulary_size ||
+        header.target_vocabulary_size >= target_vocabulary_size)
+    {
+        fprintf(stderr, "priors_read_snapshot(): vocabulary of %s is "
+                        "larger than that of the texts\n", filename);
+        fclose(file);
+        return -1;
+    }
+
+    int r = 0;
+    for (int reverse=0; reverse<=1 && !r; reverse++) {
+        struct priors *p = reverse? rev: fwd;
+        struct snapshot_count *counts;
+        struct lex_prior *lex;
+        float jump[JUMP_ARRAY_LEN];
+        uint64_t n;
+
+        if (snapshot_read_counts(&counts, &n, file)) {
+            r = -1;
+            break;
+        }
+        if ((lex = malloc(MAX(1, n)*sizeof(*lex))) == NULL) {
+            perror("priors_read_snapshot(): failed to allocate buffer");
+            exit(EXIT_FAILURE);
+        }
+        for (size_t i=0; i<n; i++) {
+            lex[i].e = counts[i].e;
+            lex[i].f = counts[i].f;
+            lex[i].alpha = (float)counts[i].n;
+        }
+        free(counts);
+        r = priors_set_lex(p, lex, n);
+        free(lex);
+        if (r) break;
+
+        if (fread(jump, sizeof(float), JUMP_ARRAY_LEN, file)
+                != JUMP_ARRAY_LEN)
+        {
+            r = -1;
+            break;
+        }
+        if (header.model >= 2) {
+            p->has_jump = 1;
+            for (size_t i=0; i<JUMP_ARRAY_LEN; i++)
+                p->jump[i] = (i == JUMP_SUM)? (count)0.0: (count)jump[i];
+        }
+
+        if (snapshot_read_counts(&counts, &n, file)) {
+            r = -1;
+            break;
+        }
+        for (size_t i=0; i<n && !r; i++)
+            r = priors_add_fert(p, counts[i].e, counts[i].f,
+                                (float)counts[i].n);
+        free(counts);
+    }
+    fclose(file);
+    if (r) {
+        fprintf(stderr, "priors_read_snapshot(): failed to read %s\n",
+                filename);
+    }
+    return r;
 }
 
 struct text_alignment *text_alignment_create(
@@ -972,18 +2421,35 @@ struct text_alignment *text_alignment_create(
     ta->source = source;
     ta->target = target;
     ta->n_clean = 0;
+    ta->weights = NULL;
+    ta->sample_begin = 0;
+    ta->sample_end = target->n_sentences;
+    ta->count_delta = NULL;
+    ta->buffers = NULL;
+    ta->n_buffers = 0;
 
-    // These should be initialized with text_alignment_load_priors()
-    ta->source_prior = NULL;
-    ta->source_prior_sum = NULL;
-    ta->fert_prior = NULL;
-    ta->has_jump_prior = 0;
+    // This can be set to priors from priors_read()
+    ta->priors = NULL;
 
     size_t buf_size = 0;
+    ta->max_source_length = 0;
+    ta->max_target_length = 0;
     for (size_t i=0; i<target->n_sentences; i++) {
-        if (target->sentences[i] != NULL && source->sentences[i] != NULL)
-            buf_size += (size_t)target->sentences[i]->length;
+        const size_t source_length = text_sentence_length(source, i);
+        const size_t target_length = text_sentence_length(target, i);
+        if (source_length > MAX_SENT_LEN || target_length > MAX_SENT_LEN) {
+            fprintf(stderr, "text_alignment_create(): sentence %zd is too "
+                            "long, it should have been segmented!\n", i);
+            free(ta);
+            return NULL;
+        }
+        if (source_length && target_length) buf_size += target_length;
+        ta->max_source_length = MAX(ta->max_source_length, source_length);
+        ta->max_target_length = MAX(ta->max_target_length, target_length);
     }
+    ta->n_links = buf_size;
+    ta->n_changed = 0;
+    ta->n_resizes = 0;
     if ((ta->buf = malloc(buf_size*sizeof(link_t))) == NULL) {
         perror("text_alignment_create(): failed to allocate buffer");
         exit(EXIT_FAILURE);
@@ -996,10 +2462,10 @@ struct text_alignment *text_alignment_create(
     }
     link_t *ptr = ta->buf;
     for (size_t i=0; i<target->n_sentences; i++) {
-        if (target->sentences[i] != NULL && source->sentences[i] != NULL)
+        if (text_sentence_length(source, i) && text_sentence_length(target, i))
         {
             ta->sentence_links[i] = ptr;
-            ptr += target->sentences[i]->length;
+            ptr += text_sentence_length(target, i);
         } else {
             ta->sentence_links[i] = NULL;
         }
@@ -1013,6 +2479,38 @@ struct text_alignment *text_alignment_create(
     }
     for (size_t i=0; i<source->vocabulary_size; i++)
         map_token_u32_create(ta->source_count + i);
+
+    // use dense rows for the leading words of the vocabulary which are
+    // frequent enough, judging by their number of tokens in the sentences
+    // that are aligned
+    size_t *n_source = calloc(source->vocabulary_size, sizeof(size_t));
+    if (n_source == NULL) {
+        perror("text_alignment_create(): failed to allocate word counts");
+        exit(EXIT_FAILURE);
+    }
+    size_t n_source_tokens = 0;
+    for (size_t i=0; i<target->n_sentences; i++) {
+        if (ta->sentence_links[i] == NULL) continue;
+        const size_t length = text_sentence_length(source, i);
+        const token *tokens = text_sentence_tokens(source, i);
+        for (size_t j=0; j<length; j++)
+            n_source[tokens[j]]++;
+        n_source_tokens += length;
+    }
+    ta->n_dense = 1;
+    while (ta->n_dense < source->vocabulary_size &&
+           (double)n_source[ta->n_dense] * (double)ta->n_links *
+           DENSE_LINK_RATIO >=
+           (double)n_source_tokens * (double)target->vocabulary_size)
+        ta->n_dense++;
+    free(n_source);
+    if ((ta->dense_counts = calloc((size_t)ta->n_dense*
+                                   target->vocabulary_size,
+                                   sizeof(uint32_t))) == NULL)
+    {
+        perror("text_alignment_create(): failed to allocate dense counts");
+        exit(EXIT_FAILURE);
+    }
     if ((ta->inv_source_count_sum =
          malloc(sizeof(count)*source->vocabulary_size)) == NULL)
     {
@@ -1027,166 +2525,771 @@ struct text_alignment *text_alignment_create(
         exit(EXIT_FAILURE);
     }
 
-    return ta;
+    return ta;
+}
+
+void text_free(struct text *text) {
+    if (text->map != NULL) munmap(text->map, text->map_size);
+    free(text->offsets_buf);
+    free(text->tokens_buf);
+    free(text->filename);
+    free(text);
+}
+
+void text_write(struct text *text, FILE *file) {
+    fprintf(file, "%zd %"PRItoken"\n",
+            text->n_sentences, text->vocabulary_size-1);
+    for (size_t i=0; i<text->n_sentences; i++) {
+        const size_t length = text_sentence_length(text, i);
+        const token *tokens = text_sentence_tokens(text, i);
+        fprintf(file, "%zd", length);
+        for (size_t j=0; j<length; j++) {
+            if (tokens[j] == 0) {
+                fprintf(stderr, "text_write(): NULL token in text\n");
+                exit(1);
+            }
+            fprintf(file, " %"PRItoken, tokens[j] - 1);
+        }
+        fprintf(file, "\n");
+    }
+}
+
+// Check that the offsets and tokens arrays of a text are consistent, so that
+// the sampler can trust them without further checks.
+static int text_check(const struct text *text) {
+    if (text->offsets[0] != 0 ||
+        text->offsets[text->n_sentences] != text->n_tokens)
+    {
+        fprintf(stderr, "text_check(): invalid offsets in %s\n",
+                text->filename);
+        return -1;
+    }
+    for (size_t i=0; i<text->n_sentences; i++) {
+        if (text->offsets[i+1] < text->offsets[i]) {
+            fprintf(stderr, "text_check(): invalid offset of sentence %zd "
+                            "in %s\n", i, text->filename);
+            return -1;
+        }
+    }
+    for (size_t i=0; i<text->n_tokens; i++) {
+        if (text->tokens[i] == 0 || text->tokens[i] >= text->vocabulary_size)
+        {
+            fprintf(stderr, "text_check(): vocabulary size is %"PRItoken
+                            " but found token %"PRItoken" in %s\n",
+                            text->vocabulary_size, text->tokens[i],
+                            text->filename);
+            return -1;
+        }
+    }
+    return 0;
+}
+
+// Read the text format written by write_text() in the Python module, into the
+// same flat arrays used for the binary format.
+static int text_read_plain(struct text *text, FILE *file) {
+    if (fscanf(file, "%zd %"SCNtoken"\n",
+              &(text->n_sentences), &(text->vocabulary_size)) != 2)
+    {
+        fprintf(stderr,
+                "text_read(): failed to read header in %s\n", text->filename);
+        return -1;
+    }
+    // type 0 is always reserved for NULL, so we need to increase vocabulary
+    // size by one
+    text->vocabulary_size++;
+    text->offsets_buf = malloc((text->n_sentences+1)*sizeof(uint64_t));
+    if (text->offsets_buf == NULL) {
+        perror("text_read(): failed to allocate offsets array");
+        exit(EXIT_FAILURE);
+    }
+    size_t tokens_size = 0x10000;
+    if ((text->tokens_buf = malloc(tokens_size*sizeof(token))) == NULL) {
+        perror("text_read(): failed to allocate token array");
+        exit(EXIT_FAILURE);
+    }
+    size_t n_tokens = 0;
+    for (size_t i=0; i<text->n_sentences; i++) {
+        size_t length;
+        text->offsets_buf[i] = n_tokens;
+        if (fscanf(file, "%zd", &length) != 1) {
+            fprintf(stderr, "text_read(): failed to read length of sentence "
+                            "%zd in %s\n", i, text->filename);
+            return -1;
+        }
+        if (n_tokens + length > tokens_size) {
+            while (n_tokens + length > tokens_size) tokens_size *= 2;
+            text->tokens_buf = realloc(text->tokens_buf,
+                                       tokens_size*sizeof(token));
+            if (text->tokens_buf == NULL) {
+                perror("text_read(): failed to reallocate token array");
+                exit(EXIT_FAILURE);
+            }
+        }
+        for (size_t j=0; j<length; j++) {
+            token t;
+            if (fscanf(file, "%"SCNtoken, &t) != 1) {
+                fprintf(stderr, "text_read(): failed to read token in "
+                                "sentence %zd of %s\n", i, text->filename);
+                return -1;
+            }
+            text->tokens_buf[n_tokens++] = t + 1;
+        }
+    }
+    text->offsets_buf[text->n_sentences] = n_tokens;
+    text->n_tokens = n_tokens;
+    text->max_length = 0;
+    for (size_t i=0; i<text->n_sentences; i++)
+        text->max_length = MAX(text->max_length,
+                               text->offsets_buf[i+1] - text->offsets_buf[i]);
+    text->offsets = text->offsets_buf;
+    text->tokens = text->tokens_buf;
+    return 0;
+}
+
+static int text_set_header(
+        struct text *text, const struct text_header *header) {
+    if (memcmp(header->magic, TEXT_MAGIC, 4)) {
+        fprintf(stderr, "text_read(): invalid header in %s\n",
+                text->filename);
+        return -1;
+    }
+    if (header->version != TEXT_VERSION) {
+        fprintf(stderr, "text_read(): unsupported version %"PRIu32" of %s\n",
+                header->version, text->filename);
+        return -1;
+    }
+    text->n_sentences = header->n_sentences;
+    text->n_tokens = header->n_tokens;
+    text->vocabulary_size = header->vocabulary_size + 1;
+    text->max_length = header->max_length;
+    return 0;
+}
+
+// Read the binary format, using a memory map if the file supports it and
+// falling back to reading into buffers otherwise (e.g. for pipes).
+static int text_read_binary(struct text *text, FILE *file) {
+    struct text_header header;
+    struct stat st;
+    if (file != stdin && fstat(fileno(file), &st) == 0 &&
+            S_ISREG(st.st_mode) && (size_t)st.st_size >= sizeof(header))
+    {
+        void *map = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE,
+                         fileno(file), 0);
+        if (map == MAP_FAILED) {
+            perror("text_read(): failed to map file");
+            return -1;
+        }
+        text->map = map;
+        text->map_size = st.st_size;
+        memcpy(&header, map, sizeof(header));
+        if (text_set_header(text, &header)) return -1;
+        if (text->map_size != sizeof(header) +
+                (text->n_sentences+1)*sizeof(uint64_t) +
+                text->n_tokens*sizeof(token))
+        {
+            fprintf(stderr, "text_read(): unexpected size of %s\n",
+                    text->filename);
+            return -1;
+        }
+        madvise(map, st.st_size, MADV_SEQUENTIAL);
+        text->offsets = (const uint64_t*)((const char*)map + sizeof(header));
+        text->tokens = (const token*)(text->offsets + text->n_sentences + 1);
+        return 0;
+    }
+
+    if (fread(&header, sizeof(header), 1, file) != 1) {
+        fprintf(stderr, "text_read(): failed to read header in %s\n",
+                text->filename);
+        return -1;
+    }
+    if (text_set_header(text, &header)) return -1;
+    text->offsets_buf = malloc((text->n_sentences+1)*sizeof(uint64_t));
+    text->tokens_buf = malloc((text->n_tokens+1)*sizeof(token));
+    if (text->offsets_buf == NULL || text->tokens_buf == NULL) {
+        perror("text_read(): failed to allocate arrays");
+        exit(EXIT_FAILURE);
+    }
+    if (fread(text->offsets_buf, sizeof(uint64_t), text->n_sentences+1, file)
+            != text->n_sentences+1 ||
+        fread(text->tokens_buf, sizeof(token), text->n_tokens, file)
+            != text->n_tokens)
+    {
+        fprintf(stderr, "text_read(): unexpected end of %s\n",
+                text->filename);
+        return -1;
+    }
+    text->offsets = text->offsets_buf;
+    text->tokens = text->tokens_buf;
+    return 0;
+}
+
+struct text* text_read(const char *filename) {
+    FILE *file = (!strcmp(filename, "-"))? stdin: fopen(filename, "rb");
+    if (file == NULL) {
+        perror("text_read(): failed to open text file");
+        return NULL;
+    }
+    struct text *text = calloc(1, sizeof(struct text));
+    if (text == NULL) {
+        perror("text_read(): failed to allocate structure");
+        if (file != stdin) fclose(file);
+        return NULL;
+    }
+    if ((text->filename = malloc(strlen(filename)+1)) == NULL) {
+        perror("text_read(): failed to allocate filename string");
+        exit(EXIT_FAILURE);
+    }
+    strcpy(text->filename, filename);
+    // The binary format starts with TEXT_MAGIC, the text format with a digit
+    const int c = getc(file);
+    ungetc(c, file);
+    const int r = (c == TEXT_MAGIC[0])? text_read_binary(text, file)
+                                      : text_read_plain(text, file);
+    if (file != stdin) fclose(file);
+    if (r || text_check(text)) {
+        text_free(text);
+        return NULL;
+    }
+    return text;
+}
+
+// Append the sentences of b to a, copying both into buffers owned by a. The
+// token numbers of b should extend the vocabulary of a (see Aligner.align()
+// in the Python module), so the larger of the two vocabularies is used.
+int text_append(struct text *a, const struct text *b) {
+    uint64_t *offsets = malloc(
+            (a->n_sentences+b->n_sentences+1)*sizeof(uint64_t));
+    token *tokens = malloc((a->n_tokens+b->n_tokens+1)*sizeof(token));
+    if (offsets == NULL || tokens == NULL) {
+        perror("text_append(): failed to allocate arrays");
+        free(offsets);
+        free(tokens);
+        return -1;
+    }
+    memcpy(offsets, a->offsets, (a->n_sentences+1)*sizeof(uint64_t));
+    for (size_t i=1; i<=b->n_sentences; i++)
+        offsets[a->n_sentences+i] = a->n_tokens + b->offsets[i];
+    memcpy(tokens, a->tokens, a->n_tokens*sizeof(token));
+    memcpy(tokens + a->n_tokens, b->tokens, b->n_tokens*sizeof(token));
+    if (a->map != NULL) munmap(a->map, a->map_size);
+    free(a->offsets_buf);
+    free(a->tokens_buf);
+    a->map = NULL;
+    a->offsets = a->offsets_buf = offsets;
+    a->tokens = a->tokens_buf = tokens;
+    a->n_sentences += b->n_sentences;
+    a->n_tokens += b->n_tokens;
+    a->max_length = MAX(a->max_length, b->max_length);
+    a->vocabulary_size = MAX(a->vocabulary_size, b->vocabulary_size);
+    return 0;
 }
 
-void sentence_free(struct sentence *sentence) {
-    free(sentence);
+// Hash of the tokens of sentence pair i, for text_deduplicate()
+static uint64_t sentence_pair_hash(
+        const struct text *source, const struct text *target, size_t i) {
+    uint64_t h = hash_u64_u64(
+            ((uint64_t)text_sentence_length(source, i) << 32) ^
+            (uint64_t)text_sentence_length(target, i));
+    for (int side=0; side<2; side++) {
+        const struct text *text = side? target: source;
+        const token *tokens = text_sentence_tokens(text, i);
+        for (size_t j=0; j<text_sentence_length(text, i); j++)
+            h = hash_u64_u64(h ^ tokens[j]);
+    }
+    return h;
 }
 
-struct sentence *sentence_read(FILE *file, token vocabulary_size) {
-    link_t length;
-    if (fscanf(file, "%"SCNlink, &length) != 1) {
-        perror("sentence_read(): failed to read sentence length");
-        exit(EXIT_FAILURE);
+static int sentence_pairs_equal(
+        const struct text *source, const struct text *target,
+        size_t i, size_t k) {
+    for (int side=0; side<2; side++) {
+        const struct text *text = side? target: source;
+        const size_t length = text_sentence_length(text, i);
+        if (length != text_sentence_length(text, k) ||
+                memcmp(text_sentence_tokens(text, i),
+                       text_sentence_tokens(text, k), length*sizeof(token)))
+            return 0;
     }
-    if (length == 0) return NULL;
-    if (length > MAX_SENT_LEN) {
-        perror("sentence_read(): sentence too long");
-        exit(EXIT_FAILURE);
+    return 1;
+}
+
+struct hashed_sentence {
+    uint64_t hash;
+    uint64_t index;
+};
+
+static int hashed_sentence_cmp(const void *a, const void *b) {
+    const struct hashed_sentence *x = a, *y = b;
+    if (x->hash != y->hash) return (x->hash < y->hash)? -1: 1;
+    return (x->index < y->index)? -1: (x->index > y->index);
+}
+
+// Merge the identical sentence pairs among the first n_dedup sentences of
+// source and target, which are replaced (copying them into buffers owned by
+// the texts, as in text_append()) by texts where each distinct pair occurs
+// once, in order of first occurrence, followed by the remaining sentences.
+// Each copy can then be aligned by aligning the pair once, with its counts
+// weighted by the number of copies (see text_alignment_weight()).
+//
+// lines receives the new index of each original sentence, and weights the
+// number of copies of each new sentence. If there are no identical pairs,
+// the texts are left as they are and both are set to NULL. Returns 0 on
+// success and -1 on error.
+int text_deduplicate(
+        struct text *source, struct text *target, size_t n_dedup,
+        uint64_t **lines, uint32_t **weights) {
+    const size_t n_sentences = source->n_sentences;
+    struct hashed_sentence *hashed =
+        malloc(MAX(1, n_dedup)*sizeof(struct hashed_sentence));
+    // index of the first copy of each sentence, and then its new index
+    uint64_t *first = malloc(MAX(1, n_sentences)*sizeof(uint64_t));
+    if (hashed == NULL || first == NULL) {
+        perror("text_deduplicate(): failed to allocate hashes");
+        free(hashed);
+        free(first);
+        return -1;
     }
-    struct sentence *sentence;
-    sentence = malloc(sizeof(struct sentence) + length*sizeof(token));
-    if (sentence == NULL) {
-        perror("sentence_read(): failed to allocate structure");
-        exit(EXIT_FAILURE);
+    for (size_t i=0; i<n_dedup; i++) {
+        hashed[i].hash = sentence_pair_hash(source, target, i);
+        hashed[i].index = i;
     }
-    sentence->length = length;
-    for (link_t i=0; i<length; i++) {
-        if (fscanf(file, "%"SCNtoken, &(sentence->tokens[i])) != 1) {
-            perror("sentence_read(): failed to read token");
-            exit(EXIT_FAILURE);
+    qsort(hashed, n_dedup, sizeof(*hashed), hashed_sentence_cmp);
+    // the sentences with the same hash are sorted by index, so the first
+    // copy of each pair comes first (and a different pair with the same
+    // hash is very unlikely)
+    for (size_t begin=0, end; begin<n_dedup; begin=end) {
+        for (end=begin+1; end<n_dedup && hashed[end].hash==hashed[begin].hash;
+             end++);
+        for (size_t k=begin; k<end; k++) {
+            const size_t i = hashed[k].index;
+            first[i] = i;
+            for (size_t l=begin; l<k; l++) {
+                const size_t i0 = hashed[l].index;
+                if (first[i0] == i0 &&
+                        sentence_pairs_equal(source, target, i0, i)) {
+                    first[i] = i0;
+                    break;
+                }
+            }
         }
-        sentence->tokens[i]++;
-        if (sentence->tokens[i] >= vocabulary_size) {
-            fprintf(stderr, "sentence_read(): vocabulary size is %"PRItoken
-                            " but found token %"PRItoken"\n",
-                            vocabulary_size, sentence->tokens[i]);
-            exit(EXIT_FAILURE);
+    }
+    free(hashed);
+
+    size_t n_unique = 0, n_tokens[2] = {0, 0};
+    for (size_t i=0; i<n_sentences; i++) {
+        if (i < n_dedup && first[i] != i) continue;
+        n_unique++;
+        n_tokens[0] += text_sentence_length(source, i);
+        n_tokens[1] += text_sentence_length(target, i);
+    }
+    *lines = NULL;
+    *weights = NULL;
+    if (n_unique == n_sentences) {
+        free(first);
+        return 0;
+    }
+
+    uint32_t *copies = calloc(n_unique, sizeof(uint32_t));
+    for (int side=0; side<2; side++) {
+        struct text *text = side? target: source;
+        uint64_t *offsets = malloc((n_unique+1)*sizeof(uint64_t));
+        token *tokens = malloc((n_tokens[side]+1)*sizeof(token));
+        if (copies == NULL || offsets == NULL || tokens == NULL) {
+            perror("text_deduplicate(): failed to allocate arrays");
+            free(copies);
+            free(offsets);
+            free(tokens);
+            free(first);
+            return -1;
         }
+        size_t k = 0;
+        offsets[0] = 0;
+        for (size_t i=0; i<n_sentences; i++) {
+            if (i < n_dedup && first[i] != i) continue;
+            const size_t length = text_sentence_length(text, i);
+            memcpy(tokens + offsets[k], text_sentence_tokens(text, i),
+                   length*sizeof(token));
+            offsets[k+1] = offsets[k] + length;
+            k++;
+        }
+        if (text->map != NULL) munmap(text->map, text->map_size);
+        free(text->offsets_buf);
+        free(text->tokens_buf);
+        text->map = NULL;
+        text->offsets = text->offsets_buf = offsets;
+        text->tokens = text->tokens_buf = tokens;
+        text->n_sentences = n_unique;
+        text->n_tokens = n_tokens[side];
+    }
+    // the first copy of a sentence always comes before the others, so
+    // first[] can be replaced by the new indexes in place
+    size_t k = 0;
+    for (size_t i=0; i<n_sentences; i++) {
+        first[i] = (i < n_dedup && first[i] != i)? first[first[i]]: k++;
+        copies[first[i]]++;
     }
-    return sentence;
+    *lines = first;
+    *weights = copies;
+    return 0;
 }
 
-void text_free(struct text *text) {
-    for (size_t i=0; i<text->n_sentences; i++)
-        if (text->sentences[i] != NULL) sentence_free(text->sentences[i]);
-    free(text->sentences);
-    free(text);
+// Return the number of segments that sentence pair i is split into, so that
+// no segment is longer than MAX_SENT_LEN
+static size_t segment_count(
+        const struct text *source, const struct text *target, size_t i) {
+    const size_t length = MAX(text_sentence_length(source, i),
+                              text_sentence_length(target, i));
+    return (length == 0)? 1: 1 + (length-1) / MAX_SENT_LEN;
 }
 
-void text_write(struct text *text, FILE *file) {
-    fprintf(file, "%zd %"PRItoken"\n",
-            text->n_sentences, text->vocabulary_size);
-    for (size_t i=0; i<text->n_sentences; i++) {
-        const struct sentence *sentence = text->sentences[i];
-        if (sentence == NULL) {
-            fprintf(file, "0\n");
-        } else {
-            fprintf(file, "%"PRIlink, sentence->length);
-            if (sentence->tokens[i] == 0) {
-                perror("text_write(): NULL token in text");
-                exit(1);
-            }
-            for (link_t j=0; j<sentence->length; j++) {
-                fprintf(file, " %"PRItoken, sentence->tokens[j] - 1);
-            }
-            fprintf(file, "\n");
+// Split the sentence pairs of source and target that are longer than
+// MAX_SENT_LEN into segments. Both sentences of a pair are split into the
+// same number of segments of equal length, so that the segments follow the
+// diagonal of the pair. If one of the sentences is too short to give every
+// segment at least one token, the segments where it is empty are left
+// unaligned. Sentences with NULL_POSITION tokens or more are rejected, since
+// their positions would not fit in the output.
+//
+// Returns 0 on success, or -1 (with nothing to free) if a sentence is too
+// long or the segments could not be allocated.
+int segmentation_create(
+        struct segmentation *seg,
+        const struct text *source,
+        const struct text *target)
+{
+    size_t n_segments = 0;
+    for (size_t i=0; i<source->n_sentences; i++) {
+        if (text_sentence_length(source, i) >= NULL_POSITION ||
+            text_sentence_length(target, i) >= NULL_POSITION)
+        {
+            fprintf(stderr, "segmentation_create(): sentence %zu is too "
+                            "long (at most %u tokens are supported)\n",
+                    i+1, NULL_POSITION-1);
+            return -1;
         }
+        n_segments += segment_count(source, target, i);
     }
-}
 
-struct text* text_read(const char *filename) {
-    FILE *file = (!strcmp(filename, "-"))? stdin: fopen(filename, "r");
-    if (file == NULL) {
-        perror("text_read(): failed to open text file");
-        return NULL;
+    seg->n_lines = source->n_sentences;
+    seg->n_training = 0;
+    seg->lines = NULL;
+    seg->n_sentences = source->n_sentences;
+    seg->weights = NULL;
+    seg->first = NULL;
+    seg->source = source;
+    seg->target = target;
+    if (n_segments == source->n_sentences) return 0;
+
+    if ((seg->first = malloc((seg->n_sentences+1)*sizeof(uint64_t))) == NULL)
+    {
+        perror("segmentation_create(): failed to allocate segment indexes");
+        return -1;
     }
-    struct text *text = malloc(sizeof(struct text));
-    if (text == NULL) {
-        perror("text_read(): failed to allocate structure");
-        if (file != stdin) fclose(file);
-        return NULL;
+    for (int side=0; side<2; side++) {
+        const struct text *text = side? target: source;
+        struct text *segments = seg->segments + side;
+        memset(segments, 0, sizeof(*segments));
+        segments->filename = text->filename;
+        segments->n_sentences = n_segments;
+        segments->vocabulary_size = text->vocabulary_size;
+        segments->n_tokens = text->n_tokens;
+        segments->max_length = MIN(text->max_length, MAX_SENT_LEN);
+        segments->tokens = text->tokens;
+        segments->offsets_buf = malloc((n_segments+1)*sizeof(uint64_t));
+        if (segments->offsets_buf == NULL) {
+            perror("segmentation_create(): failed to allocate offsets");
+            if (side) free(seg->segments[0].offsets_buf);
+            free(seg->first);
+            seg->first = NULL;
+            return -1;
+        }
+        segments->offsets = segments->offsets_buf;
     }
-    if ((text->filename = malloc(strlen(filename)+1)) == NULL) {
-        perror("text_read(): failed to allocate filename string");
-        exit(EXIT_FAILURE);
+
+    size_t k = 0;
+    for (size_t i=0; i<seg->n_sentences; i++) {
+        const size_t n = segment_count(source, target, i);
+        seg->first[i] = k;
+        for (size_t s=0; s<n; s++, k++) {
+            seg->segments[0].offsets_buf[k] = source->offsets[i] +
+                text_sentence_length(source, i)*s/n;
+            seg->segments[1].offsets_buf[k] = target->offsets[i] +
+                text_sentence_length(target, i)*s/n;
+        }
     }
-    strcpy(text->filename, filename);
-    if (fscanf(file, "%zd %"SCNtoken"\n",
-              &(text->n_sentences), &(text->vocabulary_size)) != 2)
-    {
-        fprintf(stderr,
-                "text_read(): failed to read header in %s\n", filename);
-        free(text);
-        if (file != stdin) fclose(file);
-        return NULL;
+    seg->first[seg->n_sentences] = k;
+    seg->segments[0].offsets_buf[k] = source->n_tokens;
+    seg->segments[1].offsets_buf[k] = target->n_tokens;
+    seg->source = seg->segments;
+    seg->target = seg->segments + 1;
+    return 0;
+}
+
+// Record that the texts of seg were deduplicated from n_lines lines by
+// text_deduplicate(), which gave lines and weights. These are then owned by
+// seg.
+void segmentation_set_lines(
+        struct segmentation *seg, size_t n_lines, uint64_t *lines,
+        uint32_t *weights) {
+    seg->n_lines = n_lines;
+    seg->lines = lines;
+    if (seg->first == NULL) {
+        seg->weights = weights;
+        return;
     }
-    // type 0 is always reserved for NULL, so we need to increase vocabulary
-    // size by one
-    text->vocabulary_size++;
-    text->sentences = malloc(text->n_sentences * sizeof(struct sentence*));
-    if (text->sentences == NULL) {
-        perror("text_read(): failed to allocate sentence array");
+    // the segments of a sentence have as many copies as the sentence
+    seg->weights = malloc(seg->source->n_sentences*sizeof(uint32_t));
+    if (seg->weights == NULL) {
+        perror("segmentation_set_lines(): failed to allocate weights");
         exit(EXIT_FAILURE);
     }
-    for (size_t i=0; i<text->n_sentences; i++)
-        text->sentences[i] = sentence_read(file, text->vocabulary_size);
-    if (file != stdin) fclose(file);
-    return text;
+    for (size_t i=0; i<seg->n_sentences; i++)
+        for (size_t k=seg->first[i]; k<seg->first[i+1]; k++)
+            seg->weights[k] = weights[i];
+    free(weights);
 }
 
-static void align(
+void segmentation_free(struct segmentation *seg) {
+    free(seg->lines);
+    free(seg->weights);
+    if (seg->first == NULL) return;
+    free(seg->first);
+    free(seg->segments[0].offsets_buf);
+    free(seg->segments[1].offsets_buf);
+}
+
+// Sum the scores of the segments of each sentence, weighted by the length
+// of the (target) segments, into the scores of the original sentences
+static void segmentation_merge_scores(
+        const struct segmentation *seg, const struct text_alignment *ta,
+        const count *segment_scores, count *scores) {
+    for (size_t sent=0; sent<seg->n_sentences; sent++) {
+        const size_t end_segment = segmentation_first(seg, sent+1);
+        count sum = (count)0.0, length_sum = (count)0.0;
+        for (size_t k=segmentation_first(seg, sent); k<end_segment; k++) {
+            if (ta->sentence_links[k] == NULL) continue;
+            const count length = (count)text_sentence_length(ta->target, k);
+            sum += segment_scores[k] * length;
+            length_sum += length;
+        }
+        scores[sent] = (length_sum == (count)0.0)? (count)0.0
+                                                 : sum / length_sum;
+    }
+}
+
+// Estimate the memory (in bytes) of the texts, which are shared by all
+// samplers. Only the header fields (numbers of sentences and tokens) are
+// used.
+static size_t text_memory(const struct text *text) {
+    return (text->n_sentences+1)*sizeof(uint64_t) +
+           (text->n_tokens+1)*sizeof(token);
+}
+
+// Estimate the peak memory (in bytes) of one sampler created by
+// text_alignment_create(source, target), including the buffers used while
+// sampling with n_threads threads. Like text_memory(), this only uses the
+// header fields of the texts.
+static size_t text_alignment_memory(
+        const struct text *source, const struct text *target, int n_threads)
+{
+    const size_t vocabulary_size = source->vocabulary_size;
+    size_t size = sizeof(struct text_alignment) +
+        target->n_tokens*sizeof(link_t) +
+        target->n_sentences*sizeof(link_t*) +
+        vocabulary_size*(sizeof(struct map_token_u32) + sizeof(count) +
+                         FERT_ARRAY_LEN*sizeof(count)) +
+        MAP_SLOTS_PER_LINK*target->n_tokens*(sizeof(token)+sizeof(uint32_t));
+    // dense count rows (see text_alignment_create()): a word other than NULL
+    // only gets one if it makes up a fraction of at least
+    // target->vocabulary_size / (DENSE_LINK_RATIO*n_links) of the source
+    // tokens, so there are at most 1 + DENSE_LINK_RATIO*n_links /
+    // target->vocabulary_size rows, with n_links <= target->n_tokens
+    const size_t n_dense = MIN(vocabulary_size,
+            1 + DENSE_LINK_RATIO*target->n_tokens/
+                MAX(1, target->vocabulary_size));
+    size += n_dense*target->vocabulary_size*sizeof(uint32_t);
+    // sentence order and fertility sampling buffers, and the sampling
+    // buffers of each thread (see sample_buffers_create()), of which the
+    // first is also used for argmax
+    const size_t max_source_length = MIN(source->max_length, MAX_SENT_LEN);
+    const size_t max_target_length = MIN(target->max_length, MAX_SENT_LEN);
+    size += target->n_sentences*sizeof(size_t) +
+            vocabulary_size*sizeof(size_t) +
+            sample_buffers_memory(max_source_length, max_target_length, 1) +
+            (size_t)(MAX(1, n_threads) - 1)*
+                sample_buffers_memory(max_source_length, max_target_length,
+                                      0);
+    // thread-local counts of text_alignment_sample_parallel(), where the
+    // changes of an iteration have at most one item per link
+    if (n_threads > 1)
+        size += n_threads*vocabulary_size*sizeof(count) +
+                vocabulary_size*sizeof(int32_t) +
+                MAP_SLOTS_PER_LINK*target->n_tokens*
+                    (sizeof(uint64_t)+sizeof(uint32_t));
+    return size;
+}
+
+// Resources used to align a pair of texts, see memory_plan_create()
+struct memory_plan {
+    int n_samplers;
+    // threads per sampler
+    int n_threads;
+    // if zero, the directions are aligned one after the other
+    int parallel_directions;
+    // estimated peak memory use in bytes
+    size_t peak_memory;
+};
+
+static size_t memory_plan_peak(
+        const struct memory_plan *plan,
+        const struct text *source, const struct text *target,
+        int directions, int keep_results, size_t shared_memory)
+{
+    size_t sampler[2] = {0, 0};
+    for (int reverse=0; reverse<=1; reverse++)
+        if (directions & (1 << reverse))
+            sampler[reverse] = text_alignment_memory(
+                    reverse? target: source, reverse? source: target,
+                    plan->n_threads);
+    if (plan->parallel_directions)
+        return shared_memory + plan->n_samplers*(sampler[0] + sampler[1]);
+    // the final alignment of the forward direction may be kept while the
+    // reverse direction is sampled
+    return shared_memory + MAX(
+            plan->n_samplers*sampler[0],
+            plan->n_samplers*sampler[1] + (keep_results? sampler[0]: 0));
+}
+
+// Plan the resources used to align source and target in the directions
+// given by the bitmask directions (1 = forward, 2 = reverse), starting
+// from n_samplers samplers with n_threads threads each and the directions
+// aligned in parallel. keep_results is non-zero if the final alignment of
+// each direction is kept until both are done (for snapshots and
+// symmetrization), and shared_memory is the memory used by anything else
+// (e.g. priors).
+//
+// If max_memory (in bytes) or max_threads (in total) are non-zero and the
+// plan exceeds them, the number of threads per sampler is first reduced to
+// fit max_threads, then the directions are aligned one after the other,
+// and finally the numbers of samplers and threads are reduced. Returns 0 if
+// the plan fits the budget, and -1 if it does not even with one sampler
+// and one thread.
+int memory_plan_create(
+        struct memory_plan *plan,
+        const struct text *source,
+        const struct text *target,
+        int directions,
+        int keep_results,
+        size_t shared_memory,
+        int n_samplers,
+        int n_threads,
+        size_t max_memory,
+        int max_threads)
+{
+    const int n_directions = (directions & 1) + ((directions >> 1) & 1);
+    shared_memory += text_memory(source) + text_memory(target);
+    plan->n_samplers = n_samplers;
+    plan->n_threads = n_threads;
+    plan->parallel_directions = n_directions > 1;
+    for (;;) {
+        plan->peak_memory = memory_plan_peak(
+                plan, source, target, directions, keep_results,
+                shared_memory);
+        const int threads = plan->n_samplers * plan->n_threads *
+                            (plan->parallel_directions? n_directions: 1);
+        const int over_memory = max_memory && plan->peak_memory > max_memory;
+        const int over_threads = max_threads > 0 && threads > max_threads;
+        if (!over_memory && !over_threads) return 0;
+        if (over_threads && plan->n_threads > 1) plan->n_threads--;
+        else if (plan->parallel_directions) plan->parallel_directions = 0;
+        else if (plan->n_samplers > 1) plan->n_samplers--;
+        else if (plan->n_threads > 1) plan->n_threads--;
+        else return -1;
+    }
+}
+
+// Write a telemetry record for one sampling iteration, which took the given
+// number of seconds. Nothing is done (in particular, the count tables are
+// not scanned) unless telemetry is enabled.
+static void text_alignment_telemetry(
+        const struct text_alignment *ta, int reverse, int sampler,
+        int iteration, double elapsed) {
+    if (telemetry_file == NULL) return;
+    size_t n_items = 0, map_size = 0;
+    for (size_t e=ta->n_dense; e<ta->source->vocabulary_size; e++) {
+        const struct map_token_u32 *m = ta->source_count + e;
+        n_items += m->n_items;
+        map_size += map_token_u32_is_dynamic(m)? m->structure.dynamic.size
+                                               : MAX_FIXED;
+    }
+    telemetry_write(
+        "\"event\": \"iteration\", \"direction\": \"%s\", \"model\": %d, "
+        "\"sampler\": %d, \"iteration\": %d, \"seconds\": %.6f, "
+        "\"tokens_per_second\": %.1f, \"changed\": %.6f, "
+        "\"map_items\": %zu, \"map_size\": %zu, \"map_resizes\": %zu, "
+        "\"dense_words\": %zu",
+        reverse? "reverse": "forward", ta->model, sampler, iteration, elapsed,
+        (double)text_alignment_n_sampled(ta) / MAX(elapsed, 1e-9),
+        (double)ta->n_changed / (double)MAX(1, text_alignment_n_sampled(ta)),
+        n_items, map_size, ta->n_resizes, (size_t)ta->n_dense);
+}
+
+// Run the full sampling schedule of n_samplers independent samplers, ending
+// with an argmax iteration over their combined distributions. The final
+// alignment is returned, the remaining samplers are freed.
+//
+// If tolerance is positive, n_iters is an upper bound: a sampler moves on
+// to the next model when the fraction of links that changed in an iteration
+// has decreased by less than tolerance (relative to the previous iteration)
+// for CONVERGENCE_PATIENCE iterations in a row. Since sampling never stops
+// changing the links, the fraction itself levels off above zero rather than
+// converging to it.
+static struct text_alignment *align_sample(
         int reverse,
         const struct text *source,
         const struct text *target,
         int model,
-        int score_model,
         double null_prior,
         int n_samplers,
+        int n_threads,
         int quiet,
         const int *n_iters,
-        const char *links_filename,
-        const char *stats_filename,
-        const char *scores_filename,
-        const char *priors_filename)
+        double tolerance,
+        const struct priors *priors,
+        size_t n_clean,
+        const uint32_t *weights,
+        random_state *state)
 {
     double t0;
-    random_state state;
     struct text_alignment *tas[n_samplers];
-
-    random_system_state(&state);
+    // very small shards are not worth the synchronization overhead
+    const int max_threads = (int) MIN((size_t)n_threads,
+            1 + target->n_sentences / MIN_THREAD_SENTENCES);
 
     t0 = seconds();
     for (int i=0; i<n_samplers; i++) {
         tas[i] = text_alignment_create(
                 (reverse? target: source), (reverse? source: target));
+        if (tas[i] == NULL) exit(EXIT_FAILURE);
         tas[i]->null_prior = null_prior;
-        if (priors_filename != NULL) {
-            // TODO: since read-only, could use the pointer from tas[0]
-            //       for everything, but this would require careful
-            //       initialization/destruction
-            if(text_alignment_load_priors(tas[i], priors_filename, reverse)) {
-                fprintf(stderr, "Unable to load %s, exiting\n",
-                        priors_filename);
-                exit(1);
-            }
-        }
+        tas[i]->priors = priors;
+        tas[i]->n_clean = n_clean;
+        tas[i]->weights = weights;
     }
     if (!quiet)
         fprintf(stderr, "Created alignment structures: %.3f s\n",
                 seconds() - t0);
 
+    // the states of the samplers are split off in order here rather than
+    // inside the parallel loops, so that a seeded run is reproducible
+    random_state local_states[n_samplers];
+
     t0 = seconds();
+    for (int i=0; i<n_samplers; i++)
+        local_states[i] = random_split_state(state);
 #pragma omp parallel for
-    for (int i=0; i<n_samplers; i++) {
-        random_state local_state;
-#pragma omp critical
-        {
-            local_state = random_split_state(&state);
-        }
-        text_alignment_randomize(tas[i], &local_state);
-    }
+    for (int i=0; i<n_samplers; i++)
+        text_alignment_randomize(tas[i], local_states + i);
     if (!quiet)
         fprintf(stderr, "Randomized alignment: %.3f s\n", seconds() - t0);
 
@@ -1197,20 +3300,56 @@ static void align(
                         m, n_iters[m-1]);
             t0 = seconds();
 
+            for (int i=0; i<n_samplers; i++)
+                local_states[i] = random_split_state(state);
 #pragma omp parallel for
             for (int i=0; i<n_samplers; i++) {
-                random_state local_state;
-#pragma omp critical
-                {
-                    local_state = random_split_state(&state);
-                }
+                random_state local_state = local_states[i];
                 tas[i]->model = m;
+                // the sentences after n_clean do not affect the counts, so
+                // they only need to be sampled with the final model
+                tas[i]->sample_end = (n_clean && m < model)
+                                     ? n_clean : tas[i]->target->n_sentences;
 
                 text_alignment_make_counts(tas[i]);
 
-                for (int j=0; j<n_iters[m-1]; j++) {
-                    text_alignment_sample(tas[i], &local_state, NULL, NULL, 1);
+                double last_changed = 1.0;
+                const double t_model = seconds();
+                int n_converged = 0, j;
+                for (j=0; j<n_iters[m-1]; j++) {
+                    const double t_iteration = seconds();
+                    if (max_threads > 1)
+                        text_alignment_sample_parallel(
+                                tas[i], &local_state, max_threads);
+                    else
+                        text_alignment_sample(
+                                tas[i], &local_state, NULL, NULL, 1);
+                    text_alignment_telemetry(
+                            tas[i], reverse, i, j, seconds() - t_iteration);
+                    if (tolerance > 0.0) {
+                        const double changed =
+                            (double)tas[i]->n_changed /
+                            (double)MAX(1, text_alignment_n_sampled(tas[i]));
+                        if (last_changed - changed <= tolerance*last_changed)
+                            n_converged++;
+                        else
+                            n_converged = 0;
+                        last_changed = changed;
+                        if (n_converged >= CONVERGENCE_PATIENCE) {
+                            j++;
+                            break;
+                        }
+                    }
                 }
+                if (!quiet && j < n_iters[m-1])
+                    fprintf(stderr, "Sampler %d converged after %d "
+                                    "iterations\n", i, j);
+                telemetry_write(
+                    "\"event\": \"model\", \"direction\": \"%s\", "
+                    "\"model\": %d, \"sampler\": %d, \"iterations\": %d, "
+                    "\"seconds\": %.6f",
+                    reverse? "reverse": "forward", m, i, j,
+                    seconds() - t_model);
             }
             if (!quiet)
                 fprintf(stderr, "Done: %.3f s\n", seconds() - t0);
@@ -1218,11 +3357,102 @@ static void align(
     }
 
     t0 = seconds();
-    text_alignment_sample(tas[0], &state, NULL, tas, n_samplers);
+    // only the links of the sentences after n_clean are used
+    for (int i=0; i<n_samplers; i++) {
+        tas[i]->sample_begin = n_clean;
+        tas[i]->sample_end = tas[i]->target->n_sentences;
+    }
+    text_alignment_sample(tas[0], state, NULL, tas, n_samplers);
     if (!quiet)
         fprintf(stderr, "Final argmax iteration: %.3f s\n", seconds() - t0);
+    telemetry_write(
+        "\"event\": \"argmax\", \"direction\": \"%s\", \"seconds\": %.6f",
+        reverse? "reverse": "forward", seconds() - t0);
+
+    for (int i=1; i<n_samplers; i++)
+        text_alignment_free(tas[i]);
+
+    return tas[0];
+}
+
+// Compute sentence scores (negative log-probabilities per token) using
+// score_model. The scores array must contain one element per sentence.
+static void align_scores(
+        struct text_alignment *ta,
+        int score_model,
+        int quiet,
+        random_state *state,
+        count *scores)
+{
+    for (size_t i=0; i<ta->source->n_sentences; i++)
+        scores[i] = (count)0.0;
+
+    if (!quiet)
+        fprintf(stderr,
+                "Computing scores using model %d for %zu sentences\n",
+                score_model, ta->source->n_sentences);
+
+    // Switch to whatever model is specified for scoring
+    ta->model = score_model;
+    text_alignment_sample(ta, state, scores, NULL, 1);
+
+    for (size_t i=0; i<ta->source->n_sentences; i++)
+        scores[i] = -scores[i];
+}
+
+// Copy the links of an alignment into a flat array with one element per
+// token of ta->target, containing the index of the linked ta->source token
+// (within the original sentence) or NULL_POSITION.
+void text_alignment_get_links(
+        const struct text_alignment *ta, const struct segmentation *seg,
+        position *out) {
+    for (size_t sent=0; sent<seg->n_sentences; sent++) {
+        const size_t first_segment = segmentation_first(seg, sent);
+        const size_t end_segment = segmentation_first(seg, sent+1);
+        for (size_t k=first_segment; k<end_segment; k++) {
+            const size_t length = text_sentence_length(ta->target, k);
+            const size_t i0 =
+                ta->source->offsets[k] - ta->source->offsets[first_segment];
+            position *dest = out + ta->target->offsets[k];
+            const link_t *links = ta->sentence_links[k];
+            for (size_t j=0; j<length; j++) {
+                dest[j] = (links == NULL || links[j] == NULL_LINK)
+                          ? NULL_POSITION : (position)(i0 + links[j]);
+            }
+        }
+    }
+}
+
+static void align(
+        int reverse,
+        const struct segmentation *seg,
+        int model,
+        int score_model,
+        double null_prior,
+        int n_samplers,
+        int n_threads,
+        int quiet,
+        const int *n_iters,
+        double tolerance,
+        int64_t seed,
+        const char *links_filename,
+        int binary_links,
+        const char *stats_filename,
+        const char *scores_filename,
+        const struct priors *priors,
+        struct text_alignment **result_ta)
+{
+    random_state state;
+
+    if (seed < 0) random_system_state(&state);
+    else random_seed_state(&state, (uint64_t)seed, reverse);
 
-    struct text_alignment *ta = tas[0];
+    struct text_alignment *ta = align_sample(
+            reverse, seg->source, seg->target, model, null_prior, n_samplers,
+            n_threads, quiet, n_iters, tolerance, priors,
+            segmentation_first(seg,
+                               segmentation_sentence(seg, seg->n_training)),
+            seg->weights, &state);
 
     if (stats_filename != NULL) {
         if (!quiet)
@@ -1237,41 +3467,152 @@ static void align(
 
     if (links_filename != NULL) {
         if (!quiet)
-            fprintf(stderr, "Writing alignments to %s for %Zu sentencess\n",
-                    links_filename, ta->target->n_sentences);
+            fprintf(stderr, "Writing alignments to %s for %zu sentences\n",
+                    links_filename, seg->n_lines - seg->n_training);
         FILE *file = (!strcmp(links_filename, "-"))? stdout
-                     : fopen(links_filename, "w");
-        text_alignment_write_moses(ta, file, reverse);
+                     : fopen(links_filename, binary_links? "wb": "w");
+        struct links_writer out;
+        links_writer_init(&out, file, binary_links,
+                          seg->n_lines - seg->n_training);
+        text_alignment_write_moses(ta, seg, &out, reverse);
+        links_writer_finish(&out);
         if (file != stdout) fclose(file);
     }
 
     if (scores_filename != NULL) {
-        count *scores = malloc(sizeof(count)*ta->source->n_sentences);
-        for (size_t i=0; i<ta->source->n_sentences; i++)
-            scores[i] = (count)0.0;
+        count *segment_scores = malloc(sizeof(count)*ta->source->n_sentences);
+        count *scores = malloc(sizeof(count)*seg->n_sentences);
 
         FILE *file = (!strcmp(scores_filename, "-"))? stdout
                      : fopen(scores_filename, "w");
 
-        if (!quiet)
-            fprintf(stderr,
-                    "Computing scores using model %d for %Zu sentences\n",
-                    score_model, ta->source->n_sentences);
-
-        // Switch to whatever model is specified for scoring
-        ta->model = score_model;
-        text_alignment_sample(ta, &state, scores, NULL, 1);
+        const double t0 = seconds();
+        align_scores(ta, score_model, quiet, &state, segment_scores);
+        segmentation_merge_scores(seg, ta, segment_scores, scores);
+        telemetry_write(
+            "\"event\": \"scores\", \"direction\": \"%s\", "
+            "\"seconds\": %.6f",
+            reverse? "reverse": "forward", seconds() - t0);
 
-        for (size_t i=0; i<ta->source->n_sentences; i++)
-            fprintf(file, "%g\n", -scores[i]);
+        for (size_t i=seg->n_training; i<seg->n_lines; i++)
+            fprintf(file, "%g\n", scores[segmentation_sentence(seg, i)]);
 
         if (file != stdout) fclose(file);
+        free(segment_scores);
         free(scores);
     }
 
+    // if requested, keep ta so that the caller can write a snapshot or
+    // symmetrize the alignments
+    if (result_ta != NULL) *result_ta = ta;
+    else text_alignment_free(ta);
+}
+
+// Error codes of align_buffers()
+#define ALIGN_ERROR_MEMORY  (-1)
+#define ALIGN_ERROR_PRIORS  (-2)
+#define ALIGN_ERROR_TEXT    (-3)
+
+// Align source and target in both directions (in parallel) without any file
+// I/O, for use by the Python module. links_fwd contains one element per
+// target token and links_rev one per source token, in the format of
+// text_alignment_get_links(). If score_model is non-zero, scores_fwd and
+// scores_rev (one element per sentence) receive the sentence scores.
+//
+// The numbers of samplers and threads are reduced as needed to fit
+// max_memory and max_threads (see memory_plan_create()). Returns 0 on
+// success, or without aligning anything: ALIGN_ERROR_MEMORY if the budget
+// can not be met, ALIGN_ERROR_PRIORS if the priors can not be read (or do
+// not match the vocabularies), and ALIGN_ERROR_TEXT if the texts can not
+// be segmented (see segmentation_create()).
+int align_buffers(
+        const struct text *source,
+        const struct text *target,
+        int model,
+        int score_model,
+        double null_prior,
+        int n_samplers,
+        int n_threads,
+        int quiet,
+        const int *n_iters,
+        double tolerance,
+        int64_t seed,
+        const char *priors_filename,
+        size_t max_memory,
+        int max_threads,
+        position *links_fwd,
+        position *links_rev,
+        count *scores_fwd,
+        count *scores_rev)
+{
+    struct priors priors[2];
+    struct segmentation seg;
+    struct memory_plan plan;
+    struct stat priors_st;
+
+    if (memory_plan_create(
+                &plan, source, target, 3, 0,
+                (priors_filename != NULL && !stat(priors_filename, &priors_st))
+                    ? (size_t)priors_st.st_size : 0,
+                n_samplers, n_threads, max_memory, max_threads))
+        return ALIGN_ERROR_MEMORY;
+
+    if (priors_filename != NULL &&
+        priors_read(priors_filename, source->vocabulary_size,
+                    target->vocabulary_size, priors, priors+1))
+    {
+        priors_free(priors);
+        priors_free(priors+1);
+        return ALIGN_ERROR_PRIORS;
+    }
+
+    if (segmentation_create(&seg, source, target)) {
+        if (priors_filename != NULL) {
+            priors_free(priors);
+            priors_free(priors+1);
+        }
+        return ALIGN_ERROR_TEXT;
+    }
+
+    omp_set_nested(1);
+
+#pragma omp parallel for if(plan.parallel_directions)
+    for (int reverse=0; reverse<=1; reverse++) {
+        random_state state;
+        if (seed < 0) random_system_state(&state);
+        else random_seed_state(&state, (uint64_t)seed, reverse);
+        struct text_alignment *ta = align_sample(
+                reverse, seg.source, seg.target, model, null_prior,
+                plan.n_samplers, plan.n_threads, quiet, n_iters, tolerance,
+                (priors_filename == NULL)? NULL: priors + reverse, 0, NULL,
+                &state);
+        text_alignment_get_links(ta, &seg, reverse? links_rev: links_fwd);
+        if (score_model > 0) {
+            count *segment_scores =
+                malloc(sizeof(count)*ta->source->n_sentences);
+            if (segment_scores == NULL) {
+                perror("align_buffers(): failed to allocate scores");
+                exit(EXIT_FAILURE);
+            }
+            align_scores(ta, score_model, quiet, &state, segment_scores);
+            segmentation_merge_scores(&seg, ta, segment_scores,
+                                      reverse? scores_rev: scores_fwd);
+            free(segment_scores);
+        }
+        text_alignment_free(ta);
+    }
+
+    segmentation_free(&seg);
+
+    if (priors_filename != NULL) {
+        priors_free(priors);
+        priors_free(priors+1);
+    }
 
+    return 0;
 }
 
+#ifndef EFLOMAL_NO_MAIN
 static void help(const char *filename) {
     fprintf(stderr,
 "Usage: %s [-s source_input] [-t target_input] [-p priors_input] "
@@ -1279,7 +3620,34 @@ static void help(const char *filename) {
 "[-r reverse_links_output] [-S statistics_output] [-F forward_scores_output] "
 "[-R reverse_scores_output] "
 "[-1 n_IBM1_iters] [-2 n_HMM_iters] [-3 n_fertility_iters] "
-"[-n n_samplers] [-N null_prior] [-q] [-M score_model] -m model_type\n",
+"[-n n_samplers] [-N null_prior] [-q] [-M score_model] "
+"[-T n_threads | --threads n_threads] "
+"[-w snapshot_output | --save-snapshot snapshot_output] "
+"[-l snapshot_input | --load-snapshot snapshot_input] "
+"[-o symmetrized_links_output] [-y method | --symmetrize method] "
+"[-C tolerance | --tolerance tolerance] "
+"[-P telemetry_output | --telemetry telemetry_output] "
+"[-e seed | --seed seed] [-D decay | --decay decay] "
+"[-b max_memory_MiB | --max-memory max_memory_MiB] "
+"[-j max_threads | --max-threads max_threads] "
+"[-Q query_source_input | --query-source query_source_input] "
+"[-K query_target_input | --query-target query_target_input] "
+"[-B | --binary-links] [-U | --dedup] "
+"-m model_type\n"
+"\n"
+"With -Q and -K, the query sentences are appended to the input, which is "
+"then only used for training: only the links and scores of the query "
+"sentences are written\n"
+"\n"
+"With -B, the links (-f, -r and -o) are written in a binary format instead "
+"of text\n"
+"\n"
+"With -U, identical sentence pairs of the input are aligned once, with "
+"their statistics weighted by the number of copies, and the links of each "
+"copy are written as usual\n"
+"\n"
+"Symmetrization methods (for -o): intersect, union, grow-diag, "
+"grow-diag-final, grow-diag-final-and (default)\n",
         filename);
 }
 
@@ -1290,24 +3658,68 @@ int main(int argc, char *argv[]) {
          *priors_filename = NULL,
          *links_filename_fwd = NULL, *links_filename_rev = NULL,
          *stats_filename = NULL,
-         *scores_filename_fwd = NULL, *scores_filename_rev = NULL;
+         *scores_filename_fwd = NULL, *scores_filename_rev = NULL,
+         *save_snapshot_filename = NULL, *load_snapshot_filename = NULL,
+         *links_filename_sym = NULL, *telemetry_filename = NULL,
+         *query_source_filename = NULL, *query_target_filename = NULL;
+    struct text_alignment *result_tas[2] = {NULL, NULL};
     int n_iters[3];
-    int n_samplers = 1, quiet = 0, model = -1, score_model = -1;
-    double null_prior = 0.2;
+    int n_samplers = 1, n_threads = 1, quiet = 0, model = -1,
+        score_model = -1, symmetrization = SYM_GROW_DIAG_FINAL_AND,
+        binary_links = 0, dedup = 0;
+    double null_prior = 0.2, tolerance = 0.0;
+    // factor for the counts of a loaded snapshot carried over to a saved one
+    double decay = 0.0;
+    // negative: seed from the system's random source
+    int64_t seed = -1;
+    // budget for memory_plan_create(), zero means unlimited
+    size_t max_memory = 0;
+    int max_threads = 0;
 
     n_iters[0] = 1; n_iters[1] = 1; n_iters[2] = 1;
 
+    telemetry_t0 = seconds();
+
     omp_set_nested(1);
 
-    while ((opt = getopt(argc, argv, "s:t:p:f:r:S:F:R:1:2:3:n:qm:M:N:h"))
-            != -1)
+    static const struct option long_options[] = {
+        {"threads", required_argument, NULL, 'T'},
+        {"save-snapshot", required_argument, NULL, 'w'},
+        {"load-snapshot", required_argument, NULL, 'l'},
+        {"symmetrize", required_argument, NULL, 'y'},
+        {"tolerance", required_argument, NULL, 'C'},
+        {"telemetry", required_argument, NULL, 'P'},
+        {"seed", required_argument, NULL, 'e'},
+        {"decay", required_argument, NULL, 'D'},
+        {"max-memory", required_argument, NULL, 'b'},
+        {"max-threads", required_argument, NULL, 'j'},
+        {"query-source", required_argument, NULL, 'Q'},
+        {"query-target", required_argument, NULL, 'K'},
+        {"binary-links", no_argument, NULL, 'B'},
+        {"dedup", no_argument, NULL, 'U'},
+        {NULL, 0, NULL, 0}
+    };
+
+    while ((opt = getopt_long(argc, argv,
+                              "s:t:p:f:r:o:y:S:F:R:1:2:3:n:T:w:l:C:P:e:D:b:j:Q:K:BUqm:M:N:h",
+                              long_options, NULL)) != -1)
     {
         switch(opt) {
             case 's': source_filename = optarg; break;
             case 't': target_filename = optarg; break;
             case 'p': priors_filename = optarg; break;
+            case 'w': save_snapshot_filename = optarg; break;
+            case 'l': load_snapshot_filename = optarg; break;
             case 'f': links_filename_fwd = optarg; break;
             case 'r': links_filename_rev = optarg; break;
+            case 'o': links_filename_sym = optarg; break;
+            case 'y': symmetrization = symmetrization_from_name(optarg);
+                      if (symmetrization < 0) {
+                          fprintf(stderr, "Unknown symmetrization method "
+                                          "%s!\n", optarg);
+                          return 1;
+                      }
+                      break;
             case 'F': scores_filename_fwd = optarg; break;
             case 'R': scores_filename_rev = optarg; break;
             case 'S': stats_filename = optarg; break;
@@ -1315,7 +3727,16 @@ int main(int argc, char *argv[]) {
             case '2': n_iters[1] = atoi(optarg); break;
             case '3': n_iters[2] = atoi(optarg); break;
             case 'n': n_samplers = atoi(optarg); break;
+            case 'T': n_threads = atoi(optarg);
+                      if (n_threads < 1) {
+                          fprintf(stderr, "Number of threads must be "
+                                          "positive!\n");
+                          return 1;
+                      }
+                      break;
             case 'q': quiet = 1; break;
+            case 'B': binary_links = 1; break;
+            case 'U': dedup = 1; break;
             case 'm': model = atoi(optarg);
                       if (model < 1 || model > 3) {
                           fprintf(stderr, "Model must be 1, 2 or 3!\n");
@@ -1330,6 +3751,25 @@ int main(int argc, char *argv[]) {
                       }
                       break;
             case 'N': null_prior = atof(optarg); break;
+            case 'C': tolerance = atof(optarg); break;
+            case 'P': telemetry_filename = optarg; break;
+            case 'D': decay = atof(optarg);
+                      if (decay < 0.0 || decay > 1.0) {
+                          fprintf(stderr, "Decay must be between 0 and 1!\n");
+                          return 1;
+                      }
+                      break;
+            case 'e': seed = strtoll(optarg, NULL, 10);
+                      if (seed < 0) {
+                          fprintf(stderr, "Seed must be non-negative!\n");
+                          return 1;
+                      }
+                      break;
+            case 'b': max_memory = (size_t)strtoull(optarg, NULL, 10) << 20;
+                      break;
+            case 'j': max_threads = atoi(optarg); break;
+            case 'Q': query_source_filename = optarg; break;
+            case 'K': query_target_filename = optarg; break;
             case 'h':
             default:
                 help(argv[0]);
@@ -1344,14 +3784,55 @@ int main(int argc, char *argv[]) {
 
     if (score_model == -1) score_model = model;
 
+    if (priors_filename != NULL && load_snapshot_filename != NULL) {
+        fprintf(stderr, "Priors can not be used with a snapshot!\n");
+        return 1;
+    }
+
+    if ((query_source_filename == NULL) != (query_target_filename == NULL)) {
+        fprintf(stderr, "Both -Q and -K are needed for query sentences!\n");
+        return 1;
+    }
+    const int use_priors =
+        priors_filename != NULL || load_snapshot_filename != NULL;
+
+    if (telemetry_filename != NULL &&
+            (telemetry_file = fopen(telemetry_filename, "w")) == NULL) {
+        perror("Unable to open telemetry output");
+        return 1;
+    }
+
     t0 = seconds();
     struct text *source = text_read(source_filename);
     struct text *target = text_read(target_filename);
+    if (source == NULL || target == NULL) return 1;
     if (source->n_sentences != target->n_sentences) {
         fprintf(stderr, "Source text has %zd sentences but target has %zd\n",
                 source->n_sentences, target->n_sentences);
         return 1;
     }
+    // the input sentences are only used for training if there are queries
+    size_t n_training = 0;
+    if (query_source_filename != NULL) {
+        struct text *query_source = text_read(query_source_filename);
+        struct text *query_target = text_read(query_target_filename);
+        if (query_source == NULL || query_target == NULL) return 1;
+        if (query_source->n_sentences != query_target->n_sentences) {
+            fprintf(stderr, "Query source text has %zd sentences but target "
+                            "has %zd\n",
+                    query_source->n_sentences, query_target->n_sentences);
+            return 1;
+        }
+        n_training = source->n_sentences;
+        if (text_append(source, query_source) ||
+                text_append(target, query_target))
+            return 1;
+        text_free(query_source);
+        text_free(query_target);
+        if (!quiet)
+            fprintf(stderr, "Read %zd query sentences\n",
+                    source->n_sentences - n_training);
+    }
     if (!quiet) {
         fprintf(stderr, "Read texts (%zd sentences): %.3f s\n",
                 source->n_sentences, seconds() - t0);
@@ -1359,23 +3840,176 @@ int main(int argc, char *argv[]) {
                         " %"PRItoken" (target)\n",
                 source->vocabulary_size, target->vocabulary_size);
     }
+    telemetry_write(
+        "\"event\": \"read\", \"sentences\": %zu, "
+        "\"training_sentences\": %zu, "
+        "\"source_tokens\": %zu, \"target_tokens\": %zu, "
+        "\"source_vocabulary_size\": %"PRItoken", "
+        "\"target_vocabulary_size\": %"PRItoken", \"seconds\": %.6f",
+        source->n_sentences, n_training, source->n_tokens, target->n_tokens,
+        source->vocabulary_size, target->vocabulary_size, seconds() - t0);
+
+    // identical sentence pairs are merged before planning, since only the
+    // distinct ones take up memory (the query sentences are all aligned)
+    const size_t n_lines = source->n_sentences;
+    uint64_t *lines = NULL;
+    uint32_t *weights = NULL;
+    if (dedup) {
+        t0 = seconds();
+        if (text_deduplicate(source, target, n_training? n_training: n_lines,
+                             &lines, &weights))
+            return 1;
+        if (!quiet)
+            fprintf(stderr, "Merged identical sentence pairs (%zd distinct "
+                            "of %zd): %.3f s\n",
+                    source->n_sentences, n_lines, seconds() - t0);
+        telemetry_write(
+            "\"event\": \"dedup\", \"lines\": %zu, \"sentences\": %zu, "
+            "\"seconds\": %.6f",
+            n_lines, source->n_sentences, seconds() - t0);
+    }
 
-#pragma omp parallel for
+    // the forward direction is also aligned if there is no output at all
+    int directions = 0;
+    for (int reverse=0; reverse<=1; reverse++) {
+        if ((reverse? links_filename_rev: links_filename_fwd) != NULL ||
+                (reverse? scores_filename_rev: scores_filename_fwd) != NULL ||
+                save_snapshot_filename != NULL ||
+                links_filename_sym != NULL ||
+                (!reverse && links_filename_fwd == NULL &&
+                 links_filename_rev == NULL))
+            directions |= 1 << reverse;
+    }
+
+    // plan the resources before allocating anything large, counting the
+    // priors by the size of their file
+    struct memory_plan plan;
+    struct stat priors_st;
+    const char *priors_input = (priors_filename != NULL)? priors_filename
+                                                        : load_snapshot_filename;
+    const size_t priors_memory = (priors_input != NULL &&
+                                  !stat(priors_input, &priors_st))
+                                 ? (size_t)priors_st.st_size : 0;
+    if (memory_plan_create(&plan, source, target, directions,
+                           save_snapshot_filename != NULL ||
+                               links_filename_sym != NULL,
+                           priors_memory, n_samplers, n_threads,
+                           max_memory, max_threads))
+    {
+        fprintf(stderr, "Estimated memory use of %zu MiB exceeds the limit "
+                        "of %zu MiB, even with a single sampler!\n",
+                plan.peak_memory >> 20, max_memory >> 20);
+        return 1;
+    }
+    if (!quiet) {
+        if (plan.n_samplers != n_samplers || plan.n_threads != n_threads ||
+                (!plan.parallel_directions && directions == 3))
+            fprintf(stderr, "Using %d samplers with %d threads each%s, to "
+                            "fit the budget\n",
+                    plan.n_samplers, plan.n_threads,
+                    (!plan.parallel_directions && directions == 3)
+                    ? " and aligning the directions one after the other"
+                    : "");
+        fprintf(stderr, "Estimated memory use: %zu MiB\n",
+                plan.peak_memory >> 20);
+    }
+    telemetry_write(
+        "\"event\": \"plan\", \"samplers\": %d, \"threads\": %d, "
+        "\"parallel_directions\": %s, \"memory_estimate_kb\": %zu",
+        plan.n_samplers, plan.n_threads,
+        plan.parallel_directions? "true": "false", plan.peak_memory >> 10);
+
+    struct segmentation seg;
+    if (segmentation_create(&seg, source, target)) exit(EXIT_FAILURE);
+    if (lines != NULL) segmentation_set_lines(&seg, n_lines, lines, weights);
+    seg.n_training = n_training;
+    if (!quiet && seg.first != NULL)
+        fprintf(stderr, "Split long sentences into segments (%zd in "
+                        "total)\n", seg.source->n_sentences);
+
+    // the priors are read once, and shared by all samplers
+    struct priors priors[2];
+    if (use_priors) {
+        t0 = seconds();
+        int r = (priors_filename != NULL)
+            ? priors_read(priors_filename, source->vocabulary_size,
+                          target->vocabulary_size, priors, priors+1)
+            : priors_read_snapshot(load_snapshot_filename, model,
+                                   source->vocabulary_size,
+                                   target->vocabulary_size, priors, priors+1);
+        if (r) {
+            fprintf(stderr, "Unable to load %s, exiting\n",
+                    (priors_filename != NULL)? priors_filename
+                                             : load_snapshot_filename);
+            return 1;
+        }
+        if (!quiet)
+            fprintf(stderr, "Read priors: %.3f s\n", seconds() - t0);
+        telemetry_write("\"event\": \"priors\", \"seconds\": %.6f",
+                        seconds() - t0);
+    }
+
+#pragma omp parallel for if(plan.parallel_directions)
     for (int reverse=0; reverse<=1; reverse++) {
         char *links_filename =
             (reverse? links_filename_rev: links_filename_fwd);
         char *scores_filename =
             (reverse? scores_filename_rev: scores_filename_fwd);
-        if (links_filename != NULL ||
-                scores_filename != NULL ||
-                (!reverse && links_filename_fwd == NULL &&
-                 links_filename_rev == NULL))
-            align(reverse, source, target, model, score_model, null_prior,
-                  n_samplers,
-                  quiet, n_iters, links_filename, stats_filename,
-                  scores_filename, priors_filename);
+        if (directions & (1 << reverse))
+            align(reverse, &seg, model, score_model, null_prior,
+                  plan.n_samplers, plan.n_threads,
+                  quiet, n_iters, tolerance, seed,
+                  links_filename, binary_links, stats_filename,
+                  scores_filename, use_priors? priors + reverse: NULL,
+                  (save_snapshot_filename == NULL &&
+                   links_filename_sym == NULL)? NULL: result_tas + reverse);
+    }
+
+    if (links_filename_sym != NULL) {
+        if (!quiet)
+            fprintf(stderr, "Writing %s symmetrized alignments to %s\n",
+                    symmetrization_names[symmetrization], links_filename_sym);
+        FILE *file = (!strcmp(links_filename_sym, "-"))? stdout
+                     : fopen(links_filename_sym, binary_links? "wb": "w");
+        if (file == NULL) {
+            perror("Unable to open symmetrized links output");
+            return 1;
+        }
+        struct links_writer out;
+        links_writer_init(&out, file, binary_links,
+                          seg.n_lines - seg.n_training);
+        text_alignment_write_symmetrized(result_tas[0], result_tas[1], &seg,
+                                         symmetrization, &out);
+        links_writer_finish(&out);
+        if (file != stdout) fclose(file);
+    }
+
+    if (save_snapshot_filename != NULL) {
+        if (!quiet)
+            fprintf(stderr, "Writing model snapshot to %s\n",
+                    save_snapshot_filename);
+        if (snapshot_write(result_tas, model,
+                           (load_snapshot_filename == NULL)? 0.0: decay,
+                           save_snapshot_filename))
+            return 1;
+    }
+
+    if (result_tas[0] != NULL) {
+        text_alignment_free(result_tas[0]);
+        text_alignment_free(result_tas[1]);
+    }
+
+    if (use_priors) {
+        priors_free(priors);
+        priors_free(priors+1);
     }
 
+    segmentation_free(&seg);
+
+    telemetry_write("\"event\": \"done\"");
+    if (telemetry_file != NULL) fclose(telemetry_file);
+
     return 0;
 }
 
+#endif
@@ -16,6 +16,9 @@
  * VALUE_TYPE                       type of values
  * EMPTY_KEY                        value of key for empty slots
  * INDEX_TYPE HASH_KEY(KEY_TYPE)    function to hash KEY_TYPE into INDEX_TYPE
+ *
+ * MAKE_NAME(_n_resizes) counts the hash table resizes done by the current
+ * thread, for profiling.
  */
 
 #include <stdlib.h>
@@ -45,6 +48,7 @@
 #define FUN_RESIZE_DYNAMIC  MAKE_NAME(_resize_dynamic)
 #define FUN_MAKE_DYNAMIC    MAKE_NAME(_make_dynamic)
 #define FUN_IS_DYNAMIC      MAKE_NAME(_is_dynamic)
+#define VAR_N_RESIZES       MAKE_NAME(_n_resizes)
 
 // Minimun size of hash table if MAX_FIXED is 0
 //
@@ -77,6 +81,8 @@ struct STRUCT_NAME {
 
 static int FUN_RESIZE_DYNAMIC(struct STRUCT_NAME *m, INDEX_TYPE new_size);
 
+static __thread size_t VAR_N_RESIZES = 0;
+
 // TODO: use one malloc() call instead of two when allocating dynamic
 // keys/values arrays.
 // TODO: add FUN_GET_HASH() which also takes a precomputed key hash
@@ -145,7 +151,7 @@ static void FUN_INSERT_FIXED(
         KEY_TYPE key, VALUE_TYPE value)
 {
     KEY_TYPE *keys = m->structure.fixed.keys;
-    KEY_TYPE *values = m->structure.fixed.values;
+    VALUE_TYPE *values = m->structure.fixed.values;
     if (index < m->n_items && keys[index] == key) {
         values[index] = value;
         return;
@@ -165,7 +171,7 @@ static void FUN_INSERT_FIXED(
 
 static void FUN_DELETE_FIXED(struct STRUCT_NAME *m, INDEX_TYPE index) {
     KEY_TYPE *keys = m->structure.fixed.keys;
-    KEY_TYPE *values = m->structure.fixed.values;
+    VALUE_TYPE *values = m->structure.fixed.values;
     for (INDEX_TYPE i=index; i<m->n_items-1; i++) {
         keys[i] = keys[i+1];
         values[i] = values[i+1];
@@ -201,7 +207,7 @@ static int FUN_INSERT_DYNAMIC(
 
     INDEX_TYPE index;
     KEY_TYPE *keys = m->structure.dynamic.keys;
-    KEY_TYPE *values = m->structure.dynamic.values;
+    VALUE_TYPE *values = m->structure.dynamic.values;
     if (FUN_LOOKUP_DYNAMIC(m, key, &index, key_hash)) {
         values[index] = value;
         return 1;
@@ -217,7 +223,7 @@ static void FUN_DELETE_DYNAMIC(struct STRUCT_NAME *m, INDEX_TYPE index) {
     INDEX_TYPE i,j,k;
     const INDEX_TYPE mask = m->structure.dynamic.size - 1;
     KEY_TYPE *keys = m->structure.dynamic.keys;
-    KEY_TYPE *values = m->structure.dynamic.values;
+    VALUE_TYPE *values = m->structure.dynamic.values;
     i = j = index;
     while(1) {
         keys[i] = EMPTY_KEY;
@@ -237,6 +243,7 @@ static int FUN_RESIZE_DYNAMIC(struct STRUCT_NAME *m, INDEX_TYPE new_size) {
     KEY_TYPE *old_keys = m->structure.dynamic.keys;
     VALUE_TYPE *old_values = m->structure.dynamic.values;
     const INDEX_TYPE old_size = m->structure.dynamic.size;
+    VAR_N_RESIZES++;
 #ifdef MERGE_MALLOC
     if ((m->structure.dynamic.keys =
                 malloc(new_size*(sizeof(KEY_TYPE) + sizeof(VALUE_TYPE))))
@@ -75,6 +75,16 @@ static int random_system_state(random_state *state) {
     return 0;
 }
 
+// Deterministic state for a given seed, with separate streams (e.g. one per
+// alignment direction) that do not overlap in practice.
+static void random_seed_state(
+        random_state *state, uint64_t seed, uint64_t stream)
+{
+    *state = hash_u64_u64(hash_u64_u64(seed) ^ stream);
+    // the xorshift state must be non-zero
+    if (*state == 0) *state = 1;
+}
+
 /* Sample from an unnormalized cumulative categorical distribution.
  * Since it is cumulative, the last element of p contains the normalization
  * factor. By subtracting each p[i] from p[i+1] and dividing by the original
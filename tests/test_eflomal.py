@@ -1,10 +1,14 @@
 """Unit tests for eflomal"""
 
+import gzip
 import io
+import lzma
 import os
 import tempfile
 import unittest
 
+import numpy as np
+
 import eflomal
 
 
@@ -34,6 +38,32 @@ class TestAlign(unittest.TestCase):
             rev_links.seek(0)
             self.assertEqual(len(rev_links.readlines()), 3)
 
+    def test_symmetrize(self):
+        """Test symmetrization by the eflomal binary"""
+        def read_links(fobj):
+            fobj.seek(0)
+            return [{tuple(map(int, link.split('-'))) for link in line.split()}
+                    for line in fobj]
+        aligner = eflomal.Aligner()
+        with tempfile.NamedTemporaryFile('w+') as fwd_links, \
+             tempfile.NamedTemporaryFile('w+') as rev_links, \
+             tempfile.NamedTemporaryFile('w+') as sym_links:
+            for method in eflomal.SYMMETRIZATION_METHODS:
+                aligner.align(self.src_data, self.trg_data,
+                              links_filename_fwd=fwd_links.name,
+                              links_filename_rev=rev_links.name,
+                              links_filename_sym=sym_links.name,
+                              symmetrization=method)
+                fwd, rev, sym = map(read_links, (fwd_links, rev_links, sym_links))
+                self.assertEqual(len(sym), 3)
+                for f, r, s in zip(fwd, rev, sym):
+                    self.assertLessEqual(f & r, s)
+                    self.assertLessEqual(s, f | r)
+                    if method == 'intersect':
+                        self.assertEqual(s, f & r)
+                    elif method == 'union':
+                        self.assertEqual(s, f | r)
+
     def test_aligner_with_priors(self):
         """Test aligner with priors"""
         aligner = eflomal.Aligner()
@@ -47,6 +77,419 @@ class TestAlign(unittest.TestCase):
             rev_links.seek(0)
             self.assertEqual(len(rev_links.readlines()), 3)
 
+    def test_read_text(self):
+        """Test reading sentences into a flat buffer"""
+        sents, index = eflomal.read_text(self.src_data, True, 0, 0)
+        self.assertEqual(len(sents), 3)
+        self.assertEqual(len(sents.offsets), 4)
+        self.assertEqual(len(sents.tokens), sum(len(line.split()) for line in self.src_data))
+        for sent, line in zip(sents, self.src_data):
+            words = line.lower().split()
+            self.assertEqual([index[word] for word in words], list(sent))
+        self.assertEqual(list(sents[1]), list(sents.tokens[sents.offsets[1]:sents.offsets[2]]))
+
+    def test_sort_vocabulary(self):
+        """Test numbering the vocabulary by frequency"""
+        sents, index = eflomal.read_text(self.src_data, True, 0, 0)
+        sorted_sents, sorted_index = eflomal.sort_vocabulary(sents, index)
+        self.assertEqual(set(sorted_index), set(index))
+        self.assertEqual(sorted(sorted_index.values()), list(range(len(index))))
+        n_words = np.bincount(sorted_sents.tokens, minlength=len(index))
+        self.assertTrue((np.diff(n_words) <= 0).all())
+        words = {i: word for word, i in index.items()}
+        sorted_words = {i: word for word, i in sorted_index.items()}
+        for sent, sorted_sent in zip(sents, sorted_sents):
+            self.assertEqual([words[i] for i in sent],
+                             [sorted_words[i] for i in sorted_sent])
+
+    def test_read_texts_parallel(self):
+        """Test that sharded reading gives the same result as read_text"""
+        src_data = self.src_data * 7
+        trg_data = self.trg_data * 7
+        (src_sents, src_index), (trg_sents, trg_index) = eflomal.read_texts_parallel(
+            [(src_data, 0, 0), (trg_data, 0, 3)], 2, shard_size=2)
+        for data, suffix_len, sents, index in (
+                (src_data, 0, src_sents, src_index), (trg_data, 3, trg_sents, trg_index)):
+            ref_sents, ref_index = eflomal.read_text(data, True, 0, suffix_len)
+            self.assertEqual(list(index.items()), list(ref_index.items()))
+            self.assertEqual(list(sents.tokens), list(ref_sents.tokens))
+            self.assertEqual(list(sents.offsets), list(ref_sents.offsets))
+
+    def test_align_arrays(self):
+        """Test in-process alignment"""
+        aligner = eflomal.Aligner()
+        src_sents, _ = eflomal.read_text(self.src_data, True, 0, 0)
+        trg_sents, _ = eflomal.read_text(self.trg_data, True, 0, 0)
+        links_fwd, links_rev, scores_fwd, scores_rev = aligner.align_arrays(
+            src_sents, trg_sents, scores=True)
+        self.assertEqual(len(links_fwd), sum(len(sent) for sent in trg_sents))
+        self.assertEqual(len(links_rev), sum(len(sent) for sent in src_sents))
+        for links, sents in ((links_fwd, src_sents), (links_rev, trg_sents)):
+            linked = links[links != eflomal.NULL_LINK]
+            self.assertTrue((linked < max(len(sent) for sent in sents)).all())
+        self.assertEqual(len(scores_fwd), 3)
+        self.assertEqual(len(scores_rev), 3)
+
+    def test_align_threads(self):
+        """Test alignment with parallel sampling within each sampler"""
+        # enough sentences for each thread to get its own shard
+        aligner = eflomal.Aligner(n_threads=2, n_samplers=1)
+        src_sents, _ = eflomal.read_text(self.src_data * 0x400, True, 0, 0)
+        trg_sents, _ = eflomal.read_text(self.trg_data * 0x400, True, 0, 0)
+        links_fwd, links_rev, _, _ = aligner.align_arrays(src_sents, trg_sents)
+        self.assertEqual(len(links_fwd), sum(len(sent) for sent in trg_sents))
+        self.assertEqual(len(links_rev), sum(len(sent) for sent in src_sents))
+
+    def test_tolerance(self):
+        """Test alignment with convergence-based early stopping"""
+        aligner = eflomal.Aligner(n_iterations=(100, 100, 100), tolerance=0.5)
+        src_sents, _ = eflomal.read_text(self.src_data, True, 0, 0)
+        trg_sents, _ = eflomal.read_text(self.trg_data, True, 0, 0)
+        links_fwd, links_rev, _, _ = aligner.align_arrays(src_sents, trg_sents)
+        self.assertEqual(len(links_fwd), sum(len(sent) for sent in trg_sents))
+        with tempfile.NamedTemporaryFile('w+') as fwd_links:
+            aligner.align(self.src_data, self.trg_data,
+                          links_filename_fwd=fwd_links.name)
+            fwd_links.seek(0)
+            self.assertEqual(len(fwd_links.readlines()), 3)
+
+    def test_seed(self):
+        """Test that seeded alignments are reproducible"""
+        src_sents, _ = eflomal.read_text(self.src_data, True, 0, 0)
+        trg_sents, _ = eflomal.read_text(self.trg_data, True, 0, 0)
+        aligner = eflomal.Aligner(seed=1)
+        links1 = aligner.align_arrays(src_sents, trg_sents, scores=True)
+        links2 = aligner.align_arrays(src_sents, trg_sents, scores=True)
+        for x1, x2 in zip(links1, links2):
+            self.assertEqual(x1.tolist(), x2.tolist())
+        with tempfile.NamedTemporaryFile('w+') as fwd1, \
+             tempfile.NamedTemporaryFile('w+') as fwd2:
+            aligner.align(self.src_data, self.trg_data,
+                          links_filename_fwd=fwd1.name)
+            aligner.align(self.src_data, self.trg_data,
+                          links_filename_fwd=fwd2.name)
+            self.assertEqual(fwd1.read(), fwd2.read())
+
+    def test_known_alignment(self):
+        """Test that sentences with repeated tokens get the known links"""
+        # source word i translates to target word i, in varying order
+        src_sents = [[0, 0, 1], [1, 2], [2, 0, 2], [3, 1], [0, 3, 3]] * 20
+        trg_sents = [[1, 0, 0], [2, 1], [2, 2, 0], [1, 3], [3, 3, 0]] * 20
+        src_sents = [np.array(sent, dtype=np.uint32) for sent in src_sents]
+        trg_sents = [np.array(sent, dtype=np.uint32) for sent in trg_sents]
+        aligner = eflomal.Aligner(model=1, n_samplers=2, seed=1)
+        links_fwd, links_rev, _, _ = aligner.align_arrays(src_sents,
+                                                          trg_sents)
+        # each token is linked to a copy of its translation (any one of
+        # them, if it is repeated)
+        for links, sents, linked_sents in ((links_fwd, trg_sents, src_sents),
+                                           (links_rev, src_sents, trg_sents)):
+            offset = 0
+            for sent, linked_sent in zip(sents, linked_sents):
+                sent_links = links[offset:offset+len(sent)]
+                self.assertTrue((sent_links != eflomal.NULL_LINK).all())
+                self.assertEqual(linked_sent[sent_links].tolist(),
+                                 sent.tolist())
+                offset += len(sent)
+
+    def test_progress(self):
+        """Test progress callbacks with telemetry records"""
+        aligner = eflomal.Aligner(n_iterations=(2, 2, 2), n_samplers=2)
+        records = []
+        with tempfile.NamedTemporaryFile('w+') as fwd_links:
+            aligner.align(self.src_data, self.trg_data,
+                          links_filename_fwd=fwd_links.name,
+                          progress=records.append)
+        events = [record['event'] for record in records]
+        self.assertEqual(events[-1], 'done')
+        iterations = [record for record in records
+                      if record['event'] == 'iteration']
+        self.assertEqual(len(iterations), 2 * 3 * 2)
+        for record in iterations:
+            self.assertIn('tokens_per_second', record)
+            self.assertIn('max_rss_kb', record)
+
+    def test_long_sentences(self):
+        """Test that sentences longer than the sampler's limit are aligned"""
+        aligner = eflomal.Aligner(model=1, n_iterations=(1, 0, 0), n_samplers=1)
+        src_data = self.src_data + [' '.join(self.src_data).replace('\n', ' ') * 0x2000]
+        trg_data = self.trg_data + [' '.join(self.trg_data).replace('\n', ' ') * 0x2000]
+        src_sents, _ = eflomal.read_text(src_data, True, 0, 0)
+        trg_sents, _ = eflomal.read_text(trg_data, True, 0, 0)
+        # positions in the sentence do not fit in 16 bits
+        self.assertGreater(len(src_sents[3]), 0x10000)
+        links_fwd, links_rev, _, _ = aligner.align_arrays(src_sents, trg_sents)
+        linked = links_fwd[trg_sents.offsets[3]:]
+        linked = linked[linked != eflomal.NULL_LINK]
+        self.assertGreater(linked.max(initial=0), 0xffff)
+        self.assertTrue((linked < len(src_sents[3])).all())
+        with tempfile.NamedTemporaryFile('w+') as fwd_links:
+            aligner.align(src_data, trg_data, links_filename_fwd=fwd_links.name)
+            fwd_links.seek(0)
+            lines = fwd_links.readlines()
+            self.assertEqual(len(lines), 4)
+            self.assertGreater(max(int(link.split('-')[0]) for link in lines[3].split()),
+                               0xffff)
+            with tempfile.NamedTemporaryFile('wb') as fwd_binary:
+                aligner.align(src_data, trg_data,
+                              links_filename_fwd=fwd_binary.name,
+                              binary_links=True)
+                binary_lines = eflomal.read_binary_links(
+                    fwd_binary.name).to_lines()
+                self.assertEqual(len(binary_lines), 4)
+                self.assertGreater(
+                    max(int(link.split('-')[0])
+                        for link in binary_lines[3].split()),
+                    0xffff)
+
+    def test_snapshot(self):
+        """Test aligning new data with a model snapshot"""
+        aligner = eflomal.Aligner()
+        with tempfile.NamedTemporaryFile('w+') as fwd_links, \
+             tempfile.NamedTemporaryFile('w+') as rev_links, \
+             tempfile.NamedTemporaryFile('wb') as snapshot:
+            aligner.align(self.src_data, self.trg_data,
+                          snapshot_filename=snapshot.name)
+            src_index, trg_index = eflomal.read_snapshot_vocabulary(snapshot.name)
+            self.assertEqual(src_index['Katt'], 1 + src_index.index['katt'])
+            aligner.infer(snapshot.name, self.src_data[:2] + ['helt nya ord'],
+                          self.trg_data[:2] + ['completely new words'],
+                          links_filename_fwd=fwd_links.name,
+                          links_filename_rev=rev_links.name)
+            fwd_links.seek(0)
+            self.assertEqual(len(fwd_links.readlines()), 3)
+            rev_links.seek(0)
+            self.assertEqual(len(rev_links.readlines()), 3)
+
+    def test_align_stream(self):
+        """Test aligning the input in chunks"""
+        aligner = eflomal.Aligner()
+        with tempfile.NamedTemporaryFile('w+') as fwd_links, \
+             tempfile.NamedTemporaryFile('w+') as sym_links, \
+             tempfile.NamedTemporaryFile('w+') as scores, \
+             tempfile.NamedTemporaryFile('wb') as snapshot:
+            aligner.align_stream(self.src_data * 3, self.trg_data * 3, 2,
+                                 links_filename_fwd=fwd_links.name,
+                                 links_filename_sym=sym_links.name,
+                                 scores_filename_fwd=scores.name,
+                                 snapshot_filename=snapshot.name)
+            self.assertEqual(len(fwd_links.readlines()), 9)
+            self.assertEqual(len(sym_links.readlines()), 9)
+            self.assertEqual(len(scores.readlines()), 9)
+            src_index, _ = eflomal.read_snapshot_vocabulary(snapshot.name)
+            self.assertIn('katt', src_index.index)
+            aligner.infer(snapshot.name, self.src_data, self.trg_data,
+                          links_filename_fwd=fwd_links.name)
+            fwd_links.seek(0)
+            self.assertEqual(len(fwd_links.readlines()), 3)
+
+    def test_joint_input(self):
+        """Test reading joint and compressed input"""
+        joint_data = ['%s ||| %s\n' % (src.strip(), trg.strip())
+                      for src, trg in zip(self.src_data, self.trg_data)]
+        (src_sents, src_index), (trg_sents, trg_index) = \
+            eflomal.read_joint_text(joint_data, True, 0, 0, 0, 0)
+        self.assertEqual(src_index,
+                         eflomal.read_text(self.src_data, True, 0, 0)[1])
+        self.assertEqual(trg_sents.tokens.tolist(),
+                         eflomal.read_text(self.trg_data, True, 0, 0)[0]
+                         .tokens.tolist())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for suffix, open_compressed in (('.gz', gzip.open),
+                                            ('.xz', lzma.open)):
+                filename = os.path.join(tmpdir, 'joint' + suffix)
+                with open_compressed(filename, 'wt', encoding='utf-8') as f:
+                    f.writelines(joint_data)
+                with eflomal.open_input(filename) as f:
+                    self.assertEqual(f.readlines(), joint_data)
+                links_filename = os.path.join(tmpdir, 'fwd')
+                with eflomal.open_input(filename) as f:
+                    eflomal.Aligner().align(
+                        f, None, links_filename_fwd=links_filename)
+                with open(links_filename, 'r', encoding='utf-8') as f:
+                    self.assertEqual(len(f.readlines()), 3)
+
+    def test_corpus_cache(self):
+        """Test caching of prepared texts between runs"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_dir = os.path.join(tmpdir, 'cache')
+            links = []
+            for i in range(3):
+                links_filename = os.path.join(tmpdir, 'fwd%d' % i)
+                eflomal.Aligner(seed=1, cache_dir=cache_dir).align(
+                    self.src_data, self.trg_data,
+                    links_filename_fwd=links_filename,
+                    priors_input=self.priors_data if i == 2 else None)
+                with open(links_filename, 'r', encoding='utf-8') as f:
+                    links.append(f.read())
+            self.assertEqual(links[0], links[1])
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            # other stemming settings give another entry
+            cache = eflomal.CorpusCache(cache_dir)
+            src1, _, (src_index1, _) = cache.prepare(
+                eflomal.Aligner(), self.src_data, self.trg_data)
+            src2, _, (src_index2, _) = cache.prepare(
+                eflomal.Aligner(source_prefix_len=3), self.src_data,
+                self.trg_data)
+            self.assertNotEqual(src1, src2)
+            self.assertEqual(src_index1.index, eflomal.sort_vocabulary(
+                *eflomal.read_text(self.src_data, True, 0, 0))[1])
+            self.assertEqual(src_index2.prefix_len, 3)
+            # the least recently used entry is evicted
+            os.utime(os.path.dirname(src1), (0, 0))
+            entry2 = os.path.dirname(src2)
+            cache.max_size = sum(os.path.getsize(os.path.join(entry2, name))
+                                 for name in os.listdir(entry2))
+            cache.evict()
+            self.assertEqual(os.listdir(cache_dir),
+                             [os.path.basename(entry2)])
+
+    def test_query(self):
+        """Test aligning query sentences using a training corpus"""
+        aligner = eflomal.Aligner(n_iterations=(2, 2, 2), seed=1)
+        query_src = self.src_data[1:] + ['ett helt nytt ord\n']
+        query_trg = self.trg_data[1:] + ['a completely new word\n']
+        records = []
+        with tempfile.NamedTemporaryFile('w+') as fwd_links, \
+             tempfile.NamedTemporaryFile('w+') as sym_links, \
+             tempfile.NamedTemporaryFile('w+') as fwd_scores:
+            aligner.align(self.src_data * 10, self.trg_data * 10,
+                          links_filename_fwd=fwd_links.name,
+                          links_filename_sym=sym_links.name,
+                          scores_filename_fwd=fwd_scores.name,
+                          query_src_input=query_src,
+                          query_trg_input=query_trg,
+                          progress=records.append)
+            fwd = fwd_links.readlines()
+            self.assertEqual(len(fwd), len(query_src))
+            self.assertEqual(len(sym_links.readlines()), len(query_src))
+            self.assertEqual(len(fwd_scores.readlines()), len(query_src))
+            for line, src, trg in zip(fwd, query_src, query_trg):
+                for link in line.split():
+                    i, j = map(int, link.split('-'))
+                    self.assertLess(i, len(src.split()))
+                    self.assertLess(j, len(trg.split()))
+        read = [r for r in records if r['event'] == 'read'][0]
+        self.assertEqual(read['sentences'], 30 + len(query_src))
+        self.assertEqual(read['training_sentences'], 30)
+
+    def test_query_priors(self):
+        """Test aligning query sentences with new words using priors"""
+        aligner = eflomal.Aligner(n_iterations=(2, 2, 2), seed=1)
+        query_src = ['ett helt nytt ord\n']
+        query_trg = ['a completely new word\n']
+        with tempfile.NamedTemporaryFile('w+') as fwd_links:
+            aligner.align(self.src_data * 10, self.trg_data * 10,
+                          links_filename_fwd=fwd_links.name,
+                          priors_input=self.priors_data,
+                          query_src_input=query_src,
+                          query_trg_input=query_trg)
+            self.assertEqual(len(fwd_links.readlines()), len(query_src))
+
+    def test_memory_plan(self):
+        """Test planning the resources within a budget"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src_filename = os.path.join(tmpdir, 'src.eflt')
+            trg_filename = os.path.join(tmpdir, 'trg.eflt')
+            with open(src_filename, 'wb') as srcf, \
+                 open(trg_filename, 'wb') as trgf:
+                eflomal.Aligner().prepare_files(
+                    self.src_data, srcf, self.trg_data, trgf, None, None,
+                    binary=True)
+            plan = eflomal.plan_resources(src_filename, trg_filename, 3, 2)
+            self.assertEqual((plan['n_samplers'], plan['n_threads']), (3, 2))
+            self.assertTrue(plan['parallel_directions'])
+            plan1 = eflomal.plan_resources(
+                src_filename, trg_filename, 3, 2, max_threads=6)
+            self.assertEqual((plan1['n_samplers'], plan1['n_threads']),
+                             (3, 1))
+            self.assertTrue(plan1['parallel_directions'])
+            plan2 = eflomal.plan_resources(
+                src_filename, trg_filename, 3, 1,
+                max_memory=plan1['peak_memory']-1)
+            self.assertFalse(plan2['parallel_directions'])
+            self.assertLess(plan2['peak_memory'], plan1['peak_memory'])
+            self.assertRaises(
+                MemoryError, eflomal.plan_resources, src_filename,
+                trg_filename, 3, 1, max_memory=1)
+        aligner = eflomal.Aligner(max_memory=1)
+        # the budget of the binary is rounded up to whole MiB, so the input
+        # must be large enough not to fit in that
+        with tempfile.NamedTemporaryFile('w+') as fwd_links:
+            self.assertRaises(
+                MemoryError, aligner.align, self.src_data * 0x1000,
+                self.trg_data * 0x1000, links_filename_fwd=fwd_links.name)
+        src_sents, _ = eflomal.read_text(self.src_data, True, 0, 0)
+        trg_sents, _ = eflomal.read_text(self.trg_data, True, 0, 0)
+        self.assertRaises(MemoryError, aligner.align_arrays,
+                          src_sents, trg_sents)
+        links_fwd, _, _, _ = eflomal.Aligner(
+            max_memory=1 << 30, max_threads=1).align_arrays(
+                src_sents, trg_sents)
+        self.assertEqual(len(links_fwd), len(trg_sents.tokens))
+
+    def test_binary_text(self):
+        """Test writing texts in the binary format"""
+        aligner = eflomal.Aligner()
+        with tempfile.NamedTemporaryFile('wb') as src_text, \
+             tempfile.NamedTemporaryFile('wb') as trg_text:
+            aligner.prepare_files(self.src_data, src_text, self.trg_data, trg_text,
+                                  None, None, binary=True)
+            self.assertEqual(eflomal.cython.read_n_sentences(src_text.name), 3)
+            with open(src_text.name, 'rb') as fobj:
+                data = fobj.read()
+            n_tokens = sum(len(line.split()) for line in self.src_data)
+            self.assertTrue(data.startswith(b'EFLT'))
+            self.assertEqual(len(data), 32 + 4*8 + 4*n_tokens)
+
+    def test_binary_priors(self):
+        """Test writing priors in the binary format"""
+        aligner = eflomal.Aligner()
+        with tempfile.NamedTemporaryFile('wb') as src_text, \
+             tempfile.NamedTemporaryFile('wb') as trg_text, \
+             tempfile.NamedTemporaryFile('wb') as priors:
+            src_index, trg_index = aligner.prepare_files(
+                self.src_data, src_text, self.trg_data, trg_text,
+                self.priors_data, priors, binary=True)
+            with open(priors.name, 'rb') as fobj:
+                header = eflomal.PRIORS_HEADER.unpack(
+                    fobj.read(eflomal.PRIORS_HEADER.size))
+            self.assertEqual(header[:4], (eflomal.PRIORS_MAGIC,
+                                          eflomal.PRIORS_VERSION,
+                                          len(src_index)+1, len(trg_index)+1))
+            self.assertGreater(header[4], 0)
+            src_sents, _ = eflomal.read_text(self.src_data, True, 0, 0)
+            trg_sents, _ = eflomal.read_text(self.trg_data, True, 0, 0)
+            links_fwd, _, _, _ = eflomal.align_arrays(
+                src_sents, trg_sents, priors_filename=priors.name)
+            self.assertEqual(len(links_fwd), sum(len(sent) for sent in trg_sents))
+
+    def test_align_arrays_priors_errors(self):
+        """Test in-process alignment with invalid or partly used priors"""
+        aligner = eflomal.Aligner()
+        src_sents, _ = eflomal.read_text(self.src_data, True, 0, 0)
+        trg_sents, _ = eflomal.read_text(self.trg_data, True, 0, 0)
+        self.assertRaises(OSError, eflomal.align_arrays, src_sents, trg_sents,
+                          priors_filename='/nonexistent/priors')
+        with tempfile.NamedTemporaryFile('wb') as src_text, \
+             tempfile.NamedTemporaryFile('wb') as trg_text, \
+             tempfile.NamedTemporaryFile('wb') as priors:
+            src_index, trg_index = aligner.prepare_files(
+                self.src_data, src_text, self.trg_data, trg_text,
+                self.priors_data, priors, binary=True)
+            # the first sentence pair does not contain every word
+            src_subset, trg_subset = [src_sents[0]], [trg_sents[0]]
+            self.assertRaises(OSError, eflomal.align_arrays, src_subset,
+                              trg_subset, priors_filename=priors.name)
+            links_fwd, _, _, _ = eflomal.align_arrays(
+                src_subset, trg_subset, priors_filename=priors.name,
+                source_vocabulary_size=len(src_index),
+                target_vocabulary_size=len(trg_index))
+            self.assertEqual(len(links_fwd), len(trg_subset[0]))
+            self.assertRaises(ValueError, eflomal.align_arrays, src_sents,
+                              trg_sents, priors_filename=priors.name,
+                              source_vocabulary_size=1)
+
     def test_makepriors(self):
         """Test creating priors"""
         aligner = eflomal.Aligner()
@@ -67,3 +510,150 @@ class TestAlign(unittest.TestCase):
             eflomal.write_priors(priorsf, *priors_tuple)
             priorsf.seek(0)
             self.assertGreater(len(priorsf.readlines()), 5)
+
+    def test_makepriors_jobs(self):
+        """Test that creating priors in parallel shards gives the same output"""
+        aligner = eflomal.Aligner(seed=1)
+        src_data, trg_data = self.src_data * 5, self.trg_data * 5
+        with tempfile.NamedTemporaryFile('w+') as fwd_links, \
+             tempfile.NamedTemporaryFile('w+') as rev_links:
+            aligner.align(src_data, trg_data,
+                          links_filename_fwd=fwd_links.name,
+                          links_filename_rev=rev_links.name)
+            fwd, rev = fwd_links.readlines(), rev_links.readlines()
+        outputs = []
+        for n_jobs, shard_size in ((1, eflomal.SHARD_SIZE), (2, 4)):
+            priors_tuple = eflomal.calculate_priors(
+                src_data, trg_data, fwd, rev, False, n_jobs=n_jobs,
+                shard_size=shard_size)
+            with io.StringIO() as priorsf:
+                eflomal.write_priors(priorsf, *priors_tuple)
+                outputs.append(priorsf.getvalue().encode('utf-8'))
+        self.assertGreater(len(outputs[0]), 0)
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_binary_links(self):
+        """Test writing and reading links in the binary format"""
+        aligner = eflomal.Aligner(seed=1)
+        with tempfile.NamedTemporaryFile('w+') as fwd_links, \
+             tempfile.NamedTemporaryFile('w+') as rev_links, \
+             tempfile.NamedTemporaryFile('w+') as sym_links, \
+             tempfile.NamedTemporaryFile('wb') as fwd_binary, \
+             tempfile.NamedTemporaryFile('wb') as rev_binary, \
+             tempfile.NamedTemporaryFile('wb') as sym_binary:
+            aligner.align(self.src_data, self.trg_data,
+                          links_filename_fwd=fwd_links.name,
+                          links_filename_rev=rev_links.name,
+                          links_filename_sym=sym_links.name)
+            aligner.align(self.src_data, self.trg_data,
+                          links_filename_fwd=fwd_binary.name,
+                          links_filename_rev=rev_binary.name,
+                          links_filename_sym=sym_binary.name,
+                          binary_links=True)
+            for text, binary in ((fwd_links, fwd_binary),
+                                 (rev_links, rev_binary),
+                                 (sym_links, sym_binary)):
+                links = eflomal.read_binary_links(binary.name)
+                self.assertEqual(len(links), 3)
+                self.assertEqual(links.to_lines(),
+                                 [line.strip() for line in text])
+            with eflomal.open_links(fwd_binary.name) as fwd, \
+                 eflomal.open_links(rev_binary.name) as rev:
+                binary_tuple = eflomal.calculate_priors(
+                    self.src_data, self.trg_data, fwd, rev, False,
+                    n_jobs=2, shard_size=1)
+            fwd_links.seek(0)
+            rev_links.seek(0)
+            text_tuple = eflomal.calculate_priors(
+                self.src_data, self.trg_data, fwd_links, rev_links, False)
+        self.assertEqual(binary_tuple, text_tuple)
+
+    def test_evaluate(self):
+        """Test evaluating links against a gold standard"""
+        from eflomal.evaluate import evaluate
+        gold = ['1 1 1', '1 2 2 S', '1 2 3 P', '1 3 3 P 0.5', '2 1 2 S P',
+                '2 2 1 0.8', '']
+        links = ['0-0 1-2 2-1', '0-1 1-1']
+        scores = evaluate(gold, links)
+        # A = 5 links, S = 4 (incl. 2 1 2), P = 3, A & S = 2, A & (S|P) = 3
+        self.assertEqual((scores['n_links'], scores['n_sure'],
+                          scores['n_possible']), (5, 4, 3))
+        self.assertAlmostEqual(scores['sure_precision'], 2/5)
+        self.assertAlmostEqual(scores['sure_recall'], 2/4)
+        self.assertAlmostEqual(scores['possible_precision'], 3/5)
+        self.assertAlmostEqual(scores['possible_recall'], 3/7)
+        self.assertAlmostEqual(scores['aer'], 1 - 5/9)
+        # only the first line, numbered as sentence 2
+        scores = evaluate(gold, links, numbers=[2])
+        self.assertEqual(scores['n_links'], 3)
+        self.assertAlmostEqual(scores['sure_precision'], 0)
+        with tempfile.NamedTemporaryFile('wb') as binary:
+            aligner = eflomal.Aligner(seed=1)
+            aligner.align(self.src_data, self.trg_data,
+                          links_filename_fwd=binary.name, binary_links=True)
+            binary_links = eflomal.read_binary_links(binary.name)
+            self.assertEqual(
+                evaluate(gold, binary_links, n_jobs=2, shard_size=1),
+                evaluate(gold, binary_links.to_lines()))
+
+    def test_dedup(self):
+        """Test aligning identical sentence pairs once"""
+        src_data = self.src_data * 4 + self.src_data[:1]
+        trg_data = self.trg_data * 4 + self.trg_data[:1]
+        aligner = eflomal.Aligner(dedup=True)
+        with tempfile.NamedTemporaryFile('w+') as fwd_links, \
+             tempfile.NamedTemporaryFile('w+') as sym_links, \
+             tempfile.NamedTemporaryFile('w+') as fwd_scores:
+            aligner.align(src_data, trg_data,
+                          links_filename_fwd=fwd_links.name,
+                          links_filename_sym=sym_links.name,
+                          scores_filename_fwd=fwd_scores.name)
+            for f in (fwd_links, sym_links, fwd_scores):
+                lines = f.readlines()
+                self.assertEqual(len(lines), len(src_data))
+                # the copies of a sentence pair are aligned together
+                for i, line in enumerate(lines):
+                    self.assertEqual(line, lines[i % 3])
+
+    def test_align_multi(self):
+        """Test aligning one source text with several targets"""
+        aligner = eflomal.Aligner(seed=1)
+        with tempfile.NamedTemporaryFile('w+') as links1, \
+             tempfile.NamedTemporaryFile('w+') as links2, \
+             tempfile.NamedTemporaryFile('w+') as single:
+            aligner.align_multi(self.src_data,
+                                [self.trg_data, self.trg_data],
+                                links_filenames_fwd=[links1.name,
+                                                     links2.name],
+                                n_workers=2)
+            aligner.align(self.src_data, self.trg_data,
+                          links_filename_fwd=single.name)
+            expected = single.readlines()
+            self.assertEqual(len(expected), len(self.src_data))
+            for f in (links1, links2):
+                self.assertEqual(f.readlines(), expected)
+        with self.assertRaises(ValueError):
+            aligner.align_multi(self.src_data,
+                                [self.trg_data, self.trg_data[:-1]])
+
+    def test_align_multi_filenames(self):
+        """Test aligning with several targets given as filenames"""
+        aligner = eflomal.Aligner(seed=1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            plain = os.path.join(tmpdir, 'trg.txt')
+            compressed = os.path.join(tmpdir, 'trg.txt.gz')
+            with open(plain, 'w', encoding='utf-8') as f:
+                f.writelines(self.trg_data)
+            with gzip.open(compressed, 'wt', encoding='utf-8') as f:
+                f.writelines(self.trg_data)
+            links = [os.path.join(tmpdir, name)
+                     for name in ('single', 'plain', 'compressed')]
+            aligner.align(self.src_data, self.trg_data,
+                          links_filename_fwd=links[0])
+            aligner.align_multi(self.src_data, [plain, compressed],
+                                links_filenames_fwd=links[1:], n_workers=1)
+            with open(links[0]) as f:
+                expected = f.readlines()
+            for filename in links[1:]:
+                with open(filename) as f:
+                    self.assertEqual(f.readlines(), expected)